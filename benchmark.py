@@ -0,0 +1,212 @@
+import argparse
+import datetime
+import json
+import os
+from pathlib import Path
+import platform
+import random
+import shutil
+import subprocess
+import sys
+
+import stageMetrics
+
+# Throughput benchmarks of the pipeline stages on synthetic fixtures.
+# Every stage runs in its own Python process, so its peak RSS is its own. The
+# stages report through the shared hook of stageMetrics.py: the pipeline
+# scripts measure and count their own work, library functions without a stage
+# entry point are measured here under the name of their benchmark. The results
+# of all stages are written to one JSON file, to be compared across versions.
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+TWITTER_EXPANDER = os.path.join(ROOT, "dagw", "scripts", "twitter_expander")
+FORMAT_VALIDATOR = os.path.join(ROOT, "dagw", "scripts", "format_validator", "src")
+SECTION = "bench"
+PROFILERS = ["none", "cprofile", "py-spy"]
+
+WORDS = ["Danmark", "København", "regeringen", "har", "i", "dag", "besluttet", "at", "de", "nye", "regler",
+         "for", "indvandring", "skal", "gælde", "fra", "næste", "år", "og", "ministeren", "siger", "det",
+         "er", "en", "god", "dag", "Islam", "kvinder", "muslimer", "Europa", "statsminister", "Folketinget",
+         "partiet", "vælgerne", "debatten", "om", "ytringsfrihed", "på", "Twitter", "æble", "øl", "så"]
+
+
+def sentence(rng, nWords):
+    return " ".join(rng.choice(WORDS) for _ in range(nWords))
+
+def makeSpotlight(path, n, rng):
+    # DBpedia Spotlight responses with a resource on some of the tokens
+    with open(path, "w", encoding="utf-8") as file:
+        for _ in range(n):
+            text = sentence(rng, rng.randint(8, 30))
+            resources = []
+            offset = 0
+            for word in text.split(" "):
+                if word[0].isupper() and rng.random() < 0.7:
+                    resources.append({"@URI":"http://da.dbpedia.org/resource/" + word, "@support":"100",
+                                      "@types":"", "@surfaceForm":word, "@offset":str(offset),
+                                      "@similarityScore":"0.99", "@percentageOfSecondRank":"0.01"})
+                offset += len(word) + 1
+            entry = {"@text":text, "@confidence":"0.5", "@support":"0", "@types":"", "@sparql":"", "@policy":"whitelist"}
+            if resources:
+                entry["Resources"] = resources
+            file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+def makeTweets(path, n, rng):
+    # Hydrated tweets, with some repeated ids as in overlapping hydration batches
+    with open(path, "w", encoding="utf-8") as file:
+        for i in range(n):
+            tweetId = i if rng.random() > 0.02 else rng.randrange(max(i, 1))
+            file.write(json.dumps({"id":tweetId, "id_str":str(tweetId), "full_text":sentence(rng, rng.randint(5, 40)),
+                                   "lang":"da", "user":{"screen_name":"user" + str(i % 97)}}) + "\n")
+
+def makeSection(sectionDir, section, nDocs, rng):
+    # A DAGW section: LICENSE, metadata manifest and plain text documents
+    os.makedirs(sectionDir, exist_ok=True)
+    with open(os.path.join(sectionDir, "LICENSE"), "w", encoding="utf-8") as file:
+        file.write("Synthetic benchmark data.")
+    with open(os.path.join(sectionDir, section + ".jsonl"), "w", encoding="utf-8") as meta:
+        for i in range(nDocs):
+            docId = section + "_" + str(i)
+            with open(os.path.join(sectionDir, docId), "w", encoding="utf-8") as file:
+                for _ in range(rng.randint(1, 20)):
+                    file.write(sentence(rng, rng.randint(5, 40)) + "\n")
+            meta.write(json.dumps({"doc_id":docId, "date_built":"Fri Oct 16 12:00:00 2026 CEST +0200",
+                                   "uri":"https://gigaword.dk", "year_published":2020}) + "\n")
+
+def makeFixtures(fixtureDir, scale=1.0, seed=0):
+    rng = random.Random(seed)
+    os.makedirs(fixtureDir, exist_ok=True)
+    makeSpotlight(os.path.join(fixtureDir, "spotlight.ndjson"), int(20000 * scale), rng)
+    makeTweets(os.path.join(fixtureDir, "tweets.jsonl"), int(50000 * scale), rng)
+    for i in range(4):
+        name = SECTION + str(i)
+        makeSection(os.path.join(fixtureDir, "sektioner", name), name, int(1000 * scale), rng)
+    with open(os.path.join(fixtureDir, "fixtures.json"), "w", encoding="utf-8") as file:
+        json.dump({"scale":scale, "seed":seed}, file)
+
+
+def benchSpotlightParsing(fixtureDir, args):
+    from dataAnnotation import readSpotlightEntries
+    with stageMetrics.measure("spotlight_parsing"):
+        for entry in readSpotlightEntries(os.path.join(fixtureDir, "spotlight.ndjson")):
+            stageMetrics.add("spotlight_parsing")
+
+def benchSourceTarget(fixtureDir, args):
+    import spacy
+    from dataAnnotation import createSource, createTarget, loadAnnotationPipeline
+    nlp = spacy.blank("da") if args.model == "blank" else loadAnnotationPipeline(args.model)
+    entries = [json.loads(line) for line in open(os.path.join(fixtureDir, "spotlight.ndjson"), encoding="utf-8")]
+    entries = [entry for entry in entries if "Resources" in entry]
+    with stageMetrics.measure("source_target"):
+        for entry in entries:
+            createSource(nlp, entry)
+            createTarget(entry)
+            stageMetrics.add("source_target")
+
+def benchTweetExpansion(fixtureDir, args):
+    sys.path.insert(0, TWITTER_EXPANDER)
+    import main as expander
+    inputPath = os.path.join(fixtureDir, "tweets.jsonl")
+    outputDir = os.path.join(fixtureDir, "expanded", SECTION)
+    sys.argv = ["main.py", "--input", inputPath, "--section_name", SECTION, "--output", outputDir,
+                "--shard_tweets", "10000"]
+    if args.jobs > 1:
+        sys.argv += ["--dedup", "--jobs", str(args.jobs), "--chunk_bytes", str(4 << 20)]
+    expander.main()
+
+def benchSectionValidation(fixtureDir, args):
+    sys.path.insert(0, FORMAT_VALIDATOR)
+    from engine import validate_section
+    sectionDir = os.path.join(fixtureDir, "sektioner", SECTION + "0")
+    reports = validate_section(Path(sectionDir), "strict", args.jobs)
+    failed = [message for timed in reports for message in timed.report.fail_messages]
+    if failed:
+        raise RuntimeError("Fixture section failed validation: " + failed[0])
+
+def benchDocumentFrequency(fixtureDir, args):
+    sys.path.insert(0, os.path.join(ROOT, "dagw"))
+    from documentFrequency import countCorpus
+    countCorpus(os.path.join(fixtureDir, "sektioner"), args.tokenizer, args.jobs)
+
+# Stages report their metrics under the name of their benchmark
+STAGES = {"spotlight_parsing":benchSpotlightParsing,
+          "source_target":benchSourceTarget,
+          "tweet_expansion":benchTweetExpansion,
+          "section_validation":benchSectionValidation,
+          "document_frequency":benchDocumentFrequency}
+
+
+def runStage(name, args):
+    # Runs one stage in this process and writes its metrics to args.result
+    import logging
+    logging.basicConfig(level=logging.WARNING)
+    stageMetrics.configure(args.profile, args.profile_dir)
+    STAGES[name](args.fixtures, args)
+    with open(args.result, "w", encoding="utf-8") as file:
+        json.dump(stageMetrics.stage(name).result(), file)
+
+def gitVersion():
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def runAll(args):
+    if not os.path.exists(os.path.join(args.fixtures, "fixtures.json")) or args.regenerate:
+        shutil.rmtree(args.fixtures, ignore_errors=True)
+        print("Generating fixtures in " + args.fixtures)
+        makeFixtures(args.fixtures, args.scale, args.seed)
+    with open(os.path.join(args.fixtures, "fixtures.json"), "r", encoding="utf-8") as file:
+        fixtures = json.load(file)
+    if args.profile != "none":
+        os.makedirs(args.profile_dir, exist_ok=True)
+
+    results = {"version":gitVersion(), "date":datetime.datetime.now().isoformat(timespec="seconds"),
+               "python":platform.python_version(), "platform":platform.platform(), "cpus":os.cpu_count(),
+               "fixtures":fixtures, "jobs":args.jobs, "stages":{}}
+    for name in args.stages:
+        resultPath = os.path.join(args.fixtures, name + ".result.json")
+        command = [sys.executable, os.path.abspath(__file__), "--run_stage", name, "--result", resultPath,
+                   "--fixtures", args.fixtures, "--jobs", str(args.jobs), "--model", args.model,
+                   "--tokenizer", args.tokenizer, "--profile", args.profile, "--profile_dir", args.profile_dir]
+        completed = subprocess.run(command, cwd=ROOT)
+        if completed.returncode != 0:
+            results["stages"][name] = {"error":"exit code " + str(completed.returncode)}
+            continue
+        with open(resultPath, "r", encoding="utf-8") as file:
+            results["stages"][name] = json.load(file)
+        os.remove(resultPath)
+        stage = results["stages"][name]
+        print("{:<20} {:>10} records {:>9.2f}s {:>12} rec/s {:>8.1f} MB".format(
+            name, stage["records"], stage["seconds"], str(stage["records_per_sec"]), stage["peak_rss_mb"]))
+
+    with open(args.output, "w", encoding="utf-8") as file:
+        json.dump(results, file, indent=2)
+    print("Results written to " + args.output)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks the pipeline stages on synthetic fixtures")
+    parser.add_argument("--stages", nargs="*", choices=list(STAGES), default=list(STAGES))
+    parser.add_argument("--fixtures", default="benchmark_fixtures", help="Directory of the generated fixtures")
+    parser.add_argument("--regenerate", action="store_true", default=False, help="Generate the fixtures again")
+    parser.add_argument("--scale", type=float, default=1.0, help="Size of the fixtures relative to the default")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--jobs", type=int, default=1, help="Worker processes of the stages that support them")
+    parser.add_argument("--model", default="da_core_news_sm",
+                        help="spaCy model of the source_target stage, \"blank\" for a tokenizer-only pipeline")
+    parser.add_argument("--tokenizer", default="spacy", help="Tokenizer of the document_frequency stage")
+    parser.add_argument("--profile", choices=PROFILERS, default="none")
+    parser.add_argument("--profile_dir", default="benchmark_profiles")
+    parser.add_argument("--output", default="benchmark.json", help="JSON file the results are written to")
+    parser.add_argument("--run_stage", choices=list(STAGES), default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--result", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    args.fixtures = os.path.abspath(args.fixtures)
+    args.profile_dir = os.path.abspath(args.profile_dir)
+    if args.run_stage is not None:
+        runStage(args.run_stage, args)
+    else:
+        runAll(args)
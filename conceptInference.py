@@ -0,0 +1,384 @@
+import argparse
+import collections
+import concurrent.futures
+import http.server
+import json
+import os
+import queue
+import threading
+import time
+import numpy as np
+
+from conceptStore import FIELD_ORDER, KINDS
+from dataAnnotation import createSourceFromDoc, loadAnnotationPipeline, truncate
+from docCache import DEFAULT_MAX_BYTES, DocCache
+
+# CPU inference for the copy-attention models trained from the
+# concept_extraction_*.yaml configs. Texts are tagged with the same pipeline
+# and turned into the same "token POS token POS ..." source strings as the
+# training data (createSource), translated by the OpenNMT model, and the
+# predicted concepts are mapped back to spans of the text. The output has the
+# schema of the *_concepts_extracted.json files: VERB/ADJ/ADV spans from the
+# tagger and the predicted spans under "concepts".
+#
+# Requests are batched dynamically: a single worker thread collects the texts
+# submitted within maxWait seconds (at most maxBatch), and the sources that
+# are not cached are translated in batches of similar length, so a batch
+# padded to its longest source stays under maxTokens. Results are kept in an
+# LRU cache keyed by the text, as the same tweets are often seen repeatedly.
+
+ASPECT_KINDS = ["VERB", "ADJ", "ADV"]
+GAP = "*"
+
+
+class OnmtTranslator:
+    # Wraps an OpenNMT-py translator, torch and onmt are only needed here.
+    # The models are OpenNMT-py 2.x checkpoints, which 3.x does not load: it
+    # reads the vocabulary in another format, and its checkpoint loader misses
+    # the weights of the copy generator (3.5)
+    def __init__(self, modelPath, beamSize=5, maxLength=100, threads=1):
+        import torch
+        import onmt
+        import onmt.opts
+        from onmt.utils.parse import ArgumentParser
+
+        if not onmt.__version__.startswith("2."):
+            raise RuntimeError("The concept extraction models need OpenNMT-py 2.x, found " + onmt.__version__ +
+                               ". Install it with: pip install 'OpenNMT-py>=2,<3'")
+        from onmt.translate.translator import build_translator
+
+        torch.set_num_threads(threads)
+        parser = ArgumentParser()
+        onmt.opts.config_opts(parser)
+        onmt.opts.translate_opts(parser)
+        opt = parser.parse_args(["-model", modelPath, "-src", "-", "-gpu", "-1", "-beam_size", str(beamSize),
+                                 "-max_length", str(maxLength), "-replace_unk"])
+        ArgumentParser.validate_translate_opts(opt)
+        self.devnull = open(os.devnull, "w", encoding="utf-8")
+        self.translator = build_translator(opt, out_file=self.devnull, report_score=False)
+
+    def translate(self, sources):
+        _, predictions = self.translator.translate(src=sources, batch_size=len(sources), batch_type="sents")
+        return [nBest[0] for nBest in predictions]
+
+
+def loadInferencePipeline(model="da_core_news_sm"):
+    # Same components as for annotation, so the sources match the training
+    # data, plus the sentence recognizer for the sent_id of the spans
+    nlp = loadAnnotationPipeline(model)
+    if "senter" in nlp.component_names and "senter" in nlp.disabled:
+        nlp.enable_pipe("senter")
+    return nlp
+
+def splitTarget(target):
+    # Target strings are the concepts' surface forms separated by "*" (see createTarget)
+    phrases = [[]]
+    for token in target.split():
+        if token == GAP:
+            phrases.append([])
+        else:
+            phrases[-1].append(token)
+    return [phrase for phrase in phrases if phrase]
+
+def findPhrase(doc, phrase, start):
+    # Token span of the first occurrence of phrase from token start on, or
+    # of the phrase in the text if the model joined or split tokens differently
+    n = len(phrase)
+    words = [token.text for token in doc]
+    for i in list(range(start, len(words) - n + 1)) + list(range(0, min(start, len(words) - n + 1))):
+        if words[i:i+n] == phrase:
+            return doc[i:i+n]
+    begin = doc.text.find(" ".join(phrase))
+    if begin == -1:
+        return None
+    return doc.char_span(begin, begin + len(" ".join(phrase)), alignment_mode="expand")
+
+def makeSpan(doc, span, kind, sentences):
+    following = doc[span.end] if span.end < len(doc) else None
+    return {
+        "postags":" ".join(token.tag_ for token in span),
+        "text":span.text,
+        "begin":span.start_char,
+        "end":span.end_char,
+        "type":kind,
+        "next_tag":following.tag_ if following is not None else "",
+        "next_word":following.text if following is not None else "",
+        "sent_id":int(sentences[span.start])
+    }
+
+def docSpans(doc, target):
+    # Returns the (kind, span) pairs of one text, with sent_id counted from 0
+    # within the text, and its number of sentences
+    if doc.has_annotation("SENT_START"):
+        sentences = np.cumsum([token.is_sent_start and token.i > 0 for token in doc], dtype=np.int64)
+    else:
+        sentences = np.zeros(len(doc), dtype=np.int64)
+    nSentences = int(sentences[-1]) + 1 if len(doc) > 0 else 0
+
+    spans = [(token.pos_, makeSpan(doc, doc[token.i:token.i+1], token.pos_, sentences))
+             for token in doc if token.pos_ in ASPECT_KINDS]
+    position = 0
+    for phrase in splitTarget(target):
+        span = findPhrase(doc, phrase, position)
+        if span is None or len(span) == 0:
+            continue
+        spans.append(("concepts", makeSpan(doc, span, "NOUN", sentences)))
+        position = span.end
+    return spans, nSentences
+
+def lengthBatches(lengths, maxBatch, maxTokens):
+    # Indices grouped by length, a batch is cut when padding it to its
+    # longest (last) source would exceed maxTokens
+    batches = []
+    current = []
+    for i in np.argsort(lengths, kind="stable"):
+        if current and (len(current) >= maxBatch or (len(current) + 1) * lengths[i] > maxTokens):
+            batches.append(current)
+            current = []
+        current.append(int(i))
+    if current:
+        batches.append(current)
+    return batches
+
+def assembleConcepts(results, textIds=None):
+    # Joins per-text results into one *_concepts_extracted.json object, with
+    # sent_id counted over all texts as in the extracted files
+    concepts = {kind:[] for kind in KINDS}
+    sentOffset = 0
+    for position, (spans, nSentences) in enumerate(results):
+        textId = textIds[position] if textIds is not None else position
+        for kind, span in spans:
+            entry = dict(span, sent_id=str(span["sent_id"] + sentOffset), text_id=textId)
+            concepts[kind].append({field:entry[field] for field in FIELD_ORDER})
+        sentOffset += nSentences
+    return concepts
+
+
+class ConceptExtractor:
+    # Not thread-safe, concurrent callers go through a DynamicBatcher
+    def __init__(self, nlp, translator, maxBatch=64, maxTokens=8000, srcTrunc=400, cacheSize=100000,
+                 docCache=None):
+        self.nlp = nlp
+        self.translator = translator
+        self.maxBatch = maxBatch
+        self.maxTokens = maxTokens
+        self.srcTrunc = srcTrunc
+        self.cache = collections.OrderedDict()
+        self.cacheSize = cacheSize
+        self.docCache = docCache
+        self.stats = {"texts":0, "hits":0, "batches":0, "translated":0, "seconds":0.0}
+
+    def process(self, texts):
+        # Returns (spans, nSentences) for every text
+        start = time.perf_counter()
+        self.stats["texts"] += len(texts)
+        results = [None] * len(texts)
+        missing = collections.OrderedDict()
+        for position, text in enumerate(texts):
+            if text in self.cache:
+                self.cache.move_to_end(text)
+                results[position] = self.cache[text]
+            else:
+                missing.setdefault(text, []).append(position)
+        self.stats["hits"] += len(texts) - sum(len(positions) for positions in missing.values())
+
+        if missing:
+            pipe = self.docCache.pipe if self.docCache is not None else self.nlp.pipe
+            docs = list(pipe(missing.keys(), batch_size=self.maxBatch))
+            sources = [truncate(createSourceFromDoc(doc), self.srcTrunc)[0] for doc in docs]
+            # Texts without words, e.g. empty tweets, have no concepts and are not given to the model
+            targets = [""] * len(sources)
+            nonEmpty = [i for i, doc in enumerate(docs) if any(not token.is_space for token in doc)]
+            lengths = np.array([len(sources[i].split()) for i in nonEmpty], dtype=np.int64)
+            for batch in lengthBatches(lengths, self.maxBatch, self.maxTokens):
+                batch = [nonEmpty[i] for i in batch]
+                for i, target in zip(batch, self.translator.translate([sources[i] for i in batch])):
+                    targets[i] = target
+                self.stats["batches"] += 1
+            self.stats["translated"] += len(nonEmpty)
+
+            for doc, target, (text, positions) in zip(docs, targets, missing.items()):
+                result = docSpans(doc, target)
+                for position in positions:
+                    results[position] = result
+                self.cache[text] = result
+                if len(self.cache) > self.cacheSize:
+                    self.cache.popitem(last=False)
+
+        self.stats["seconds"] += time.perf_counter() - start
+        return results
+
+    def extract(self, texts):
+        return assembleConcepts(self.process(list(texts)))
+
+
+class DynamicBatcher:
+    # Collects the texts submitted from any thread into batches for one worker thread
+    def __init__(self, process, maxBatch=64, maxWait=0.01):
+        self.process = process
+        self.maxBatch = maxBatch
+        self.maxWait = maxWait
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, text):
+        future = concurrent.futures.Future()
+        self.queue.put((text, future))
+        return future
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = time.monotonic() + self.maxWait
+            while len(batch) < self.maxBatch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is None:
+                    self.queue.put(None)
+                    break
+                batch.append(item)
+
+            try:
+                results = self.process([text for text, _ in batch])
+            except Exception as error:
+                if len(batch) == 1:
+                    batch[0][1].set_exception(error)
+                    continue
+                # The texts are processed one by one, so only the ones that fail get the error
+                for text, future in batch:
+                    try:
+                        future.set_result(self.process([text])[0])
+                    except Exception as error:
+                        future.set_exception(error)
+                continue
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
+
+    def extract(self, texts, timeout=None):
+        futures = [self.submit(text) for text in texts]
+        return assembleConcepts([future.result(timeout) for future in futures])
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+
+def makeHandler(batcher, extractor, timeout):
+    class ConceptHandler(http.server.BaseHTTPRequestHandler):
+        def sendJson(self, status, body):
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_POST(self):
+            # {"texts": [...]} -> {"VERB": [...], "ADJ": [...], "ADV": [...], "concepts": [...]}
+            if self.path != "/extract":
+                self.sendJson(404, {"error":"unknown path " + self.path})
+                return
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                texts = request["texts"]
+                if not isinstance(texts, list) or not all(isinstance(text, str) for text in texts):
+                    raise ValueError("texts must be a list of strings")
+            except (KeyError, TypeError, ValueError) as error:
+                self.sendJson(400, {"error":str(error)})
+                return
+            try:
+                self.sendJson(200, batcher.extract(texts, timeout))
+            except concurrent.futures.TimeoutError:
+                self.sendJson(503, {"error":"timed out"})
+            except Exception as error:
+                # Errors of the batch the texts were in, re-raised by the futures
+                self.sendJson(500, {"error":type(error).__name__ + ": " + str(error)})
+
+        def do_GET(self):
+            if self.path != "/stats":
+                self.sendJson(404, {"error":"unknown path " + self.path})
+                return
+            self.sendJson(200, dict(extractor.stats, cached=len(extractor.cache)))
+
+        def log_message(self, format, *args):
+            return
+
+    return ConceptHandler
+
+def readTexts(path):
+    # One tweet per line, either plain text or JSON records with a "text" field
+    with open(path, "r", encoding="utf-8") as file:
+        for line in file:
+            line = line.rstrip("\n")
+            if line.startswith("{"):
+                yield json.loads(line)["text"]
+            elif line != "":
+                yield line
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Extracts concepts from tweets with a trained OpenNMT model on CPU")
+    parser.add_argument("model", help="OpenNMT-py 2.x checkpoint, e.g. run/model_dbpedia_spotlight10_100k_2l_da_mlp_step_100000.pt")
+    parser.add_argument("--spacy_model", default="da_core_news_sm", help="spaCy model used for POS tagging")
+    parser.add_argument("--input", default=None,
+                        help="Texts to extract concepts from, one per line; without it an HTTP server is started")
+    parser.add_argument("--output", default="concepts_extracted.json", help="Output of --input")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--beam_size", type=int, default=5)
+    parser.add_argument("--max_length", type=int, default=100, help="Longest target, tgt_seq_length_trunc in training")
+    parser.add_argument("--src_seq_length_trunc", type=int, default=400, help="Sources are truncated as in training")
+    parser.add_argument("--threads", type=int, default=1, help="Torch threads")
+    parser.add_argument("--max_batch", type=int, default=64, help="Most texts translated at once")
+    parser.add_argument("--max_tokens", type=int, default=8000,
+                        help="Most source tokens in a batch, counting padding to its longest source")
+    parser.add_argument("--max_wait_ms", type=float, default=10,
+                        help="How long the server waits for more requests before translating a batch")
+    parser.add_argument("--timeout", type=float, default=60, help="Seconds before a server request fails")
+    parser.add_argument("--cache_size", type=int, default=100000, help="Texts whose results are kept in memory")
+    parser.add_argument("--doc_cache", default=None,
+                        help="Directory of a spaCy Doc cache (see docCache.py). Docs are keyed by the pipeline "
+                             "components, so with the sentence recognizer enabled they are not shared with "
+                             "dataAnnotation.py")
+    parser.add_argument("--doc_cache_gb", type=float, default=DEFAULT_MAX_BYTES / 1024**3,
+                        help="Size limit of --doc_cache in GB")
+    args = parser.parse_args()
+
+    nlp = loadInferencePipeline(args.spacy_model)
+    docCache = DocCache(args.doc_cache, nlp, int(args.doc_cache_gb * 1024**3)) if args.doc_cache is not None else None
+    translator = OnmtTranslator(args.model, args.beam_size, args.max_length, args.threads)
+    extractor = ConceptExtractor(nlp, translator, args.max_batch, args.max_tokens, args.src_seq_length_trunc,
+                                 args.cache_size, docCache)
+
+    if args.input is not None:
+        start = time.perf_counter()
+        texts = list(readTexts(args.input))
+        results = []
+        for batchStart in range(0, len(texts), args.max_batch):
+            results.extend(extractor.process(texts[batchStart:batchStart + args.max_batch]))
+        with open(args.output, "w", encoding="utf-8") as outputfile:
+            json.dump(assembleConcepts(results), outputfile, separators=(",", ":"))
+        print(str(len(texts)) + " texts in " + str(round(time.perf_counter() - start, 1)) + "s, " +
+              str(extractor.stats["hits"]) + " cached")
+    else:
+        batcher = DynamicBatcher(extractor.process, args.max_batch, args.max_wait_ms / 1000)
+        server = http.server.ThreadingHTTPServer((args.host, args.port), makeHandler(batcher, extractor, args.timeout))
+        print("Serving on http://" + args.host + ":" + str(args.port) + "/extract")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        server.server_close()
+        batcher.close()
+
+    if docCache is not None:
+        docCache.close()
@@ -0,0 +1,168 @@
+import argparse
+import json
+import os
+import numpy as np
+
+# Columnar, memory-mapped version of the *_concepts_extracted.json files.
+# Every span of the VERB/ADJ/ADV/concepts lists becomes one row. String fields
+# are interned into a single UTF-8 blob, and rows are sorted by
+# (text_id, sent_id) so the spans of a tweet are one contiguous slice.
+
+KINDS = ["VERB", "ADJ", "ADV", "concepts"]
+STRING_FIELDS = ["postags", "text", "type", "next_tag", "next_word"]
+INT_FIELDS = ["begin", "end", "sent_id", "text_id"]
+# Key order of the spans in the original files
+FIELD_ORDER = ["postags", "text", "begin", "end", "type", "next_tag", "next_word", "sent_id", "text_id"]
+
+
+class StringTable:
+    def __init__(self):
+        self.ids = {}
+        self.strings = []
+
+    def intern(self, string):
+        stringId = self.ids.get(string)
+        if stringId is None:
+            stringId = len(self.strings)
+            self.ids[string] = stringId
+            self.strings.append(string)
+        return stringId
+
+    def save(self, storeDir):
+        encoded = [string.encode("utf-8") for string in self.strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(string) for string in encoded])
+        np.save(os.path.join(storeDir, "strings.npy"), np.frombuffer(b"".join(encoded), dtype=np.uint8))
+        np.save(os.path.join(storeDir, "string_offsets.npy"), offsets)
+
+
+def convert(jsonPath, storeDir):
+    with open(jsonPath, "r", encoding="utf-8") as file:
+        extracted = json.load(file)
+
+    strings = StringTable()
+    columns = {field:[] for field in STRING_FIELDS + INT_FIELDS + ["kind", "position"]}
+    for kindId, kind in enumerate(KINDS):
+        for position, span in enumerate(extracted.get(kind, [])):
+            for field in STRING_FIELDS:
+                columns[field].append(strings.intern(span[field]))
+            for field in INT_FIELDS:
+                # sent_id is a numeric string in the extracted files
+                columns[field].append(int(span[field]))
+            columns["kind"].append(kindId)
+            columns["position"].append(position)
+
+    arrays = {field:np.asarray(values, dtype=np.int32) for field, values in columns.items()}
+    arrays["kind"] = arrays["kind"].astype(np.uint8)
+    arrays["begin"] = arrays["begin"].astype(np.int64)
+    arrays["end"] = arrays["end"].astype(np.int64)
+    arrays["sent_id"] = arrays["sent_id"].astype(np.int64)
+
+    # Stable sort keeps the original list order within a sentence
+    order = np.lexsort((arrays["position"], arrays["kind"], arrays["sent_id"], arrays["text_id"]))
+    os.makedirs(storeDir, exist_ok=True)
+    for field, values in arrays.items():
+        np.save(os.path.join(storeDir, field + ".npy"), values[order])
+
+    # CSR index: the rows of text_id t are text_offsets[t]:text_offsets[t+1]
+    textIds = arrays["text_id"][order]
+    nTexts = int(textIds.max()) + 1 if len(textIds) > 0 else 0
+    textOffsets = np.zeros(nTexts + 1, dtype=np.int64)
+    textOffsets[1:] = np.cumsum(np.bincount(textIds, minlength=nTexts))
+    np.save(os.path.join(storeDir, "text_offsets.npy"), textOffsets)
+
+    strings.save(storeDir)
+
+
+class ConceptStore:
+    def __init__(self, storeDir, mmap=True):
+        mode = "r" if mmap else None
+        load = lambda name: np.load(os.path.join(storeDir, name + ".npy"), mmap_mode=mode)
+        self.columns = {field:load(field) for field in STRING_FIELDS + INT_FIELDS + ["kind", "position"]}
+        self.textOffsets = load("text_offsets")
+        self.stringBlob = load("strings")
+        self.stringOffsets = load("string_offsets")
+
+    def __len__(self):
+        return len(self.columns["text_id"])
+
+    @property
+    def nTexts(self):
+        return len(self.textOffsets) - 1
+
+    def string(self, stringId):
+        start, end = self.stringOffsets[stringId], self.stringOffsets[stringId + 1]
+        return bytes(self.stringBlob[start:end]).decode("utf-8")
+
+    def decodeStrings(self):
+        # The interning table is small compared to the spans, so it is decoded once
+        blob = bytes(self.stringBlob)
+        offsets = np.asarray(self.stringOffsets)
+        return [blob[offsets[i]:offsets[i+1]].decode("utf-8") for i in range(len(offsets) - 1)]
+
+    def textRows(self, textId):
+        # Row range of all spans of a tweet, O(1)
+        if textId < 0 or textId >= self.nTexts:
+            return 0, 0
+        return int(self.textOffsets[textId]), int(self.textOffsets[textId + 1])
+
+    def sentenceRows(self, textId, sentId):
+        start, end = self.textRows(textId)
+        sentIds = self.columns["sent_id"][start:end]
+        return (start + int(np.searchsorted(sentIds, sentId, "left")),
+                start + int(np.searchsorted(sentIds, sentId, "right")))
+
+    def toDicts(self, start, end, kind=None):
+        # Rebuilds the spans of rows [start, end) in the original JSON layout
+        spans = []
+        for row in range(start, end):
+            if kind is not None and KINDS[self.columns["kind"][row]] != kind:
+                continue
+            span = {}
+            for field in FIELD_ORDER:
+                value = self.columns[field][row]
+                if field in STRING_FIELDS:
+                    span[field] = self.string(value)
+                elif field == "sent_id":
+                    span[field] = str(value)
+                else:
+                    span[field] = int(value)
+            spans.append(span)
+        return spans
+
+    def spansForText(self, textId, kind=None):
+        return self.toDicts(*self.textRows(textId), kind=kind)
+
+    def spansForSentence(self, textId, sentId, kind=None):
+        return self.toDicts(*self.sentenceRows(textId, int(sentId)), kind=kind)
+
+    def toJson(self):
+        # Same object as the *_concepts_extracted.json the store was built from
+        extracted = {kind:[] for kind in KINDS}
+        kindIds = np.asarray(self.columns["kind"])
+        positions = np.asarray(self.columns["position"])
+        for kindId, kind in enumerate(KINDS):
+            rows = np.flatnonzero(kindIds == kindId)
+            for row in rows[np.argsort(positions[rows], kind="stable")]:
+                extracted[kind].extend(self.toDicts(row, row + 1))
+        return extracted
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Converts *_concepts_extracted.json files to a columnar store")
+    parser.add_argument("input", help="*_concepts_extracted.json file")
+    parser.add_argument("output", help="Directory of the columnar store")
+    parser.add_argument("--verify", action="store_true", default=False,
+                        help="Check that the store reproduces the input file")
+    args = parser.parse_args()
+
+    convert(args.input, args.output)
+    store = ConceptStore(args.output)
+    print(str(len(store)) + " spans in " + str(store.nTexts) + " texts")
+
+    if args.verify:
+        with open(args.input, "r", encoding="utf-8") as file:
+            if store.toJson() != json.load(file):
+                print("store does not match " + args.input)
+                exit(1)
+        print("store matches " + args.input)
@@ -0,0 +1,181 @@
+import argparse
+import json
+import os
+import re
+import sys
+from collections import Counter
+from multiprocessing import Pool
+import numpy as np
+
+# stageMetrics.py, the metrics hook shared by the stages, is in the repository root
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import stageMetrics
+
+# Document frequencies of the tokens of the Danish Gigaword sections. Only
+# token text is needed, so lines are split by the tokenizer of a blank Danish
+# pipeline (the same rules as da_core_news_sm) or by a regex. Batches of
+# documents are counted in a process pool, every batch into its own Counters,
+# which are merged as they come back.
+#
+# The vocabulary is written to a directory:
+#   terms.npy, term_offsets.npy  UTF-8 terms, sorted bytewise
+#   df.npy                       documents containing each term
+#   tf.npy                       occurrences of each term, with --tf
+#   vocab.json                   number of documents and the settings used
+
+TOKENIZERS = ["spacy", "regex"]
+# Runs of word characters, every other non-space character on its own
+regexPattern = re.compile(r"\w+|[^\w\s]")
+
+
+def isSection(name):
+    return len(name.split(".")) == 1
+
+def isDocument(name):
+    return len(name.split(".")) == 1 and name != "LICENSE"
+
+def listDocuments(corpusDir, sections=None):
+    # Yields (section, document path) for every document of the corpus
+    for section in sorted(os.listdir(corpusDir)):
+        sectionDir = os.path.join(corpusDir, section)
+        if not isSection(section) or not os.path.isdir(sectionDir):
+            continue
+        if sections is not None and section not in sections:
+            continue
+        for docName in sorted(os.listdir(sectionDir)):
+            if isDocument(docName):
+                yield section, os.path.join(sectionDir, docName)
+
+def batchDocuments(documents, docsPerTask):
+    # Groups the documents of each section into tasks of at most docsPerTask
+    batch = []
+    for section, path in documents:
+        if batch and (len(batch) == docsPerTask or batch[-1][0] != section):
+            yield batch
+            batch = []
+        batch.append((section, path))
+    if batch:
+        yield batch
+
+def loadTokenizer(name, lowercase=False):
+    # Returns a function from an iterable of lines to lists of token texts
+    if lowercase:
+        tokenize = loadTokenizer(name)
+        return lambda lines: tokenize(line.lower() for line in lines)
+    if name == "regex":
+        return lambda lines: (regexPattern.findall(line) for line in lines)
+    if name == "spacy":
+        import spacy
+        tokenizer = spacy.blank("da").tokenizer
+        return lambda lines: ([token.text for token in doc] for doc in tokenizer.pipe(lines))
+    raise ValueError("Unknown tokenizer " + name)
+
+
+workerTokenize = None
+
+def initWorker(tokenizerName, lowercase=False):
+    global workerTokenize
+    workerTokenize = loadTokenizer(tokenizerName, lowercase)
+
+def countDocuments(args):
+    # Counts a batch of documents in a worker, returns (nDocs, df, tf or None)
+    paths, withTf = args
+    df = Counter()
+    tf = Counter() if withTf else None
+    for path in paths:
+        # Documents are streamed line by line, only their distinct tokens are kept
+        docTokens = set()
+        with open(path, "r", encoding="utf-8") as file:
+            lines = (line.strip() for line in file)
+            for tokens in workerTokenize(line for line in lines if line):
+                docTokens.update(tokens)
+                if withTf:
+                    tf.update(tokens)
+        df.update(docTokens)
+    return len(paths), df, tf
+
+def countCorpus(corpusDir, tokenizerName="spacy", jobs=1, withTf=False, sections=None, docsPerTask=256,
+                lowercase=False):
+    # Returns (nDocs, df Counter, tf Counter or None) over all documents
+    tasks = (([path for section, path in batch], withTf)
+             for batch in batchDocuments(listDocuments(corpusDir, sections), docsPerTask))
+    nDocs = 0
+    df = Counter()
+    tf = Counter() if withTf else None
+    if jobs > 1:
+        pool = Pool(jobs, initializer=initWorker, initargs=(tokenizerName, lowercase))
+        results = pool.imap_unordered(countDocuments, tasks)
+    else:
+        pool = None
+        initWorker(tokenizerName, lowercase)
+        results = map(countDocuments, tasks)
+    try:
+        with stageMetrics.measure("document_frequency"):
+            for batchDocs, batchDf, batchTf in results:
+                nDocs += batchDocs
+                df.update(batchDf)
+                if withTf:
+                    tf.update(batchTf)
+                stageMetrics.add("document_frequency", batchDocs)
+                print(str(nDocs) + " documents counted", end="\r")
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    print()
+    return nDocs, df, tf
+
+def writeVocabulary(outputDir, nDocs, df, tf=None, minDf=1, settings=None):
+    terms = sorted(term.encode("utf-8") for term, count in df.items() if count >= minDf)
+    offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(term) for term in terms])
+    decoded = [term.decode("utf-8") for term in terms]
+
+    os.makedirs(outputDir, exist_ok=True)
+    np.save(os.path.join(outputDir, "terms.npy"), np.frombuffer(b"".join(terms), dtype=np.uint8))
+    np.save(os.path.join(outputDir, "term_offsets.npy"), offsets)
+    np.save(os.path.join(outputDir, "df.npy"), np.asarray([df[term] for term in decoded], dtype=np.int64))
+    if tf is not None:
+        np.save(os.path.join(outputDir, "tf.npy"), np.asarray([tf[term] for term in decoded], dtype=np.int64))
+    with open(os.path.join(outputDir, "vocab.json"), "w", encoding="utf-8") as file:
+        json.dump(dict(documents=nDocs, terms=len(terms), min_df=minDf, **(settings or {})), file)
+    return len(terms)
+
+def readVocabulary(outputDir):
+    # Yields (term, df, tf or None) in the order they are stored
+    load = lambda name: np.load(os.path.join(outputDir, name + ".npy"), mmap_mode="r")
+    blob = bytes(load("terms"))
+    offsets = load("term_offsets")
+    df = load("df")
+    tf = load("tf") if os.path.exists(os.path.join(outputDir, "tf.npy")) else None
+    for i in range(len(df)):
+        term = blob[offsets[i]:offsets[i+1]].decode("utf-8")
+        yield term, int(df[i]), int(tf[i]) if tf is not None else None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Counts the document frequency of every token of the DAGW sections")
+    parser.add_argument("--corpus", default="sektioner", help="Directory holding the sections")
+    parser.add_argument("--output", default="documentFrequency", help="Directory the vocabulary is written to")
+    parser.add_argument("--sections", nargs="*", default=None, help="Only count these sections")
+    parser.add_argument("--tokenizer", choices=TOKENIZERS, default="spacy",
+                        help="spacy: tokenizer of a blank Danish pipeline, regex: words and single punctuation characters")
+    parser.add_argument("--lowercase", action="store_true", default=False,
+                        help="Count lowercased tokens, as in the target/aspect pairs")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(), help="Number of worker processes")
+    parser.add_argument("--docs_per_task", type=int, default=256, help="Documents counted by a worker at a time")
+    parser.add_argument("--tf", action="store_true", default=False, help="Also count term frequencies")
+    parser.add_argument("--min_df", type=int, default=1, help="Leave out terms in fewer documents")
+    parser.add_argument("--tsv", default=None, help="Also write the vocabulary as term<TAB>df[<TAB>tf] lines")
+    args = parser.parse_args()
+
+    nDocs, df, tf = countCorpus(args.corpus, args.tokenizer, args.jobs, args.tf, args.sections, args.docs_per_task,
+                                args.lowercase)
+    nTerms = writeVocabulary(args.output, nDocs, df, tf, args.min_df,
+                             settings=dict(tokenizer=args.tokenizer, lowercase=args.lowercase))
+    print(str(nTerms) + " terms in " + str(nDocs) + " documents written to " + args.output)
+
+    if args.tsv is not None:
+        with open(args.tsv, "w", encoding="utf-8") as outputfile:
+            for term, termDf, termTf in readVocabulary(args.output):
+                outputfile.write(term + "\t" + str(termDf) + ("\t" + str(termTf) if termTf is not None else "") + "\n")
@@ -0,0 +1,122 @@
+"""
+Persistent cache of validation outcomes, so unchanged files and metadata records are not checked
+again.
+"""
+import hashlib
+import json
+from pathlib import Path
+import sqlite3
+from typing import Dict, Iterable, Tuple
+
+from validators import TestReport
+
+
+def hash_bytes(data: bytes) -> str:
+    """
+    :param data: bytes to hash
+    :return: hex digest identifying the content
+    """
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def hash_file(file: Path, chunk_size: int = 1 << 20) -> str:
+    """
+    :param file: file to hash
+    :param chunk_size: number of bytes read at a time
+    :return: hex digest identifying the content of the file
+    """
+    h = hashlib.blake2b(digest_size=16)
+    with file.open("rb") as in_file:
+        for chunk in iter(lambda: in_file.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def encode_report(report: TestReport) -> Tuple[int, str]:
+    """
+    :param report: report of a single file or metadata line
+    :return: the report as (passed, JSON list of fail messages)
+    """
+    return int(bool(report.passed)), json.dumps(report.fail_messages)
+
+
+def decode_report(passed: int, fail_messages: str) -> TestReport:
+    """
+    :param passed: stored outcome
+    :param fail_messages: stored JSON list of fail messages
+    :return: the report stored by encode_report
+    """
+    return TestReport(test_name="", passed=bool(passed), fail_messages=json.loads(fail_messages))
+
+
+class ValidationCache:
+    """
+    Models an SQLite sidecar holding, per section:
+     * the outcome of each per-file check together with the file's size, mtime and content hash
+     * the doc_id and outcome of the field checks for each metadata line, keyed by the line's hash
+    """
+
+    def __init__(self, path: Path, section: str):
+        self.section = section
+        self.connection = sqlite3.connect(str(path))
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS files (section TEXT, check_name TEXT, name TEXT, "
+            "size INTEGER, mtime_ns INTEGER, hash TEXT, passed INTEGER, fail_messages TEXT, "
+            "PRIMARY KEY (section, check_name, name))")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS meta_lines (section TEXT, hash TEXT, year INTEGER, "
+            "doc_id TEXT, passed INTEGER, fail_messages TEXT, PRIMARY KEY (section, hash))")
+
+    def get_files(self, check_name: str) -> Dict[str, Tuple[int, int, str, TestReport]]:
+        """
+        :param check_name: name of the per-file check
+        :return: file name mapped to its cached (size, mtime_ns, hash, report)
+        """
+        rows = self.connection.execute(
+            "SELECT name, size, mtime_ns, hash, passed, fail_messages FROM files "
+            "WHERE section = ? AND check_name = ?", (self.section, check_name))
+        return {name: (size, mtime_ns, h, decode_report(passed, msgs))
+                for name, size, mtime_ns, h, passed, msgs in rows}
+
+    def put_files(self, check_name: str,
+                  files: Iterable[Tuple[str, int, int, str, TestReport]]) -> None:
+        """
+        Replaces the cached per-file outcomes of a check
+        :param check_name: name of the per-file check
+        :param files: (name, size, mtime_ns, hash, report) of every file in the section
+        """
+        self.connection.execute("DELETE FROM files WHERE section = ? AND check_name = ?",
+                                (self.section, check_name))
+        self.connection.executemany(
+            "INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            ((self.section, check_name, name, size, mtime_ns, h) + encode_report(report)
+             for name, size, mtime_ns, h, report in files))
+        self.connection.commit()
+
+    def get_meta_lines(self, year: int) -> Dict[str, Tuple[str, TestReport]]:
+        """
+        :param year: current year, outcomes computed in another year are not used
+        :return: line hash mapped to the cached (doc_id, report)
+        """
+        rows = self.connection.execute(
+            "SELECT hash, doc_id, passed, fail_messages FROM meta_lines "
+            "WHERE section = ? AND year = ?", (self.section, year))
+        return {h: (doc_id, decode_report(passed, msgs)) for h, doc_id, passed, msgs in rows}
+
+    def put_meta_lines(self, year: int,
+                       lines: Iterable[Tuple[str, str, TestReport]]) -> None:
+        """
+        Replaces the cached metadata outcomes
+        :param year: year the outcomes were computed in
+        :param lines: (hash, doc_id, report) of every metadata line
+        """
+        self.connection.execute("DELETE FROM meta_lines WHERE section = ?", (self.section,))
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO meta_lines VALUES (?, ?, ?, ?, ?, ?)",
+            ((self.section, h, year, doc_id) + encode_report(report)
+             for h, doc_id, report in lines))
+        self.connection.commit()
+
+    def close(self) -> None:
+        self.connection.close()
+
@@ -0,0 +1,206 @@
+"""
+Runs the validators over a section in a single pass.
+"""
+from dataclasses import dataclass
+import datetime
+import json
+import logging
+from multiprocessing import Pool
+from pathlib import Path
+import sys
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from cache import ValidationCache, hash_bytes, hash_file
+from validators import Meta, SectionContext, TestReport, check_all_files_in_metadata, \
+    check_auxiliary_files, check_correct_prefix, check_file_utf8, check_file_utf8_strict, \
+    check_metadata_fields, check_metadata_record
+
+# stageMetrics.py, the metrics hook shared by the stages, is in the repository root
+sys.path.append(str(Path(__file__).resolve().parents[4]))
+import stageMetrics
+
+
+section_tests = [check_correct_prefix, check_auxiliary_files,
+                 check_all_files_in_metadata, check_metadata_fields]
+
+# "strict" decodes every file completely, "chardet" guesses the encoding from the first lines
+encoding_checks = {"strict": check_file_utf8_strict, "chardet": check_file_utf8}
+
+
+@dataclass
+class TimedReport:
+    """
+    Models a test report together with the time it took to produce it.
+    """
+    report: TestReport
+    seconds: float
+
+
+def run_file_check(pool: Pool, check: Callable[[Path], TestReport], files: Iterable[Path],
+                   report: TestReport, chunk_size: int = 64) -> TestReport:
+    """
+    Runs a per-file check over all files, in the pool if one is given
+    :param pool: process pool, or None to run in this process
+    :param check: per-file check
+    :param files: files to check
+    :param report: report the per-file reports are added to
+    :param chunk_size: number of files sent to a worker at a time
+    :return: the combined report
+    """
+    results = pool.imap_unordered(check, files, chunk_size) if pool is not None else map(check, files)
+    for file_report in results:
+        report += file_report
+    return report
+
+
+def check_file_cached(args: Tuple[Path, str, Optional[str]]) -> Tuple[str, str, TestReport]:
+    """
+    Runs a per-file check on a file whose size or mtime changed, unless its content hash is still
+    the cached one
+    :param args: the file, the name of the check and the cached hash of the file, if any
+    :return: (name, hash, report), where report is None if the cached outcome is still valid
+    """
+    file, check_name, cached_hash = args
+    h = hash_file(file)
+    if h == cached_hash:
+        return file.name, h, None
+    return file.name, h, encoding_checks[check_name](file)
+
+
+def run_file_check_cached(pool: Pool, check_name: str, files: Iterable[Path], report: TestReport,
+                          cache: ValidationCache, chunk_size: int = 64) -> TestReport:
+    """
+    Runs a per-file check over the files that changed since the cached run
+    :param pool: process pool, or None to run in this process
+    :param check_name: name of the check in encoding_checks
+    :param files: files to check
+    :param report: report the per-file reports are added to
+    :param cache: cache of earlier outcomes, updated with the new ones
+    :param chunk_size: number of files sent to a worker at a time
+    :return: the combined report
+    """
+    cached = cache.get_files(check_name)
+    entries = []
+    stats: Dict[str, Tuple[int, int]] = {}
+    changed = []
+    for file in files:
+        st = file.stat()
+        c = cached.get(file.name)
+        if c is not None and c[0] == st.st_size and c[1] == st.st_mtime_ns:
+            entries.append((file.name, st.st_size, st.st_mtime_ns, c[2], c[3]))
+        else:
+            stats[file.name] = (st.st_size, st.st_mtime_ns)
+            changed.append((file, check_name, c[2] if c is not None else None))
+
+    results = pool.imap_unordered(check_file_cached, changed, chunk_size) if pool is not None \
+        else map(check_file_cached, changed)
+    n_checked = 0
+    for name, h, file_report in results:
+        if file_report is None:
+            file_report = cached[name][3]
+        else:
+            n_checked += 1
+        entries.append((name,) + stats[name] + (h, file_report))
+    logging.info(f"Checked {n_checked} of {len(entries)} files, the rest were unchanged")
+
+    for entry in entries:
+        report += entry[4]
+    cache.put_files(check_name, entries)
+    return report
+
+
+def check_metadata_fields_cached(p: Path, context: SectionContext,
+                                 cache: ValidationCache) -> TestReport:
+    """
+    Checks the fields of the metadata lines that changed since the cached run and sets the
+    doc_ids of the context, so unchanged lines are not parsed at all
+    :param p: path to check
+    :param context: shared listing of the section
+    :param cache: cache of earlier outcomes, updated with the new ones
+    :return: a test report
+    """
+    current_year: int = int(datetime.datetime.now().strftime("%Y"))
+    t = TestReport(test_name="Fields in metadata")
+    meta_file = context.meta_file
+    if meta_file.name not in context.entries:
+        t.passed = False
+        t.fail_messages.append(f"Could not find metadata file {str(meta_file)}")
+        return t
+
+    cached = cache.get_meta_lines(current_year)
+    lines = []
+    doc_ids = []
+    n_checked = 0
+    with meta_file.open("rb") as in_meta:
+        for line in in_meta:
+            h = hash_bytes(line.rstrip(b"\r\n"))
+            if h in cached:
+                doc_id, report = cached[h]
+            else:
+                current_meta = json.loads(line)
+                doc_id = current_meta[Meta.Field.DOC_ID]
+                report = check_metadata_record(current_meta, current_year)
+                n_checked += 1
+            t += report
+            doc_ids.append(doc_id)
+            lines.append((h, doc_id, report))
+    logging.info(f"Checked {n_checked} of {len(lines)} metadata lines, the rest were unchanged")
+
+    context.doc_ids = doc_ids
+    cache.put_meta_lines(current_year, lines)
+    return t
+
+
+def validate_section(p: Path, enc_check: Optional[str] = "strict", jobs: int = 1,
+                     cache: Optional[ValidationCache] = None) -> List[TimedReport]:
+    """
+    Lists the section and parses its metadata once, runs the section-level checks on that shared
+    context and the per-file checks across a process pool.
+    :param p: path to the section
+    :param enc_check: name of the encoding check in encoding_checks, or None to skip it
+    :param jobs: number of worker processes for the per-file checks
+    :param cache: if given, only files and metadata lines that changed since the cached run are
+    checked
+    :return: the test reports with their running times
+    """
+    with stageMetrics.measure("section_validation"):
+        results: List[TimedReport] = []
+
+        start = time.perf_counter()
+        context = SectionContext(p)
+        stageMetrics.add("section_validation", len(context.files))
+        logging.info(f"Listed {len(context.entries)} entries in {time.perf_counter() - start:.2f}s")
+
+        # The manifest check needs the doc_ids, which the cached field check provides without
+        # parsing unchanged lines, so it runs first
+        if cache is not None:
+            start = time.perf_counter()
+            metadata_report = TimedReport(check_metadata_fields_cached(p, context, cache),
+                                          time.perf_counter() - start)
+
+        for func in section_tests:
+            if func is check_metadata_fields and cache is not None:
+                results.append(metadata_report)
+                continue
+            start = time.perf_counter()
+            report = func(p, context)
+            results.append(TimedReport(report, time.perf_counter() - start))
+
+        if enc_check is not None:
+            pool = Pool(jobs) if jobs > 1 else None
+            try:
+                start = time.perf_counter()
+                if cache is not None:
+                    report = run_file_check_cached(pool, enc_check, context.files,
+                                                   TestReport(test_name="UTF-8 encoding"), cache)
+                else:
+                    report = run_file_check(pool, encoding_checks[enc_check], context.files,
+                                            TestReport(test_name="UTF-8 encoding"))
+                results.append(TimedReport(report, time.perf_counter() - start))
+            finally:
+                if pool is not None:
+                    pool.close()
+                    pool.join()
+
+    return results
@@ -1,10 +1,13 @@
 import argparse
 import logging
+import os
 from pathlib import Path
 import sys
 from typing import List
 
-from validators import TestReport, check_utf8_encoding, tests
+from cache import ValidationCache
+from engine import TimedReport, validate_section
+from validators import TestReport
 
 
 class ParserWithUsage(argparse.ArgumentParser):
@@ -24,13 +27,22 @@ def main():
     parser.description = "Validates a specific section of DKGW"
     parser.add_argument("input",
                         help="Path to directory containing the section")
-    parser.add_argument("--check_enc", action="store_true", default=False,
-                        help="Check that files are UTF-8 encoded (slow).")
+    parser.add_argument("--enc_check", choices=["strict", "chardet", "none"], default="strict",
+                        help="How to check that files are UTF-8 encoded: decode every file "
+                             "completely (strict), guess from the first lines (chardet, slow) or "
+                             "not at all (none).")
+    parser.add_argument("--check_enc", action="store_const", dest="enc_check", const="chardet",
+                        help="Same as --enc_check chardet.")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(),
+                        help="Number of processes used for the per-file checks.")
+    parser.add_argument("--cache", type=Path, default=None,
+                        help="SQLite file that keeps the outcomes between runs, so that only "
+                             "changed files and metadata lines are checked again.")
 
     args = parser.parse_args()
     logging.info("STARTED")
     path: Path = Path(args.input)
-    check_enc = args.check_enc
+    enc_check = args.enc_check if args.enc_check != "none" else None
     logging.info("Validating section " + path.name)
     raw_data = path / "raw_data"
     metadata_file = path / f"{path.name}.jsonl"
@@ -39,12 +51,16 @@ def main():
             "The section appears to have a \"raw_data\" directory whose content has not been "
             "expanded. Stopping validation until the section is expanded.")
     else:
-        validators = tests
-        if not check_enc:
+        if enc_check is None:
             logging.info("Skipping encoding validation")
-            validators.remove(check_utf8_encoding)
 
-        results: List[TestReport] = [func(path) for func in tests]
+        cache = ValidationCache(args.cache, str(path.resolve())) if args.cache else None
+        timed_results: List[TimedReport] = validate_section(path, enc_check, args.jobs, cache)
+        if cache is not None:
+            cache.close()
+        for r in timed_results:
+            logging.info(f"{r.report.test_name} took {r.seconds:.2f}s")
+        results: List[TestReport] = [r.report for r in timed_results]
 
         tests_passed: List[TestReport] = [t for t in results if t.passed is True]
         tests_failed: List[TestReport] = [t for t in results if t.passed is False]
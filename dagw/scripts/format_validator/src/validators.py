@@ -1,12 +1,15 @@
 """
 Contains validators for the DAGW format.
 """
+import codecs
 from dataclasses import dataclass, field
 import datetime
 import json
+import mmap
+import os
 from pathlib import Path
 import re
-from typing import List, Set, Tuple
+from typing import Dict, List, Optional, Set, Tuple
 
 
 class Meta:
@@ -51,20 +54,70 @@ class TestReport:
         return self
 
 
-def check_correct_prefix(p: Path) -> TestReport:
+class SectionContext:
+    """
+    Models a section whose directory has been listed once and whose metadata is parsed at most
+    once, so that several checks can share them.
+    """
+
+    def __init__(self, p: Path):
+        self.path: Path = p
+        self.namespace: str = p.name
+        self.meta_file: Path = p / f"{self.namespace}.jsonl"
+        # Name of every directory entry, mapped to whether it is a regular file
+        self.entries: Dict[str, bool] = {}
+        with os.scandir(p) as it:
+            for entry in it:
+                self.entries[entry.name] = entry.is_file()
+        self._metadata: Optional[List[dict]] = None
+        self._doc_ids: Optional[List[str]] = None
+
+    @property
+    def files(self) -> List[Path]:
+        """
+        :return: paths of all regular files in the section
+        """
+        return [self.path / name for name, is_file in self.entries.items() if is_file]
+
+    @property
+    def metadata(self) -> List[dict]:
+        """
+        :return: the parsed metadata records, in file order
+        """
+        if self._metadata is None:
+            with self.meta_file.open(mode="r") as in_meta:
+                self._metadata = [json.loads(line) for line in in_meta]
+        return self._metadata
+
+    @property
+    def doc_ids(self) -> List[str]:
+        """
+        :return: the doc_id of every metadata record, in file order
+        """
+        if self._doc_ids is None:
+            self._doc_ids = [current_meta[Meta.Field.DOC_ID] for current_meta in self.metadata]
+        return self._doc_ids
+
+    @doc_ids.setter
+    def doc_ids(self, doc_ids: List[str]):
+        self._doc_ids = doc_ids
+
+
+def check_correct_prefix(p: Path, context: Optional[SectionContext] = None) -> TestReport:
     """
     Checks that all non-auxiliary files' names start with the namespace
     :param p: path to check
+    :param context: shared listing of the section, created if not given
     :return: a test report
     """
+    context = context or SectionContext(p)
     namespace = p.name
     t = TestReport(test_name="Content files prefix")
     auxiliary_files, _ = get_auxiliary_files(namespace)
-    for child in p.iterdir():
-        if child.name not in auxiliary_files and child.is_file() and not child.name.startswith(
-                namespace):
+    for name, is_file in context.entries.items():
+        if name not in auxiliary_files and is_file and not name.startswith(namespace):
             t.passed = False
-            msg = f"The name of file {child} should start with the namespace {namespace}"
+            msg = f"The name of file {p / name} should start with the namespace {namespace}"
             t.fail_messages.append(msg)
     return t
 
@@ -80,18 +133,19 @@ def get_auxiliary_files(namespace: str) -> Tuple[List[str], List[bool]]:
     return auxiliary_files, required_flag
 
 
-def check_auxiliary_files(p: Path) -> TestReport:
+def check_auxiliary_files(p: Path, context: Optional[SectionContext] = None) -> TestReport:
     """
     Checks that all required auxiliary files exist.
     :param p: path to check
+    :param context: shared listing of the section, created if not given
     :return: test report
     """
+    context = context or SectionContext(p)
     namespace = p.name
     t = TestReport(test_name="Auxiliary files")
     auxiliary_files, req_info = get_auxiliary_files(namespace)
     for f, r in zip(auxiliary_files, req_info):
-        meta_path = p / f
-        if not meta_path.exists() and r:
+        if f not in context.entries and r:
             t.passed = False
             msg = f"File {f} does not exist"
             t.fail_messages.append(msg)
@@ -113,25 +167,22 @@ def check_set(file_set, error_msg) -> TestReport:
     return t
 
 
-def check_all_files_in_metadata(p: Path) -> TestReport:
+def check_all_files_in_metadata(p: Path, context: Optional[SectionContext] = None) -> TestReport:
     """
     Checks that all the files in the metadata exist.
     :param p: path to check
+    :param context: shared listing and metadata of the section, created if not given
     :return: test report
     """
-    namespace = p.name
+    context = context or SectionContext(p)
     t = TestReport(test_name="Test files manifest")
     expected_doc_ids: Set[str] = set()
-    actual_doc_ids: Set[str] = {c.name for c in p.iterdir()}
+    actual_doc_ids: Set[str] = set(context.entries)
     auxiliary_files, _ = get_auxiliary_files(p.name)
     auxiliary_files = set(auxiliary_files)
-    meta_file = p / f"{namespace}.jsonl"
-    if meta_file.exists():
-        with meta_file.open(mode="r") as in_meta:
-            for line in in_meta:
-                current_meta = json.loads(line)
-                doc_id = current_meta[Meta.Field.DOC_ID]
-                expected_doc_ids.add(doc_id)
+    meta_file = context.meta_file
+    if meta_file.name in context.entries:
+        expected_doc_ids.update(context.doc_ids)
 
         undeclared = actual_doc_ids - expected_doc_ids - auxiliary_files
         nonexistent = expected_doc_ids - actual_doc_ids
@@ -187,77 +238,145 @@ def check_datetime(s: str) -> TestReport:
     return t
 
 
-def check_metadata_fields(p: Path) -> TestReport:
+def check_metadata_record(current_meta: dict, current_year: int) -> TestReport:
+    """
+    Checks every field of a single metadata record
+    :param current_meta: the parsed metadata record
+    :param current_year: years after this one are in the future
+    :return: a test report
+    """
+    t = TestReport(test_name="")
+    doc_id = current_meta[Meta.Field.DOC_ID]
+    keys = set(current_meta.keys())
+    missing_required = Meta.REQUIRED_FIELDS - keys
+    required_msg = "Metadata missing field {{}} for doc_id = {d}"
+    t += check_set(missing_required, required_msg.format(d=doc_id))
+
+    illegal_fields = keys - Meta.ALL_FIELDS
+    illegal_msg = "Metadata contains undocumented field {{}} for doc_id = {d}"
+    t += check_set(illegal_fields, illegal_msg.format(d=doc_id))
+
+    # Check year published
+    year_published = current_meta.get(Meta.Field.YEAR_PUBLISHED,
+                                      None)
+    if year_published is not None:
+        year_published = int(year_published)
+        if year_published > current_year:
+            t.passed = False
+            t.fail_messages.append(
+                f"{Meta.Field.YEAR_PUBLISHED}: {year_published} is in the future!")
+
+    # Check all dates for correct content
+    date_built = current_meta.get(Meta.Field.DATE_BUILT, None)
+    t += check_datetime(date_built)
+
+    date_collected = current_meta.get(Meta.Field.DATE_COLLECTED,
+                                      None)
+    t += check_datetime(date_collected)
+
+    date_published = current_meta.get(Meta.Field.DATE_PUBLISHED,
+                                      None)
+    t += check_datetime(date_published)
+    return t
+
+
+def check_metadata_fields(p: Path, context: Optional[SectionContext] = None) -> TestReport:
     """
     Checks every field in metadata
     :param p: path to check
+    :param context: shared listing and metadata of the section, created if not given
     :return: a test report
     """
+    context = context or SectionContext(p)
     current_year: int = int(datetime.datetime.now().strftime("%Y"))
-    namespace = p.name
     t = TestReport(test_name="Fields in metadata")
-    meta_file = p / f"{namespace}.jsonl"
-    if meta_file.exists():
-        with meta_file.open("r") as in_meta:
-            for line in in_meta:
-                current_meta = json.loads(line)
-                doc_id = current_meta[Meta.Field.DOC_ID]
-                keys = set(current_meta.keys())
-                missing_required = Meta.REQUIRED_FIELDS - keys
-                required_msg = "Metadata missing field {{}} for doc_id = {d}"
-                t += check_set(missing_required, required_msg.format(d=doc_id))
-
-                illegal_fields = keys - Meta.ALL_FIELDS
-                illegal_msg = "Metadata contains undocumented field {{}} for doc_id = {d}"
-                t += check_set(illegal_fields, illegal_msg.format(d=doc_id))
-
-                # Check year published
-                year_published = current_meta.get(Meta.Field.YEAR_PUBLISHED,
-                                                  None)
-                if year_published is not None:
-                    year_published = int(year_published)
-                    if year_published > current_year:
-                        t.passed = False
-                        t.fail_messages.append(
-                            f"{Meta.Field.YEAR_PUBLISHED}: {year_published} is in the future!")
-
-                # Check all dates for correct content
-                date_built = current_meta.get(Meta.Field.DATE_BUILT, None)
-                t += check_datetime(date_built)
-
-                date_collected = current_meta.get(Meta.Field.DATE_COLLECTED,
-                                                  None)
-                t += check_datetime(date_collected)
-
-                date_published = current_meta.get(Meta.Field.DATE_PUBLISHED,
-                                                  None)
-                t += check_datetime(date_published)
+    meta_file = context.meta_file
+    if meta_file.name in context.entries:
+        for current_meta in context.metadata:
+            t += check_metadata_record(current_meta, current_year)
     else:
         t.passed = False
         t.fail_messages.append(f"Could not find metadata file {str(meta_file)}")
     return t
 
 
-def check_utf8_encoding(path: Path) -> TestReport:
-    t = TestReport(test_name="UTF-8 encoding")
+def check_file_utf8(file: Path) -> TestReport:
+    """
+    Guesses the encoding of a single file from its first lines
+    :param file: file to check
+    :return: a test report
+    """
+    t = TestReport(test_name="")
     from chardet.universaldetector import UniversalDetector
     err_msg = "File {} is not UTF-8 encoded, but {} (confidence: {:.2f})"
     accepted_encs = {"ascii", "utf-8"}
     detector = UniversalDetector()
     max_lines = 50
-    for file in path.iterdir():
-        detector.reset()
-        for idx, line in enumerate(file.open("rb")):
+    with file.open("rb") as in_file:
+        for idx, line in enumerate(in_file):
             detector.feed(line)
             if detector.done or idx > max_lines:
                 break
-        detector.close()
-        actual_enc = detector.result["encoding"]
-        if actual_enc not in accepted_encs:
-            conf = detector.result["confidence"]
-            t.passed = False
-            name = file.name
-            t.fail_messages.append(err_msg.format(name, actual_enc, conf))
+    detector.close()
+    actual_enc = detector.result["encoding"]
+    if actual_enc not in accepted_encs:
+        conf = detector.result["confidence"]
+        t.passed = False
+        t.fail_messages.append(err_msg.format(file.name, actual_enc, conf))
+    return t
+
+
+def find_invalid_utf8(file: Path, chunk_size: int = 1 << 24) -> Optional[int]:
+    """
+    Decodes a whole file as UTF-8 in chunks of its memory-mapped bytes
+    :param file: file to check
+    :param chunk_size: number of bytes decoded at a time
+    :return: byte offset of the first invalid sequence, or None if the file is valid UTF-8
+    """
+    size = file.stat().st_size
+    if size == 0:
+        return None
+    with file.open("rb") as in_file, mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        # Bytes of a sequence that was split by the chunk boundary are carried over
+        pending = b""
+        for start in range(0, size, chunk_size):
+            chunk = pending + data[start:start + chunk_size]
+            final = start + chunk_size >= size
+            try:
+                _, consumed = codecs.utf_8_decode(chunk, "strict", final)
+            except UnicodeDecodeError as e:
+                return start - len(pending) + e.start
+            pending = chunk[consumed:]
+    return None
+
+
+def check_file_utf8_strict(file: Path) -> TestReport:
+    """
+    Checks that a whole file is valid UTF-8. The encoding is only guessed for files that fail.
+    :param file: file to check
+    :return: a test report
+    """
+    t = TestReport(test_name="")
+    offset = find_invalid_utf8(file)
+    if offset is not None:
+        t.passed = False
+        t.fail_messages.append(f"File {file.name} is not UTF-8 encoded, invalid byte sequence at "
+                               f"offset {offset}")
+        t += check_file_utf8(file)
+    return t
+
+
+def check_utf8_encoding(path: Path, context: Optional[SectionContext] = None) -> TestReport:
+    """
+    Checks that all files in the section are UTF-8 encoded
+    :param path: path to check
+    :param context: shared listing of the section, created if not given
+    :return: a test report
+    """
+    context = context or SectionContext(path)
+    t = TestReport(test_name="UTF-8 encoding")
+    for file in context.files:
+        t += check_file_utf8(file)
     return t
 
 
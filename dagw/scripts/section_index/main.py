@@ -0,0 +1,83 @@
+"""
+Builds, packs and queries doc_id indexes of DAGW sections.
+"""
+import argparse
+import json
+import logging
+from pathlib import Path
+import sys
+import time
+
+from section_index import SectionIndex, build_index, default_index_dir, pack_section
+
+
+class ParserWithUsage(argparse.ArgumentParser):
+    """ A custom parser that writes error messages followed by command line usage documentation."""
+
+    def error(self, message) -> None:
+        """
+        Prints error message and help.
+        :param message: error message to print
+        """
+        sys.stderr.write('error: %s\n' % message)
+        self.print_help()
+        sys.exit(2)
+
+
+def main():
+    """
+    Main method
+    """
+    logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s', level=logging.INFO,
+                        datefmt='%m/%d/%Y %H:%M:%S')
+    parser = ParserWithUsage()
+    parser.description = "Builds, packs and queries doc_id indexes of DAGW sections"
+    parser.add_argument("command", choices=["build", "pack", "get", "meta", "sample"],
+                        help="build: index the metadata and document sizes, pack: also concatenate "
+                             "the documents into one blob, get/meta: print the document or metadata "
+                             "of the given doc_ids, sample: print random doc_ids")
+    parser.add_argument("sections", nargs="+", type=Path, help="Section directories")
+    parser.add_argument("--index_dir", type=Path, default=None,
+                        help="Index directory, <section>.index next to the section by default; "
+                             "only with a single section")
+    parser.add_argument("--doc_ids", nargs="*", default=[], help="doc_ids for get and meta")
+    parser.add_argument("-k", type=int, default=10, help="Number of doc_ids for sample")
+    parser.add_argument("--seed", type=int, default=None, help="Seed for sample")
+
+    args = parser.parse_args()
+    if args.index_dir is not None and len(args.sections) > 1:
+        parser.error("--index_dir can only be given for a single section")
+
+    for section_dir in args.sections:
+        index_dir = args.index_dir or default_index_dir(section_dir)
+        if args.command in ("build", "pack"):
+            start = time.perf_counter()
+            index_dir = build_index(section_dir, index_dir) if args.command == "build" \
+                else pack_section(section_dir, index_dir)
+            index = SectionIndex(index_dir)
+            logging.info(f"Indexed {len(index)} documents of {section_dir.name} in "
+                         f"{time.perf_counter() - start:.2f}s")
+            index.close()
+            continue
+
+        index = SectionIndex(index_dir)
+        if index.is_stale():
+            logging.warning(f"The metadata of {section_dir.name} changed since it was indexed")
+        if args.command == "sample":
+            for doc_id in index.sample(args.k, args.seed):
+                print(doc_id)
+        for doc_id in args.doc_ids:
+            if args.command == "meta":
+                meta = index.metadata(doc_id)
+                if meta is not None:
+                    print(json.dumps(meta))
+            elif args.command == "get":
+                content = index.document(doc_id)
+                if content is not None:
+                    sys.stdout.buffer.write(content)
+                    content.release()
+        index.close()
+
+
+if __name__ == "__main__":
+    main()
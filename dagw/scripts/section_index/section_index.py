@@ -0,0 +1,331 @@
+"""
+Random access by doc_id to the documents and metadata of DAGW sections.
+
+An index of a section is a directory of NumPy arrays, kept outside the section so the section
+itself is not changed:
+ * doc_ids.npy, doc_id_offsets.npy: the doc_ids of the metadata, in file order, as a UTF-8 blob
+ * meta_offsets.npy, meta_lengths.npy: byte range of every metadata line
+ * doc_sizes.npy: size of every document, -1 if the file does not exist
+ * hash_slots.npy: open addressing hash table from doc_id to row, for O(1) lookups
+ * index.json: the section, its size in documents and the state of the metadata file
+Packing a section adds blob.bin, all documents concatenated in metadata order, and
+doc_offsets.npy, so documents can be read and iterated as zero-copy slices of one memory map.
+"""
+import hashlib
+import json
+import mmap
+import os
+from pathlib import Path
+import random
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+DOC_ID = "doc_id"
+EMPTY_SLOT = -1
+
+
+def hash_doc_id(doc_id: bytes) -> int:
+    """
+    :param doc_id: UTF-8 encoded doc_id
+    :return: 63 bit hash of the doc_id
+    """
+    return int.from_bytes(hashlib.blake2b(doc_id, digest_size=8).digest(), "little") >> 1
+
+
+def default_index_dir(section_dir: Path) -> Path:
+    """
+    :param section_dir: section directory
+    :return: the index directory next to the section
+    """
+    return section_dir.with_name(section_dir.name + ".index")
+
+
+def metadata_state(meta_file: Path) -> Dict[str, int]:
+    """
+    :param meta_file: metadata file of a section
+    :return: size and mtime of the file, to tell whether an index is stale
+    """
+    st = meta_file.stat()
+    return {"meta_size": st.st_size, "meta_mtime_ns": st.st_mtime_ns}
+
+
+def build_hash_table(encoded: List[bytes]) -> np.ndarray:
+    """
+    Builds a linear probing table with at least twice as many slots as keys
+    :param encoded: UTF-8 encoded doc_ids
+    :return: slot -> row, EMPTY_SLOT for empty slots
+    """
+    n_slots = 1 << max(1, (2 * len(encoded) - 1).bit_length())
+    mask = n_slots - 1
+    slots = np.full(n_slots, EMPTY_SLOT, dtype=np.int64)
+    for row, doc_id in enumerate(encoded):
+        slot = hash_doc_id(doc_id) & mask
+        while slots[slot] != EMPTY_SLOT:
+            slot = (slot + 1) & mask
+        slots[slot] = row
+    return slots
+
+
+def build_index(section_dir: Path, index_dir: Optional[Path] = None) -> Path:
+    """
+    Indexes the metadata lines and document sizes of a section in one pass over the metadata file
+    and one listing of the section directory
+    :param section_dir: section directory
+    :param index_dir: index directory, next to the section if not given
+    :return: the index directory
+    """
+    index_dir = index_dir or default_index_dir(section_dir)
+    namespace = section_dir.name
+    meta_file = section_dir / f"{namespace}.jsonl"
+
+    sizes: Dict[str, int] = {}
+    with os.scandir(section_dir) as it:
+        for entry in it:
+            if entry.is_file():
+                sizes[entry.name] = entry.stat().st_size
+
+    encoded: List[bytes] = []
+    meta_offsets: List[int] = []
+    meta_lengths: List[int] = []
+    offset = 0
+    with meta_file.open("rb") as in_meta:
+        for line in in_meta:
+            if line.strip():
+                encoded.append(json.loads(line)[DOC_ID].encode("utf8"))
+                meta_offsets.append(offset)
+                meta_lengths.append(len(line))
+            offset += len(line)
+
+    index_dir.mkdir(parents=True, exist_ok=True)
+    doc_id_offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    doc_id_offsets[1:] = np.cumsum([len(doc_id) for doc_id in encoded])
+    np.save(index_dir / "doc_ids.npy", np.frombuffer(b"".join(encoded), dtype=np.uint8))
+    np.save(index_dir / "doc_id_offsets.npy", doc_id_offsets)
+    np.save(index_dir / "meta_offsets.npy", np.asarray(meta_offsets, dtype=np.int64))
+    np.save(index_dir / "meta_lengths.npy", np.asarray(meta_lengths, dtype=np.int64))
+    np.save(index_dir / "doc_sizes.npy",
+            np.asarray([sizes.get(doc_id.decode("utf8"), -1) for doc_id in encoded], dtype=np.int64))
+    np.save(index_dir / "hash_slots.npy", build_hash_table(encoded))
+    with (index_dir / "index.json").open("w", encoding="utf8") as out_file:
+        json.dump(dict(section=str(section_dir.resolve()), documents=len(encoded), packed=False,
+                       **metadata_state(meta_file)), out_file)
+    return index_dir
+
+
+def pack_section(section_dir: Path, index_dir: Optional[Path] = None) -> Path:
+    """
+    Concatenates the documents of an indexed section into blob.bin, in metadata order; documents
+    without a file are empty
+    :param section_dir: section directory
+    :param index_dir: index directory, next to the section if not given
+    :return: the index directory
+    """
+    # The offset table has to match the current metadata, so the index is built again
+    index_dir = build_index(section_dir, index_dir)
+    index = SectionIndex(index_dir)
+    offsets = np.zeros(len(index) + 1, dtype=np.int64)
+    tmp_blob = index_dir / "blob.bin.tmp"
+    with tmp_blob.open("wb") as out_blob:
+        for row in range(len(index)):
+            path = section_dir / index.doc_id(row)
+            if path.exists():
+                with path.open("rb") as in_doc:
+                    data = in_doc.read()
+                out_blob.write(data)
+                offsets[row + 1] = offsets[row] + len(data)
+            else:
+                offsets[row + 1] = offsets[row]
+    os.replace(tmp_blob, index_dir / "blob.bin")
+    np.save(index_dir / "doc_offsets.npy", offsets)
+    index.settings["packed"] = True
+    with (index_dir / "index.json").open("w", encoding="utf8") as out_file:
+        json.dump(index.settings, out_file)
+    index.close()
+    return index_dir
+
+
+class SectionIndex:
+    """
+    Models a memory-mapped index of a section, see build_index and pack_section.
+    """
+
+    def __init__(self, index_dir: Path):
+        self.index_dir = index_dir
+        with (index_dir / "index.json").open("r", encoding="utf8") as in_file:
+            self.settings: dict = json.load(in_file)
+        self.section_dir = Path(self.settings["section"])
+        self.meta_file = self.section_dir / f"{self.section_dir.name}.jsonl"
+
+        def load(name: str) -> np.ndarray:
+            return np.load(index_dir / f"{name}.npy", mmap_mode="r")
+        self.doc_id_blob = load("doc_ids")
+        self.doc_id_offsets = load("doc_id_offsets")
+        self.meta_offsets = load("meta_offsets")
+        self.meta_lengths = load("meta_lengths")
+        self.doc_sizes = load("doc_sizes")
+        self.hash_slots = load("hash_slots")
+        self._meta_map: Optional[mmap.mmap] = None
+        self._blob_map: Optional[mmap.mmap] = None
+        self.doc_offsets = load("doc_offsets") if self.settings["packed"] else None
+
+    def __len__(self) -> int:
+        return len(self.meta_offsets)
+
+    @property
+    def packed(self) -> bool:
+        return bool(self.settings["packed"])
+
+    def is_stale(self) -> bool:
+        """
+        :return: whether the metadata file changed since the index was built
+        """
+        state = metadata_state(self.meta_file)
+        return any(self.settings[key] != value for key, value in state.items())
+
+    def doc_id(self, row: int) -> str:
+        start, end = self.doc_id_offsets[row], self.doc_id_offsets[row + 1]
+        return bytes(self.doc_id_blob[start:end]).decode("utf8")
+
+    def row(self, doc_id: str) -> Optional[int]:
+        """
+        :param doc_id: doc_id to look up
+        :return: the row of the doc_id, in metadata order, or None if it is not in the section
+        """
+        encoded = doc_id.encode("utf8")
+        mask = len(self.hash_slots) - 1
+        slot = hash_doc_id(encoded) & mask
+        while True:
+            row = int(self.hash_slots[slot])
+            if row == EMPTY_SLOT:
+                return None
+            start, end = self.doc_id_offsets[row], self.doc_id_offsets[row + 1]
+            if bytes(self.doc_id_blob[start:end]) == encoded:
+                return row
+            slot = (slot + 1) & mask
+
+    def __contains__(self, doc_id: str) -> bool:
+        return self.row(doc_id) is not None
+
+    def _meta(self) -> mmap.mmap:
+        if self._meta_map is None:
+            with self.meta_file.open("rb") as in_meta:
+                self._meta_map = mmap.mmap(in_meta.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._meta_map
+
+    def _blob(self) -> mmap.mmap:
+        if self._blob_map is None:
+            with (self.index_dir / "blob.bin").open("rb") as in_blob:
+                # mmap cannot map an empty file
+                if os.fstat(in_blob.fileno()).st_size == 0:
+                    self._blob_map = mmap.mmap(-1, 1)
+                else:
+                    self._blob_map = mmap.mmap(in_blob.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._blob_map
+
+    def metadata_bytes(self, row: int) -> memoryview:
+        start = int(self.meta_offsets[row])
+        return memoryview(self._meta())[start:start + int(self.meta_lengths[row])]
+
+    def metadata(self, doc_id: str) -> Optional[dict]:
+        """
+        :param doc_id: doc_id to look up
+        :return: the parsed metadata record, or None if the doc_id is not in the section
+        """
+        row = self.row(doc_id)
+        return None if row is None else json.loads(bytes(self.metadata_bytes(row)))
+
+    def document_path(self, doc_id: str) -> Path:
+        return self.section_dir / doc_id
+
+    def document_size(self, doc_id: str) -> Optional[int]:
+        """
+        :return: size of the document in bytes, -1 if it has no file, None if the doc_id is not in
+        the section
+        """
+        row = self.row(doc_id)
+        return None if row is None else int(self.doc_sizes[row])
+
+    def document_bytes(self, row: int) -> memoryview:
+        """
+        :param row: row of the document
+        :return: the content of the document, a zero-copy slice of the blob if the section is packed
+        """
+        if self.packed:
+            start, end = int(self.doc_offsets[row]), int(self.doc_offsets[row + 1])
+            return memoryview(self._blob())[start:end]
+        path = self.section_dir / self.doc_id(row)
+        return memoryview(path.read_bytes() if path.exists() else b"")
+
+    def document(self, doc_id: str) -> Optional[memoryview]:
+        """
+        :param doc_id: doc_id to look up
+        :return: the content of the document, or None if the doc_id is not in the section
+        """
+        row = self.row(doc_id)
+        return None if row is None else self.document_bytes(row)
+
+    def iter_documents(self) -> Iterator[Tuple[str, memoryview]]:
+        """
+        :return: iterator of (doc_id, content) in metadata order
+        """
+        for row in range(len(self)):
+            yield self.doc_id(row), self.document_bytes(row)
+
+    def sample(self, k: int, seed: Optional[int] = None) -> List[str]:
+        """
+        :param k: number of doc_ids
+        :param seed: seed of the sample
+        :return: k distinct doc_ids drawn uniformly, without listing the section
+        """
+        rows = random.Random(seed).sample(range(len(self)), min(k, len(self)))
+        return [self.doc_id(row) for row in rows]
+
+    def close(self) -> None:
+        """
+        Unmaps the index. Slices returned by document_bytes and metadata_bytes must be released first.
+        """
+        for mapped in (self._meta_map, self._blob_map):
+            if mapped is not None:
+                mapped.close()
+        self._meta_map = None
+        self._blob_map = None
+
+
+class CorpusIndex:
+    """
+    Models the indexes of several sections. doc_ids start with the name of their section, so a
+    lookup only consults the section whose name is the longest prefix of the doc_id.
+    """
+
+    def __init__(self, index_dirs: List[Path]):
+        self.sections: Dict[str, SectionIndex] = {}
+        for index_dir in index_dirs:
+            index = SectionIndex(index_dir)
+            self.sections[index.section_dir.name] = index
+        self._by_length = sorted(self.sections, key=len, reverse=True)
+
+    def section(self, doc_id: str) -> Optional[SectionIndex]:
+        for name in self._by_length:
+            if doc_id.startswith(name):
+                return self.sections[name]
+        return None
+
+    def metadata(self, doc_id: str) -> Optional[dict]:
+        index = self.section(doc_id)
+        return None if index is None else index.metadata(doc_id)
+
+    def document(self, doc_id: str) -> Optional[memoryview]:
+        index = self.section(doc_id)
+        return None if index is None else index.document(doc_id)
+
+    def join_metadata(self, doc_ids: List[str]) -> List[Optional[dict]]:
+        """
+        :param doc_ids: doc_ids from any of the sections
+        :return: the metadata record of every doc_id, None for unknown doc_ids
+        """
+        return [self.metadata(doc_id) for doc_id in doc_ids]
+
+    def close(self) -> None:
+        for index in self.sections.values():
+            index.close()
@@ -12,6 +12,12 @@ import arrow
 
 import meta
 from meta import get_meta_object
+from resumable import Manifest, expand_resumable
+from tweet_io import JSON_BACKENDS, ShardWriter, get_text_extractor, open_input
+
+# stageMetrics.py, the metrics hook shared by the stages, is in the repository root
+sys.path.append(str(Path(__file__).resolve().parents[3]))
+import stageMetrics
 
 
 class ParserWithUsage(argparse.ArgumentParser):
@@ -38,6 +44,20 @@ def main():
     parser.add_argument("--input", help="Input file", required=True, type=Path)
     parser.add_argument("--section_name", help="Name of resulting section", required=True, type=str)
     parser.add_argument("--output", help="Output directory", required=True, type=Path)
+    parser.add_argument("--shard_tweets", help="Start a new document after this many tweets",
+                        type=int, default=None)
+    parser.add_argument("--shard_bytes", help="Start a new document after this many bytes",
+                        type=int, default=None)
+    parser.add_argument("--json_backend", help="JSON parser used to read the tweets",
+                        choices=JSON_BACKENDS, default="json")
+    parser.add_argument("--resume", help="Continue an interrupted or earlier run from its manifest "
+                        "instead of rebuilding the section", action="store_true", default=False)
+    parser.add_argument("--dedup", help="Drop tweets whose id has already been written",
+                        action="store_true", default=False)
+    parser.add_argument("--jobs", help="Number of processes parsing an uncompressed input",
+                        type=int, default=1)
+    parser.add_argument("--chunk_bytes", help="Input bytes between checkpoints of a resumable run",
+                        type=int, default=64 << 20)
 
     args = parser.parse_args()
     input_file = args.input
@@ -46,8 +66,17 @@ def main():
     logging.info(f"Will read tweets from JSONL file: {input_file}")
     namespace: str = args.section_name
 
-    if output_dir.exists():
-        shutil.rmtree(output_dir)
+    incremental = args.resume or args.dedup or args.jobs > 1
+    manifest_file = Manifest.path_for(output_dir)
+    ids_file = output_dir.with_name(output_dir.name + ".ids.sqlite")
+    if args.resume and manifest_file.exists():
+        logging.info(f"Resuming from {manifest_file}")
+    else:
+        if output_dir.exists():
+            shutil.rmtree(output_dir)
+        for state_file in (manifest_file, ids_file):
+            if state_file.exists():
+                state_file.unlink()
     if not output_dir.exists():
         output_dir.mkdir(parents=True, exist_ok=False)
 
@@ -60,33 +89,50 @@ def main():
             "The use of this section is described in the Twitter Terms of Service and Twitter "
             "Developer Agreement.")
 
-    with input_file.open(mode="r") as in_file:
-        doc_id = f"{namespace}_0"
+    date_built = arrow.now().replace(tzinfo="Europe/Copenhagen").strftime(date_format)
+
+    def new_meta(doc_id: str) -> dict:
         meta_object = get_meta_object()
         meta_object[meta.KEY_URI] = "https://twitter.com"
         meta_object[meta.KEY_DOC_ID] = doc_id
-        meta_object[meta.KEY_DATE_BUILT] = arrow.now().replace(
-            tzinfo="Europe/Copenhagen").strftime(date_format)
-        metadata.append(meta_object)
-        out_file = output_dir / doc_id
-        with out_file.open(mode="w", encoding="utf8") as o:
-            for idx, line in enumerate(in_file):
-                if idx % 1_000 == 0:
-                    logging.info(f"Processing tweet: {idx}")
-                doc = json.loads(line)
-                text_content = doc["full_text"]
-                text_content = text_content.rstrip()
-                text_content = text_content.replace("\n", " ")
-                if len(text_content) > 0:
-                    o.write(text_content)
-                    o.write("\n")
+        meta_object[meta.KEY_DATE_BUILT] = date_built
+        return meta_object
 
     output_path_meta = output_dir / f"{namespace}.jsonl"
-    with output_path_meta.open("w", encoding="utf8") as out_meta:
-        for m in metadata:
-            line = json.dumps(m)
-            out_meta.write(line)
-            out_meta.write("\n")
+
+    def write_metadata(records: list) -> None:
+        with output_path_meta.open("w", encoding="utf8") as out_meta:
+            for m in records:
+                line = json.dumps(m)
+                out_meta.write(line)
+                out_meta.write("\n")
+
+    with stageMetrics.measure("tweet_expansion"):
+        if incremental:
+            metadata, n_written = expand_resumable(input_file, output_dir, namespace, new_meta,
+                                                   write_metadata, args.shard_tweets,
+                                                   args.shard_bytes, args.json_backend, args.jobs,
+                                                   args.chunk_bytes, args.dedup)
+        else:
+            n_written = 0
+            extract_text = get_text_extractor(args.json_backend)
+            with open_input(input_file) as in_file:
+                writer = ShardWriter(output_dir, namespace, new_meta, args.shard_tweets,
+                                     args.shard_bytes)
+                for idx, line in enumerate(in_file):
+                    if idx % 1_000 == 0:
+                        logging.info(f"Processing tweet: {idx}")
+                    text_content = extract_text(line)
+                    text_content = text_content.rstrip()
+                    text_content = text_content.replace("\n", " ")
+                    if len(text_content) > 0:
+                        writer.write(text_content)
+                        n_written += 1
+                writer.close()
+                metadata.extend(writer.metadata)
+    stageMetrics.add("tweet_expansion", n_written)
+
+    write_metadata(metadata)
 
     logging.info("DONE")
 
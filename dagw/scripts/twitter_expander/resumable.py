@@ -0,0 +1,312 @@
+"""
+Resumable, deduplicating expansion of a hydrated tweet file.
+
+Progress is recorded in a manifest next to the output directory: the input byte offset up to which
+all tweets have been written, the next document number, the size of the document being written
+and the metadata written so far. Tweet ids that have been written are kept in an SQLite set next
+to the output directory, so duplicates from overlapping hydration batches are dropped, also across
+runs. With deduplication, the manifest is committed in the same transaction as the ids.
+"""
+from dataclasses import asdict, dataclass, field
+import json
+import logging
+from multiprocessing import Pool
+import os
+from pathlib import Path
+import shutil
+import sqlite3
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from tweet_io import ShardWriter, get_tweet_extractor, open_input
+
+COMPRESSED_SUFFIXES = {".gz", ".zst"}
+
+
+@dataclass
+class Manifest:
+    """
+    Models the progress of an expansion.
+    """
+    input: str
+    offset: int = 0
+    next_shard: int = 0
+    doc_tweets: int = 0
+    doc_bytes: int = 0
+    metadata: List[Dict] = field(default_factory=list)
+
+    @staticmethod
+    def path_for(output_dir: Path) -> Path:
+        return output_dir.with_name(output_dir.name + ".manifest.json")
+
+    @classmethod
+    def load(cls, output_dir: Path) -> Optional["Manifest"]:
+        path = cls.path_for(output_dir)
+        if not path.exists():
+            return None
+        with path.open("r", encoding="utf8") as in_file:
+            return cls(**json.load(in_file))
+
+    def to_json(self) -> str:
+        return json.dumps(asdict(self))
+
+    def save(self, output_dir: Path) -> None:
+        """
+        Writes the manifest atomically, so a crash leaves either the old or the new version.
+        :param output_dir: section directory the manifest belongs to
+        """
+        path = self.path_for(output_dir)
+        tmp_path = path.with_name(path.name + ".tmp")
+        with tmp_path.open("w", encoding="utf8") as out_file:
+            out_file.write(self.to_json())
+        os.replace(tmp_path, path)
+
+
+class TweetIdSet:
+    """
+    Models an on-disk set of tweet ids. Additions become permanent on commit, together with the
+    manifest of the expansion they belong to.
+    """
+
+    def __init__(self, path: Path):
+        self.connection = sqlite3.connect(str(path))
+        self.connection.execute("CREATE TABLE IF NOT EXISTS ids (id INTEGER PRIMARY KEY)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS manifest "
+                                "(key INTEGER PRIMARY KEY CHECK (key = 0), manifest TEXT)")
+
+    def add(self, tweet_id: int) -> bool:
+        """
+        :param tweet_id: id to add
+        :return: True if the id was not in the set
+        """
+        cursor = self.connection.execute("INSERT OR IGNORE INTO ids VALUES (?)", (tweet_id,))
+        return cursor.rowcount == 1
+
+    def commit(self, manifest: Manifest) -> None:
+        """
+        Commits the added ids and the manifest in one transaction.
+        :param manifest: progress up to which the ids have been written
+        """
+        self.connection.execute("INSERT OR REPLACE INTO manifest VALUES (0, ?)", (manifest.to_json(),))
+        self.connection.commit()
+
+    def manifest(self) -> Optional[Manifest]:
+        """
+        :return: the manifest of the last commit, or None
+        """
+        row = self.connection.execute("SELECT manifest FROM manifest").fetchone()
+        return None if row is None else Manifest(**json.loads(row[0]))
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+def remove_unrecorded_documents(output_dir: Path, namespace: str, next_shard: int) -> None:
+    """
+    Removes the documents an interrupted run created after its last checkpoint.
+    :param output_dir: section directory
+    :param namespace: section name
+    :param next_shard: number of the first document that is not in the manifest
+    """
+    while (output_dir / f"{namespace}_{next_shard}").exists():
+        (output_dir / f"{namespace}_{next_shard}").unlink()
+        next_shard += 1
+
+
+def clean_text(text: str) -> str:
+    """
+    :param text: full_text of a tweet
+    :return: the text as it is written to a document
+    """
+    return text.rstrip().replace("\n", " ")
+
+
+def find_ranges(path: Path, start: int, end: int, chunk_bytes: int) -> List[Tuple[int, int]]:
+    """
+    Splits [start, end) of a file into ranges of about chunk_bytes that begin and end on line
+    boundaries.
+    :param path: file to split
+    :param start: first byte, at the start of a line
+    :param end: end of the file
+    :param chunk_bytes: approximate size of a range
+    :return: list of (start, end) byte ranges
+    """
+    boundaries = [start]
+    with path.open("rb") as in_file:
+        while boundaries[-1] + chunk_bytes < end:
+            in_file.seek(boundaries[-1] + chunk_bytes)
+            in_file.readline()
+            boundaries.append(min(in_file.tell(), end))
+    if boundaries[-1] < end:
+        boundaries.append(end)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def extract_range(args: Tuple[Path, int, int, str, Path]) -> Path:
+    """
+    Parses the tweets that start in a byte range and writes "id<TAB>JSON string" lines to a
+    temporary file, so the expensive parsing runs in worker processes. The text is JSON encoded,
+    so carriage returns and other line separators in a tweet cannot split its line.
+    :param args: input file, start and end of the range, JSON backend and temporary file
+    :return: the temporary file
+    """
+    input_file, start, end, backend, tmp_file = args
+    extract = get_tweet_extractor(backend)
+    with input_file.open("rb") as in_file, tmp_file.open("wb") as out_file:
+        in_file.seek(start)
+        position = start
+        while position < end:
+            line = in_file.readline()
+            if not line:
+                break
+            position += len(line)
+            tweet_id, text = extract(line)
+            out_file.write(f"{tweet_id}\t{json.dumps(clean_text(text))}\n".encode("utf8"))
+    return tmp_file
+
+
+def read_extracted(tmp_file: Path) -> Iterator[Tuple[int, str]]:
+    """
+    Reads a file written by extract_range and removes it.
+    :param tmp_file: temporary file
+    :return: iterator of (tweet id, text)
+    """
+    with tmp_file.open("rb") as in_file:
+        for line in in_file:
+            tweet_id, text = line.split(b"\t", 1)
+            yield int(tweet_id), json.loads(text)
+    tmp_file.unlink()
+
+
+def iter_chunks_parallel(input_file: Path, start: int, backend: str, jobs: int, chunk_bytes: int,
+                         tmp_dir: Path) -> Iterator[Tuple[int, Iterable[Tuple[int, str]]]]:
+    """
+    Parses byte ranges of an uncompressed input in a process pool.
+    :return: iterator of (end offset of the range, tweets of the range), in input order
+    """
+    ranges = find_ranges(input_file, start, input_file.stat().st_size, chunk_bytes)
+    tasks = [(input_file, s, e, backend, tmp_dir / f"range_{s}") for s, e in ranges]
+    with Pool(jobs) as pool:
+        for (s, e), tmp_file in zip(ranges, pool.imap(extract_range, tasks)):
+            yield e, read_extracted(tmp_file)
+
+
+def iter_chunks_sequential(input_file: Path, start: int, backend: str,
+                           chunk_bytes: int) -> Iterator[Tuple[int, Iterable[Tuple[int, str]]]]:
+    """
+    Parses an input that cannot be split into byte ranges, e.g. a compressed one, in this
+    process. Offsets refer to the decompressed stream.
+    :return: iterator of (end offset of the chunk, tweets of the chunk), in input order
+    """
+    extract = get_tweet_extractor(backend)
+    with open_input(input_file) as in_file:
+        skipped = 0
+        while skipped < start:
+            data = in_file.read(min(1 << 20, start - skipped))
+            if not data:
+                break
+            skipped += len(data)
+
+        position = start
+        chunk_start = start
+        tweets = []
+        for line in in_file:
+            position += len(line)
+            tweet_id, text = extract(line)
+            tweets.append((tweet_id, clean_text(text)))
+            if position - chunk_start >= chunk_bytes:
+                yield position, tweets
+                chunk_start = position
+                tweets = []
+        if tweets:
+            yield position, tweets
+
+
+def expand_resumable(input_file: Path, output_dir: Path, namespace: str,
+                     new_meta: Callable[[str], Dict], write_metadata: Callable[[List[Dict]], None],
+                     max_tweets: Optional[int], max_bytes: Optional[int], backend: str,
+                     jobs: int, chunk_bytes: int, dedup: bool) -> Tuple[List[Dict], int]:
+    """
+    Expands the part of the input that has not been expanded yet. After every chunk the written
+    documents are flushed, the metadata written and the manifest updated, so an interrupted run
+    continues after the last completed chunk. Documents are split by max_tweets and max_bytes
+    only, as in a single pass; the document being written at a checkpoint is continued by the
+    next chunk or run.
+    :param input_file: hydrated tweet file
+    :param output_dir: section directory
+    :param namespace: section name
+    :param new_meta: creates the metadata record of a document
+    :param write_metadata: writes the section's metadata file
+    :param max_tweets: maximum number of tweets per document
+    :param max_bytes: maximum number of bytes per document
+    :param backend: JSON backend
+    :param jobs: number of processes parsing the input
+    :param chunk_bytes: input bytes between checkpoints
+    :param dedup: whether to drop tweets whose id has already been written
+    :return: the metadata of all documents in the section and the number of tweets written by
+    this run
+    """
+    seen = TweetIdSet(output_dir.with_name(output_dir.name + ".ids.sqlite")) if dedup else None
+    # The manifest committed with the ids is at least as recent as the file
+    manifest = seen.manifest() if seen is not None else None
+    if manifest is None:
+        manifest = Manifest.load(output_dir)
+    if manifest is None:
+        manifest = Manifest(input=str(input_file.resolve()))
+    elif manifest.input != str(input_file.resolve()):
+        # A different dump: read it from the start, the id set drops what was already written
+        logging.info(f"Input changed from {manifest.input}, reading it from the start")
+        manifest.input = str(input_file.resolve())
+        manifest.offset = 0
+    elif input_file.suffix not in COMPRESSED_SUFFIXES and \
+            input_file.stat().st_size < manifest.offset:
+        logging.info("Input is shorter than the recorded offset, reading it from the start")
+        manifest.offset = 0
+    if manifest.offset > 0:
+        logging.info(f"Resuming at byte {manifest.offset}, document {manifest.next_shard}")
+
+    remove_unrecorded_documents(output_dir, namespace, manifest.next_shard)
+    writer = ShardWriter(output_dir, namespace, new_meta, max_tweets, max_bytes,
+                         first_shard=manifest.next_shard, open_first=False)
+    writer.metadata = manifest.metadata
+    if manifest.doc_tweets > 0:
+        writer.reopen(manifest.doc_tweets, manifest.doc_bytes)
+
+    tmp_dir = output_dir.with_name(output_dir.name + ".tmp")
+    tmp_dir.mkdir(exist_ok=True)
+
+    if input_file.suffix in COMPRESSED_SUFFIXES or jobs <= 1:
+        chunks = iter_chunks_sequential(input_file, manifest.offset, backend, chunk_bytes)
+    else:
+        chunks = iter_chunks_parallel(input_file, manifest.offset, backend, jobs, chunk_bytes,
+                                      tmp_dir)
+
+    n_written = 0
+    n_duplicates = 0
+    for end, tweets in chunks:
+        for tweet_id, text in tweets:
+            if len(text) == 0:
+                continue
+            if seen is not None and not seen.add(tweet_id):
+                n_duplicates += 1
+                continue
+            writer.write(text)
+            n_written += 1
+        writer.flush()
+
+        manifest.metadata = writer.metadata
+        manifest.next_shard = writer.next_shard
+        manifest.doc_tweets = writer.n_tweets
+        manifest.doc_bytes = writer.n_bytes
+        manifest.offset = end
+        write_metadata(manifest.metadata)
+        if seen is not None:
+            seen.commit(manifest)
+        manifest.save(output_dir)
+        logging.info(f"Expanded input up to byte {end}: {n_written} tweets written, "
+                     f"{n_duplicates} duplicates dropped")
+
+    writer.close()
+    if seen is not None:
+        seen.close()
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    return manifest.metadata, n_written
@@ -0,0 +1,143 @@
+"""
+Reading of hydrated tweet files: compressed input and pluggable JSON backends.
+"""
+import gzip
+import io
+import json
+from pathlib import Path
+from typing import BinaryIO, Callable, Dict, Optional, Tuple
+
+
+def get_text_extractor(backend: str) -> Callable[[bytes], str]:
+    """
+    Returns a function that extracts the full_text field from one line of hydrated JSON.
+    :param backend: "json" (standard library), "orjson" or "simdjson" (parses lazily, so only
+    full_text is materialized)
+    :return: the extractor
+    """
+    if backend == "json":
+        return lambda line: json.loads(line)["full_text"]
+    if backend == "orjson":
+        import orjson
+        return lambda line: orjson.loads(line)["full_text"]
+    if backend == "simdjson":
+        import simdjson
+        parser = simdjson.Parser()
+
+        def extract(line: bytes) -> str:
+            return parser.parse(line)["full_text"]
+        return extract
+    raise ValueError(f"Unknown JSON backend {backend}")
+
+
+def get_tweet_extractor(backend: str) -> Callable[[bytes], Tuple[int, str]]:
+    """
+    Returns a function that extracts the tweet id and the full_text field from one line of
+    hydrated JSON.
+    :param backend: see get_text_extractor
+    :return: the extractor
+    """
+    if backend == "json":
+        loads = json.loads
+    elif backend == "orjson":
+        import orjson
+        loads = orjson.loads
+    elif backend == "simdjson":
+        import simdjson
+        loads = simdjson.Parser().parse
+    else:
+        raise ValueError(f"Unknown JSON backend {backend}")
+
+    def extract(line: bytes) -> Tuple[int, str]:
+        doc = loads(line)
+        return int(doc["id_str"] if "id_str" in doc else doc["id"]), doc["full_text"]
+    return extract
+
+
+JSON_BACKENDS = ["json", "orjson", "simdjson"]
+
+
+def open_input(path: Path) -> BinaryIO:
+    """
+    Opens a hydrated tweet file for reading, decompressing .gz and .zst files on the fly.
+    :param path: input file
+    :return: binary file object
+    """
+    if path.suffix == ".gz":
+        return gzip.open(path, "rb")
+    if path.suffix == ".zst":
+        import zstandard
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(path.open("rb"),
+                                                                            closefd=True))
+    return path.open("rb")
+
+
+class ShardWriter:
+    """
+    Writes tweets into documents {namespace}_0, {namespace}_1, ... starting a new document after
+    max_tweets tweets or max_bytes bytes, and keeps one metadata record per document. Unless
+    open_first is set, a document is only created once a tweet is written to it.
+    """
+
+    def __init__(self, output_dir: Path, namespace: str, new_meta: Callable[[str], Dict],
+                 max_tweets: Optional[int] = None, max_bytes: Optional[int] = None,
+                 first_shard: int = 0, open_first: bool = True):
+        self.output_dir = output_dir
+        self.namespace = namespace
+        self.new_meta = new_meta
+        self.max_tweets = max_tweets
+        self.max_bytes = max_bytes
+        self.next_shard = first_shard
+        self.metadata = []
+        self.out = None
+        self.n_tweets = 0
+        self.n_bytes = 0
+        if open_first:
+            self._open_next()
+
+    def _open_next(self):
+        if self.out is not None:
+            self.out.close()
+        doc_id = f"{self.namespace}_{self.next_shard}"
+        self.next_shard += 1
+        self.metadata.append(self.new_meta(doc_id))
+        self.out = (self.output_dir / doc_id).open(mode="wb")
+        self.n_tweets = 0
+        self.n_bytes = 0
+
+    def write(self, text: str) -> None:
+        """
+        Writes one tweet as a line, rolling over to the next document if the current one is full.
+        :param text: tweet text without newlines
+        """
+        data = text.encode("utf8") + b"\n"
+        if self.out is None or (self.max_tweets is not None and self.n_tweets >= self.max_tweets) \
+                or (self.max_bytes is not None and self.n_tweets > 0
+                    and self.n_bytes + len(data) > self.max_bytes):
+            self._open_next()
+        self.out.write(data)
+        self.n_tweets += 1
+        self.n_bytes += len(data)
+
+    def reopen(self, n_tweets: int, n_bytes: int) -> None:
+        """
+        Continues the last opened document of an earlier writer, dropping anything written to it
+        after that writer's checkpoint.
+        :param n_tweets: number of tweets in the document at the checkpoint
+        :param n_bytes: size of the document at the checkpoint
+        """
+        self.close()
+        self.out = (self.output_dir / f"{self.namespace}_{self.next_shard - 1}").open(mode="r+b")
+        self.out.truncate(n_bytes)
+        self.out.seek(n_bytes)
+        self.n_tweets = n_tweets
+        self.n_bytes = n_bytes
+
+    def flush(self) -> None:
+        if self.out is not None:
+            self.out.flush()
+
+    def close(self) -> None:
+        if self.out is not None:
+            self.out.close()
+            self.out = None
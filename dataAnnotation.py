@@ -1,11 +1,24 @@
+import argparse
+import collections
+import hashlib
+import multiprocessing
+import os
 import requests
 import json
 import pandas as pd
 import re
+import shutil
 import spacy
 import time
 import numpy as np
 
+import stageMetrics
+from docCache import DEFAULT_MAX_BYTES, DocCache
+
+# Only the tagger output (token.pos_) is used when building the source string,
+# so the remaining components are excluded when loading the model for annotation.
+UNUSED_COMPONENTS = ["parser", "lemmatizer", "ner"]
+
 def findTokenOffsets(sentence):
     # This function only works with grammatically correct english
     # where there are spaces after commas, colons and semi-colons.
@@ -17,7 +30,63 @@ def findTokenOffsets(sentence):
 
     return {offsets[i]:sentenceSplit[i] for i in range(len(sentenceSplit))}
 
-def createTarget(dbEntry):
+def findAttachedPunctuation(tokenOffsets):
+    # Maps offsets inside a token that follow punctuation, e.g. the "S" in
+    # "(Schweiz" or in "Danmark,Sverige", to the offset of the token itself
+    attached = {}
+    for offset, token in tokenOffsets.items():
+        for idx in range(1, len(token)):
+            if not token[idx-1].isalnum():
+                attached[offset+idx] = offset
+    return attached
+
+def indexResources(resources, attached=None):
+    # Resources grouped by token offset, keeping their position in the list
+    resourceIndex = {}
+    for position, word in enumerate(resources):
+        offset = int(word["@offset"])
+        if attached is not None:
+            offset = attached.get(offset, offset)
+        resourceIndex.setdefault(offset, []).append((position, word))
+    return resourceIndex
+
+def createTarget(dbEntry, attachedPunctuation=False):
+    # Single pass over the tokens producing the same output as
+    # createTargetLegacy: surface forms in token order, with a "*" wherever
+    # the legacy loop would have met a resource at another offset.
+    tokenOffsets = findTokenOffsets(dbEntry["@text"])
+    resources = dbEntry["Resources"]
+    attached = findAttachedPunctuation(tokenOffsets) if attachedPunctuation else None
+    resourceIndex = indexResources(resources, attached)
+    lastPosition = len(resources) - 1
+
+    targetParts = []
+    isEmpty = True
+
+    def markGap():
+        # Has it already been marked?
+        if not isEmpty and targetParts[-1].rsplit(" ", 1)[-1] != "*":
+            targetParts.append("*")
+
+    for offset in tokenOffsets:
+        previousPosition = -1
+        for position, word in resourceIndex.get(offset, ()):
+            if position > previousPosition + 1:
+                markGap()
+            if isEmpty:
+                targetParts = [word["@surfaceForm"]]
+                isEmpty = targetParts[0] == ""
+            else:
+                targetParts.append(word["@surfaceForm"])
+            previousPosition = position
+
+        if previousPosition < lastPosition:
+            markGap()
+
+    return " ".join(targetParts)
+
+def createTargetLegacy(dbEntry):
+    # Original O(tokens x resources) implementation, kept to verify createTarget
 
     targetString = ""
 
@@ -52,18 +121,142 @@ def createSource(nlp, dbEntry):
 
     return sourceString[:-1]
 
+def createSourceFromDoc(doc):
+    return " ".join(token.text + " " + token.pos_ for token in doc)
+
+def cleanTarget(target):
+    # Remove a trailing gap marker left by createTarget
+    if target.split(" ")[-1] == "*":
+        return target[:-2]
+    return target
+
+def loadAnnotationPipeline(model="da_core_news_sm"):
+    return spacy.load(model, exclude=UNUSED_COMPONENTS)
+
+def readSpotlightEntries(path):
+    # Lazily yields the parsed DBpedia Spotlight responses, one per line
+    with open(path, "r", encoding="utf-8") as file:
+        for line in file:
+            line = line.strip()
+            if line == "":
+                continue
+            try:
+                yield json.loads(line)
+            # Failed dbpedia spotlight request
+            except json.JSONDecodeError:
+                continue
+
+def annotateStream(nlp, dbEntries, batchSize=1000, attachedPunctuation=False, docCache=None):
+    # Entries without resources have no targets, so they are dropped
+    # before they reach the spaCy pipeline.
+    withTargets = ((dbEntry["@text"], dbEntry) for dbEntry in dbEntries
+                   if "Resources" in dbEntry and "@text" in dbEntry)
+
+    # Texts tagged in an earlier run are taken from the cache
+    pipe = docCache.pipe if docCache is not None else nlp.pipe
+    for doc, dbEntry in pipe(withTargets, as_tuples=True, batch_size=batchSize):
+        try:
+            target = createTarget(dbEntry, attachedPunctuation)
+        except KeyError:
+            continue
 
-if __name__ == "__main__":
+        yield {
+            "text":dbEntry["@text"],
+            "source":createSourceFromDoc(doc),
+            "target":target
+        }
+
+def isTrainRecord(text, seed=0, trainFraction=0.8):
+    # Deterministic train/valid assignment so the split can be reproduced
+    # without holding (and shuffling) the whole corpus in memory.
+    digest = hashlib.blake2b((str(seed) + "\t" + text).encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big") / 2**64 < trainFraction
+
+def findShardRanges(path, nShards):
+    # Splits the file into byte ranges that start and end on line boundaries
+    fileSize = os.path.getsize(path)
+    boundaries = [0]
+
+    with open(path, "rb") as file:
+        for i in range(1, nShards):
+            file.seek(max(fileSize * i // nShards, boundaries[-1]))
+            if file.tell() > 0:
+                file.seek(file.tell() - 1)
+                file.readline()
+            boundaries.append(file.tell())
+    boundaries.append(fileSize)
+
+    return [(boundaries[i], boundaries[i+1]) for i in range(nShards) if boundaries[i] < boundaries[i+1]]
+
+def readSpotlightRange(path, start, end):
+    # Same as readSpotlightEntries, restricted to the lines starting in [start, end)
+    with open(path, "rb") as file:
+        file.seek(start)
+        position = start
+        while position < end:
+            line = file.readline()
+            if not line:
+                break
+            position += len(line)
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            # Failed dbpedia spotlight request
+            except (json.JSONDecodeError, UnicodeDecodeError):
+                continue
+
+
+def outputPath(side, split, suffix="dbpedia_spotlight05_da", bucket=""):
+    return side + "_" + split + "_" + suffix + bucket + ".txt"
+
+
+# Applied while the pairs are written, so OpenNMT needs no further passes:
+# srcTrunc/tgtTrunc cut sequences to that many tokens (src_seq_length_trunc and
+# tgt_seq_length_trunc), buckets are the upper source lengths of the
+# size-bucketed files, and countVocab counts the tokens of the training pairs.
+OutputOptions = collections.namedtuple("OutputOptions", ["srcTrunc", "tgtTrunc", "buckets", "countVocab"],
+                                       defaults=[None, None, None, False])
+
+def truncate(sequence, maxTokens):
+    # Tokens are split on whitespace, as OpenNMT does
+    if maxTokens is None:
+        return sequence, False
+    tokens = sequence.split()
+    if len(tokens) <= maxTokens:
+        return sequence, False
+    return " ".join(tokens[:maxTokens]), True
+
+def bucketSuffix(nTokens, buckets):
+    # Sources longer than the last bound go into the ".lenmax" files
+    if buckets is None:
+        return ""
+    for upper in buckets:
+        if nTokens <= upper:
+            return ".len" + str(upper)
+    return ".lenmax"
+
+def writeVocab(vocab, prefix):
+    # One "token<TAB>count" line per token, most frequent first, as written by onmt_build_vocab.
+    # Ties are ordered by token, so the file does not depend on the order shards were merged in.
+    for side in ["src", "tgt"]:
+        with open(prefix + ".vocab." + side, "w", encoding="utf-8") as vocabfile:
+            for token, count in sorted(vocab[side].items(), key=lambda item: (-item[1], item[0])):
+                vocabfile.write(token + "\t" + str(count) + "\n")
+
+
+def annotateInMemory(inputPath, model, suffix):
 
     print("loading file")
 
-    with open("db_spotlight_05.json", "r", encoding="utf-8") as file:
+    with open(inputPath, "r", encoding="utf-8") as file:
         db_spotlight_05 = [line.strip() for line in file.readlines()]
 
     print("file loaded")
     print("starting data annotation")
 
-    nlp = spacy.load("da_core_news_sm")
+    nlp = spacy.load(model)
     annotatedData = []
     counter = 0
     errorCounter = 0
@@ -95,16 +288,7 @@ if __name__ == "__main__":
     print("finished data annotation")
     dfAnnotatedData = pd.DataFrame(annotatedData)
 
-    cleanedTargets = []
-
-    for target in dfAnnotatedData["target"]:
-        
-        if target.split(" ")[-1] == "*":
-            cleanedTargets.append(target[:-2])
-        else:
-            cleanedTargets.append(target)
-
-    dfAnnotatedData["cleaned_target"]= cleanedTargets
+    dfAnnotatedData["cleaned_target"]= [cleanTarget(target) for target in dfAnnotatedData["target"]]
 
 
     validationSplit = int(len(dfAnnotatedData)*0.8)
@@ -115,17 +299,213 @@ if __name__ == "__main__":
     train_set = dfAnnotatedDataShuffled.iloc[:validationSplit]
     validation_set = dfAnnotatedDataShuffled.iloc[validationSplit:]
     print("writing training set")
-    with open("src_train_dbpedia_spotlight05_da.txt", "w+", encoding="utf-8") as srcfile:
-        with open("tgt_train_dbpedia_spotlight05_da.txt", "w+", encoding="utf-8") as tgtfile:
+    with open(outputPath("src", "train", suffix), "w+", encoding="utf-8") as srcfile:
+        with open(outputPath("tgt", "train", suffix), "w+", encoding="utf-8") as tgtfile:
 
             for idx, row in train_set.iterrows():
                 srcfile.write(row[0]+ "\n")
                 tgtfile.write(row[2]+ "\n")
 
     print("writing validation set")
-    with open("src_valid_dbpedia_spotlight05_da.txt", "w+", encoding="utf-8") as srcfile:
-        with open("tgt_valid_dbpedia_spotlight05_da.txt", "w+", encoding="utf-8") as tgtfile:
+    with open(outputPath("src", "valid", suffix), "w+", encoding="utf-8") as srcfile:
+        with open(outputPath("tgt", "valid", suffix), "w+", encoding="utf-8") as tgtfile:
 
             for idx, row in validation_set.iterrows():
                 srcfile.write(row[0]+ "\n")
-                tgtfile.write(row[2]+ "\n")
\ No newline at end of file
+                tgtfile.write(row[2]+ "\n")
+
+
+def writePairs(nlp, dbEntries, suffix, batchSize, seed=0, trainFraction=0.8, shardSuffix="", showProgress=True,
+               attachedPunctuation=False, options=OutputOptions(), docCache=None):
+    # Pairs are written as soon as they are produced, so the split is decided
+    # per record by isTrainRecord instead of shuffling the complete data set.
+    # Returns the counts, the vocabulary Counters (or None) and the written files.
+    counts = {"train":0, "valid":0, "truncated":0}
+    vocab = {"src":collections.Counter(), "tgt":collections.Counter()} if options.countVocab else None
+    files = {}
+
+    def openPair(split, bucket):
+        if (split, bucket) not in files:
+            files[(split, bucket)] = tuple(open(outputPath(side, split, suffix, bucket) + shardSuffix, "w+", encoding="utf-8")
+                                           for side in ["src", "tgt"])
+        return files[(split, bucket)]
+
+    if options.buckets is None:
+        openPair("train", "")
+        openPair("valid", "")
+
+    try:
+        for pair in annotateStream(nlp, dbEntries, batchSize, attachedPunctuation, docCache):
+            split = "train" if isTrainRecord(pair["text"], seed, trainFraction) else "valid"
+            source, srcTruncated = truncate(pair["source"], options.srcTrunc)
+            target, tgtTruncated = truncate(cleanTarget(pair["target"]), options.tgtTrunc)
+            if srcTruncated or tgtTruncated:
+                counts["truncated"] += 1
+
+            sourceTokens = source.split()
+            srcFile, tgtFile = openPair(split, bucketSuffix(len(sourceTokens), options.buckets))
+            srcFile.write(source + "\n")
+            tgtFile.write(target + "\n")
+            counts[split] += 1
+            if vocab is not None and split == "train":
+                vocab["src"].update(sourceTokens)
+                vocab["tgt"].update(target.split())
+
+            if showProgress:
+                print(counts["train"] + counts["valid"], end="\r")
+    finally:
+        for pairFiles in files.values():
+            for file in pairFiles:
+                file.close()
+
+    paths = sorted(outputPath(side, split, suffix, bucket) for split, bucket in files for side in ["src", "tgt"])
+    return counts, vocab, paths
+
+
+def annotateStreaming(inputPath, model, suffix, batchSize, seed=0, trainFraction=0.8, attachedPunctuation=False,
+                      options=OutputOptions(), vocabPrefix=None, cacheDir=None, cacheMaxBytes=DEFAULT_MAX_BYTES):
+    nlp = loadAnnotationPipeline(model)
+    docCache = DocCache(cacheDir, nlp, cacheMaxBytes) if cacheDir is not None else None
+    with stageMetrics.measure("annotation"):
+        counts, vocab, paths = writePairs(nlp, readSpotlightEntries(inputPath), suffix, batchSize, seed,
+                                          trainFraction, attachedPunctuation=attachedPunctuation, options=options,
+                                          docCache=docCache)
+    stageMetrics.add("annotation", counts["train"] + counts["valid"])
+    if vocab is not None:
+        writeVocab(vocab, vocabPrefix)
+    if docCache is not None:
+        print("doc cache", docCache.stats)
+        docCache.close()
+    print("finished data annotation", counts)
+
+
+# One spaCy model (and Doc cache connection) per worker process, loaded by initWorker
+workerNlp = None
+workerDocCache = None
+
+def initWorker(model, cacheDir=None, cacheMaxBytes=DEFAULT_MAX_BYTES):
+    global workerNlp, workerDocCache
+    workerNlp = loadAnnotationPipeline(model)
+    if cacheDir is not None:
+        workerDocCache = DocCache(cacheDir, workerNlp, cacheMaxBytes)
+
+def annotateShard(shard):
+    inputPath, start, end, shardIndex, suffix, batchSize, seed, trainFraction, attachedPunctuation, options = shard
+    return writePairs(workerNlp, readSpotlightRange(inputPath, start, end), suffix, batchSize,
+                      seed, trainFraction, shardSuffix=".shard" + str(shardIndex), showProgress=False,
+                      attachedPunctuation=attachedPunctuation, options=options, docCache=workerDocCache)
+
+def mergeShards(paths, nShards):
+    # Concatenates the shard files of every output file in input order and
+    # removes them, a shard that wrote nothing to a bucket has no file for it
+    for path in paths:
+        with open(path, "wb") as outputFile:
+            for shardIndex in range(nShards):
+                shardPath = path + ".shard" + str(shardIndex)
+                if not os.path.exists(shardPath):
+                    continue
+                with open(shardPath, "rb") as shardFile:
+                    shutil.copyfileobj(shardFile, outputFile)
+                os.remove(shardPath)
+
+def annotateParallel(inputPath, model, suffix, batchSize, jobs, seed=0, trainFraction=0.8, attachedPunctuation=False,
+                     options=OutputOptions(), vocabPrefix=None, cacheDir=None, cacheMaxBytes=DEFAULT_MAX_BYTES):
+    ranges = findShardRanges(inputPath, jobs)
+    shards = [(inputPath, start, end, shardIndex, suffix, batchSize, seed, trainFraction, attachedPunctuation, options)
+              for shardIndex, (start, end) in enumerate(ranges)]
+
+    print("annotating " + str(len(shards)) + " shards with " + str(jobs) + " processes")
+    counts = {"train":0, "valid":0, "truncated":0}
+    # Every worker counts its own shard, the Counters are merged here
+    vocab = {"src":collections.Counter(), "tgt":collections.Counter()} if options.countVocab else None
+    paths = set()
+    with stageMetrics.measure("annotation"):
+        with multiprocessing.Pool(jobs, initializer=initWorker, initargs=(model, cacheDir, cacheMaxBytes)) as pool:
+            for shardCounts, shardVocab, shardPaths in pool.imap_unordered(annotateShard, shards):
+                for key in counts:
+                    counts[key] += shardCounts[key]
+                if vocab is not None:
+                    vocab["src"].update(shardVocab["src"])
+                    vocab["tgt"].update(shardVocab["tgt"])
+                paths.update(shardPaths)
+                stageMetrics.add("annotation", shardCounts["train"] + shardCounts["valid"])
+                print(counts["train"] + counts["valid"], end="\r")
+
+        mergeShards(sorted(paths), len(shards))
+    if vocab is not None:
+        writeVocab(vocab, vocabPrefix)
+    print("finished data annotation", counts)
+
+
+def verifyTargets(inputPath):
+    # Compares createTarget with createTargetLegacy, including the trailing
+    # "*" cleanup, on every Spotlight response in the file
+    checked = 0
+    mismatches = 0
+    for dbEntry in readSpotlightEntries(inputPath):
+        try:
+            expected = cleanTarget(createTargetLegacy(dbEntry))
+        except (KeyError, ValueError) as e:
+            expected = type(e)
+        try:
+            actual = cleanTarget(createTarget(dbEntry))
+        except (KeyError, ValueError) as e:
+            actual = type(e)
+
+        checked += 1
+        if actual != expected:
+            mismatches += 1
+            print("mismatch for " + repr(dbEntry.get("@text")) + ": " + repr(expected) + " != " + repr(actual))
+
+    print(str(checked) + " entries checked, " + str(mismatches) + " mismatches")
+    return mismatches
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Turns DBpedia Spotlight annotations into OpenNMT training data")
+    parser.add_argument("--input", default="db_spotlight_05.json", help="DBpedia Spotlight NDJSON file")
+    parser.add_argument("--suffix", default="dbpedia_spotlight05_da", help="Suffix of the src_*/tgt_* output files")
+    parser.add_argument("--model", default="da_core_news_sm", help="spaCy model used for POS tagging")
+    parser.add_argument("--stream", action="store_true", default=False,
+                        help="Stream the input through nlp.pipe instead of loading it into memory")
+    parser.add_argument("--batch_size", type=int, default=1000, help="nlp.pipe batch size in streaming mode")
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="Number of worker processes in streaming mode, each annotating a byte range of the input")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the hashed train/valid split in streaming mode")
+    parser.add_argument("--attached_punctuation", action="store_true", default=False,
+                        help="Also match resources starting after punctuation inside a token, e.g. \"(Schweiz\" or "
+                             "\"Danmark,Sverige\", in streaming mode")
+    parser.add_argument("--vocab", default=None,
+                        help="Count the tokens of the training pairs in streaming mode and write them to VOCAB.vocab.src/tgt")
+    parser.add_argument("--src_seq_length_trunc", type=int, default=None,
+                        help="Cut sources to this many tokens in streaming mode")
+    parser.add_argument("--tgt_seq_length_trunc", type=int, default=None,
+                        help="Cut targets to this many tokens in streaming mode")
+    parser.add_argument("--length_buckets", default=None,
+                        help="Comma separated source lengths, e.g. 50,100,200; in streaming mode the pairs are "
+                             "written to one src/tgt file per length bucket instead of a single one")
+    parser.add_argument("--doc_cache", default=None,
+                        help="Directory of a spaCy Doc cache (see docCache.py), so texts tagged before are not tagged again")
+    parser.add_argument("--doc_cache_gb", type=float, default=DEFAULT_MAX_BYTES / 1024**3,
+                        help="Size from which the least recently used Doc batches are evicted")
+    parser.add_argument("--verify_targets", action="store_true", default=False,
+                        help="Only check that createTarget matches createTargetLegacy on every entry of the input")
+    args = parser.parse_args()
+
+    buckets = sorted(int(bound) for bound in args.length_buckets.split(",")) if args.length_buckets else None
+    options = OutputOptions(args.src_seq_length_trunc, args.tgt_seq_length_trunc, buckets, args.vocab is not None)
+    cacheMaxBytes = int(args.doc_cache_gb * 1024**3)
+
+    if args.verify_targets:
+        if verifyTargets(args.input) > 0:
+            exit(1)
+    elif args.stream and args.jobs > 1:
+        annotateParallel(args.input, args.model, args.suffix, args.batch_size, args.jobs, seed=args.seed,
+                         attachedPunctuation=args.attached_punctuation, options=options, vocabPrefix=args.vocab,
+                         cacheDir=args.doc_cache, cacheMaxBytes=cacheMaxBytes)
+    elif args.stream:
+        annotateStreaming(args.input, args.model, args.suffix, args.batch_size, seed=args.seed,
+                          attachedPunctuation=args.attached_punctuation, options=options, vocabPrefix=args.vocab,
+                          cacheDir=args.doc_cache, cacheMaxBytes=cacheMaxBytes)
+    else:
+        annotateInMemory(args.input, args.model, args.suffix)
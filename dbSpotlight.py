@@ -0,0 +1,147 @@
+import argparse
+import collections
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class SpotlightCache:
+    # On-disk cache of Spotlight responses keyed by (endpoint, text, confidence),
+    # so re-runs and restarts after a crash don't hit the server again
+    def __init__(self, path, commitEvery=100):
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS responses "
+                                "(key TEXT PRIMARY KEY, endpoint TEXT, confidence REAL, response TEXT)")
+        self.lock = threading.Lock()
+        self.commitEvery = commitEvery
+        self.pendingWrites = 0
+
+    @staticmethod
+    def key(endpoint, text, confidence):
+        return hashlib.sha1((endpoint + "\t" + repr(float(confidence)) + "\t" + text).encode("utf-8")).hexdigest()
+
+    def get(self, endpoint, text, confidence):
+        with self.lock:
+            row = self.connection.execute("SELECT response FROM responses WHERE key = ?",
+                                          (self.key(endpoint, text, confidence),)).fetchone()
+        return None if row is None else row[0]
+
+    def put(self, endpoint, text, confidence, response):
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+                                    (self.key(endpoint, text, confidence), endpoint, float(confidence), response))
+            self.pendingWrites += 1
+            if self.pendingWrites >= self.commitEvery:
+                self.connection.commit()
+                self.pendingWrites = 0
+
+    def close(self):
+        with self.lock:
+            self.connection.commit()
+            self.connection.close()
+
+
+class DBSpotlight:
+    def __init__(self, url, port, workers=8, maxRetries=5, backoff=1.0, timeout=30, cachePath=None):
+        self.url = url + ":" + port + "/rest/"
+        self.workers = workers
+        self.maxRetries = maxRetries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.cache = SpotlightCache(cachePath) if cachePath is not None else None
+
+        # Keep-alive connections shared by all worker threads
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({"Accept":"application/json"})
+
+    def request(self, endpoint, text, confidence):
+        if self.cache is not None:
+            response = self.cache.get(endpoint, text, confidence)
+            if response is not None:
+                return response
+
+        attempt = 0
+        while True:
+            try:
+                r = self.session.get(self.url+endpoint,
+                                     params={
+                                        "text":text,
+                                        "confidence":confidence
+                                     },
+                                     timeout=self.timeout
+                )
+                # The server answers 5xx while it is overloaded, which is worth retrying
+                if r.status_code < 500:
+                    break
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt >= self.maxRetries:
+                    raise
+
+            if attempt >= self.maxRetries:
+                r.raise_for_status()
+            time.sleep(min(self.backoff * 2**attempt, 60))
+            attempt += 1
+
+        if self.cache is not None and r.ok:
+            self.cache.put(endpoint, text, confidence, r.text)
+
+        return r.text
+
+    def annotate(self, text, confidence):
+        return self.request("annotate", text, confidence)
+
+    def candidate(self, text, confidence):
+        return self.request("candidate", text, confidence)
+
+    def spot(self, text, confidence):
+        return self.request("spot", text, confidence)
+
+    def annotateMany(self, texts, confidence, endpoint="annotate"):
+        # Yields the responses in input order while keeping at most
+        # 2 * workers requests in flight, so texts can be a lazy stream
+        with ThreadPoolExecutor(self.workers) as executor:
+            pending = collections.deque()
+            for text in texts:
+                pending.append(executor.submit(self.request, endpoint, text, confidence))
+                if len(pending) >= 2 * self.workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    def close(self):
+        self.session.close()
+        if self.cache is not None:
+            self.cache.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Annotates sentences with DBpedia Spotlight")
+    parser.add_argument("--input", default="DanishWikiSentences.ndjson",
+                        help="Sentence NDJSON written by sentenceExtraction.py")
+    parser.add_argument("--output", default="db_spotlight_05.json", help="NDJSON file of Spotlight responses")
+    parser.add_argument("--url", default="http://localhost")
+    parser.add_argument("--port", default="2222")
+    parser.add_argument("--confidence", type=float, default=0.5)
+    parser.add_argument("--workers", type=int, default=8, help="Maximum number of concurrent requests")
+    parser.add_argument("--cache", default="db_spotlight_cache.sqlite", help="Response cache, shared across runs")
+    args = parser.parse_args()
+
+    dbspotlight = DBSpotlight(args.url, args.port, workers=args.workers, cachePath=args.cache)
+
+    with open(args.input, "r", encoding="utf-8") as inputfile:
+        with open(args.output, "w+", encoding="utf-8") as outputfile:
+            sentences = (json.loads(line)["sentence"] for line in inputfile if line.strip() != "")
+            for counter, response in enumerate(dbspotlight.annotateMany(sentences, args.confidence)):
+                outputfile.write(response.replace("\n", " ") + "\n")
+                print(counter + 1, end="\r")
+
+    dbspotlight.close()
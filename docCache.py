@@ -0,0 +1,206 @@
+import argparse
+import collections
+import hashlib
+import os
+import sqlite3
+import time
+
+import spacy
+from spacy.tokens import DocBin
+
+# Content-addressed on-disk cache of spaCy Docs, shared by the stages that
+# run a pipeline over the same texts. A Doc is keyed by the hash of the
+# pipeline (language, model name and version, components, spaCy version) and
+# the text, so a text is processed once per pipeline and changing what a
+# stage does with the Docs does not mean running the model again.
+#
+# Docs are stored in DocBin batches, one file per batch of new texts, and an
+# SQLite index maps every key to its batch and position. When the batches
+# take more than maxBytes, the least recently used ones are removed.
+
+DEFAULT_MAX_BYTES = 10 * 1024**3
+
+
+def pipelineKey(nlp):
+    meta = nlp.meta
+    return "\t".join([meta.get("lang", ""), meta.get("name", ""), meta.get("version", ""),
+                      ",".join(nlp.pipe_names), spacy.__version__])
+
+def textKey(pipeline, text):
+    return hashlib.blake2b((pipeline + "\n" + text).encode("utf-8"), digest_size=16).hexdigest()
+
+
+class DocCache:
+    def __init__(self, cacheDir, nlp, maxBytes=DEFAULT_MAX_BYTES, loadedBatches=4):
+        self.cacheDir = cacheDir
+        self.nlp = nlp
+        self.pipeline = pipelineKey(nlp)
+        self.maxBytes = maxBytes
+        os.makedirs(os.path.join(cacheDir, "batches"), exist_ok=True)
+        # Several processes may share a cache, e.g. the workers of dataAnnotation.py --jobs
+        self.connection = sqlite3.connect(os.path.join(cacheDir, "index.sqlite"), timeout=60)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS docs (key TEXT PRIMARY KEY, batch TEXT, position INTEGER)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS batches (batch TEXT PRIMARY KEY, bytes INTEGER, last_used REAL)")
+        self.connection.commit()
+        # Recently read batches, so consecutive lookups do not read a file again
+        self.loaded = collections.OrderedDict()
+        self.loadedBatches = loadedBatches
+        self.stats = {"hits":0, "misses":0}
+
+    def batchPath(self, batch):
+        return os.path.join(self.cacheDir, "batches", batch + ".spacy")
+
+    def loadBatch(self, batch):
+        if batch in self.loaded:
+            self.loaded.move_to_end(batch)
+            return self.loaded[batch]
+        with open(self.batchPath(batch), "rb") as file:
+            docs = list(DocBin().from_bytes(file.read()).get_docs(self.nlp.vocab))
+        self.loaded[batch] = docs
+        if len(self.loaded) > self.loadedBatches:
+            self.loaded.popitem(last=False)
+        return docs
+
+    def lookup(self, keys):
+        # Returns key -> Doc for the cached keys, batches removed by another process count as misses
+        locations = {}
+        uniqueKeys = list(set(keys))
+        for start in range(0, len(uniqueKeys), 500):
+            chunk = uniqueKeys[start:start+500]
+            rows = self.connection.execute("SELECT key, batch, position FROM docs WHERE key IN (" +
+                                           ",".join("?" * len(chunk)) + ")", chunk)
+            locations.update((key, (batch, position)) for key, batch, position in rows)
+
+        docs = {}
+        used = set()
+        for key, (batch, position) in locations.items():
+            try:
+                docs[key] = self.loadBatch(batch)[position]
+                used.add(batch)
+            except FileNotFoundError:
+                continue
+        if used:
+            now = time.time()
+            self.connection.executemany("UPDATE batches SET last_used = ? WHERE batch = ?", [(now, batch) for batch in used])
+            self.connection.commit()
+        return docs
+
+    def store(self, keys, docs):
+        # Writes the Docs of new texts as one batch
+        docBin = DocBin(store_user_data=False, docs=docs)
+        data = docBin.to_bytes()
+        batch = hashlib.blake2b("".join(keys).encode("utf-8"), digest_size=16).hexdigest()
+        path = self.batchPath(batch)
+        tmpPath = path + ".tmp" + str(os.getpid())
+        with open(tmpPath, "wb") as file:
+            file.write(data)
+        os.replace(tmpPath, path)
+        self.connection.execute("INSERT OR REPLACE INTO batches VALUES (?, ?, ?)", (batch, len(data), time.time()))
+        self.connection.executemany("INSERT OR REPLACE INTO docs VALUES (?, ?, ?)",
+                                    [(key, batch, position) for position, key in enumerate(keys)])
+        self.connection.commit()
+        self.evict()
+
+    def evict(self):
+        total = self.connection.execute("SELECT COALESCE(SUM(bytes), 0) FROM batches").fetchone()[0]
+        if total <= self.maxBytes:
+            return 0
+        removed = 0
+        for batch, size in self.connection.execute("SELECT batch, bytes FROM batches ORDER BY last_used").fetchall():
+            if total <= self.maxBytes:
+                break
+            self.connection.execute("DELETE FROM docs WHERE batch = ?", (batch,))
+            self.connection.execute("DELETE FROM batches WHERE batch = ?", (batch,))
+            if os.path.exists(self.batchPath(batch)):
+                os.remove(self.batchPath(batch))
+            self.loaded.pop(batch, None)
+            total -= size
+            removed += 1
+        self.connection.commit()
+        return removed
+
+    def pipe(self, texts, as_tuples=False, batch_size=1000, maxPending=4, **pipeArgs):
+        # Drop-in replacement of nlp.pipe: Docs are taken from the cache where
+        # possible, the other texts are run through the pipeline and stored.
+        # Input is read one chunk of batch_size texts at a time and a chunk
+        # without misses is yielded at once, so a warm cache streams. The
+        # misses go through one nlp.pipe call, so with n_process the worker
+        # processes are not started for every chunk; it is only restarted when
+        # the pipeline asks for texts while maxPending chunks wait for their Docs.
+        items = iter(texts)
+        pending = collections.deque()
+        toProcess = collections.deque()
+
+        def readChunk():
+            chunk = [item for _, item in zip(range(batch_size), items)]
+            if not chunk:
+                return False
+            chunkTexts = [item[0] for item in chunk] if as_tuples else chunk
+            keys = [textKey(self.pipeline, text) for text in chunkTexts]
+            cached = self.lookup(keys)
+            missing = {}
+            for key, text in zip(keys, chunkTexts):
+                if key not in cached and key not in missing:
+                    missing[key] = text
+            self.stats["hits"] += len(keys) - len(missing)
+            self.stats["misses"] += len(missing)
+            pending.append((chunk, keys, cached, list(missing)))
+            toProcess.extend(missing.values())
+            return True
+
+        def missingTexts():
+            # Reads further chunks while the pipeline fills its batch
+            while True:
+                while not toProcess:
+                    if len(pending) >= maxPending or not readChunk():
+                        return
+                yield toProcess.popleft()
+
+        newDocs = None
+        ready = collections.deque()
+        while pending or readChunk():
+            chunk, keys, cached, missing = pending[0]
+            # Docs come back in input order, so the oldest chunk is complete once it has all of its misses
+            while len(ready) < len(missing):
+                if newDocs is None:
+                    newDocs = iter(self.nlp.pipe(missingTexts(), batch_size=batch_size, **pipeArgs))
+                try:
+                    ready.append(next(newDocs))
+                except StopIteration:
+                    newDocs = None
+            pending.popleft()
+            if missing:
+                docs = [ready.popleft() for _ in missing]
+                self.store(missing, docs)
+                cached.update(zip(missing, docs))
+
+            for key, item in zip(keys, chunk):
+                yield (cached[key], item[1]) if as_tuples else cached[key]
+        if newDocs is not None:
+            # Lets the pipeline see the end of its input, e.g. to stop its worker processes
+            for _ in newDocs:
+                pass
+
+    def size(self):
+        return self.connection.execute("SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM batches").fetchone()
+
+    def close(self):
+        self.connection.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspects or shrinks a spaCy Doc cache")
+    parser.add_argument("cache", help="Cache directory")
+    parser.add_argument("--max_gb", type=float, default=None, help="Evict batches until the cache is this small")
+    args = parser.parse_args()
+
+    # Eviction and statistics do not depend on the pipeline
+    cache = DocCache(args.cache, spacy.blank("da"))
+    if args.max_gb is not None:
+        cache.maxBytes = int(args.max_gb * 1024**3)
+        print(str(cache.evict()) + " batches evicted")
+    nBatches, nBytes = cache.size()
+    nDocs = cache.connection.execute("SELECT COUNT(*) FROM docs").fetchone()[0]
+    print(str(nDocs) + " docs in " + str(nBatches) + " batches, " + str(round(nBytes / 1024**2, 1)) + " MB")
+    cache.close()
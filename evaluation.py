@@ -0,0 +1,237 @@
+import argparse
+import json
+import os
+import re
+import numpy as np
+
+from conceptStore import StringTable
+
+# Scores target/aspect predictions against annotation_dev.tsv or
+# annotation_test.tsv, where row i holds up to three Target/Aspect pairs of
+# tweet i and line i of a predictions file holds its predicted pairs.
+#
+# Phrases are normalized and interned once, so every level of matching is a
+# set of (tweet, key) integers per side. Exact matching uses the phrase (or
+# pair) ids as keys, token overlap the ids of the phrase tokens. True
+# positives are found with one np.isin per level, and the bootstrap resamples
+# the per-tweet counts of all models and levels with one matrix product, so
+# every model is scored on the same resamples.
+
+NONE_MARKERS = {"", "-"}
+LEVELS = ["target", "aspect", "pair", "target_tokens", "aspect_tokens", "pair_tokens"]
+FORMATS = ["pairs", "targets"]
+edgePunctuation = " \t.,;:!?\"'()[]"
+whitespacePattern = re.compile(r"\s+")
+tokenPattern = re.compile(r"\w+")
+
+
+def normalize(phrase):
+    # Case and surrounding punctuation do not decide a match
+    return whitespacePattern.sub(" ", phrase.casefold()).strip(edgePunctuation)
+
+def readReference(path):
+    # Returns the [(target, aspect), ...] of every row, "-" marks a missing target or aspect
+    posts = []
+    with open(path, "r", encoding="utf-8") as file:
+        header = file.readline().rstrip("\n").split("\t")
+        for line in file:
+            fields = line.rstrip("\n").split("\t")
+            fields += [""] * (len(header) - len(fields))
+            pairs = []
+            for i in range(0, len(header) - 1, 2):
+                target, aspect = fields[i].strip(), fields[i+1].strip()
+                if target == "" and aspect == "":
+                    continue
+                pairs.append((None if target in NONE_MARKERS else target,
+                              None if aspect in NONE_MARKERS else aspect))
+            posts.append(pairs)
+    return posts
+
+def readPredictions(path, format="pairs"):
+    # pairs: JSON lists of [target, aspect] as in target_aspect_pairs_*.json,
+    # targets: OpenNMT output lines of concepts separated by "*"
+    posts = []
+    with open(path, "r", encoding="utf-8") as file:
+        for line in file:
+            if format == "pairs":
+                posts.append([(target, aspect) for target, aspect in json.loads(line)])
+            else:
+                concepts = [concept.strip() for concept in line.split("*")]
+                posts.append([(concept, None) for concept in concepts if concept != ""])
+    return posts
+
+
+class Encoder:
+    def __init__(self):
+        self.phrases = StringTable()
+        self.tokens = StringTable()
+        self.pairIds = {}
+
+    def phrase(self, phrase):
+        # Returns (phrase id, token ids, word count), phrase id -1 for a missing phrase
+        if phrase is None:
+            return -1, [], 0
+        normalized = normalize(phrase)
+        if normalized == "":
+            return -1, [], 0
+        return (self.phrases.intern(normalized), [self.tokens.intern(token) for token in tokenPattern.findall(normalized)],
+                len(phrase.split()))
+
+    def encode(self, posts):
+        # Returns the (tweet, key) arrays of every level and the word counts of the targets and aspects
+        keys = {level:([], []) for level in LEVELS}
+        wordCounts = ([], [])
+
+        def add(level, tweet, key):
+            keys[level][0].append(tweet)
+            keys[level][1].append(key)
+
+        for tweet, pairs in enumerate(posts):
+            for target, aspect in pairs:
+                targetId, targetTokens, targetWords = self.phrase(target)
+                aspectId, aspectTokens, aspectWords = self.phrase(aspect)
+                wordCounts[0].append(targetWords)
+                wordCounts[1].append(aspectWords)
+                if targetId >= 0:
+                    add("target", tweet, targetId)
+                if aspectId >= 0:
+                    add("aspect", tweet, aspectId)
+                if targetId >= 0 and aspectId >= 0:
+                    add("pair", tweet, self.pairIds.setdefault((targetId, aspectId), len(self.pairIds)))
+                for token in targetTokens:
+                    add("target_tokens", tweet, token)
+                    add("pair_tokens", tweet, 2 * token)
+                for token in aspectTokens:
+                    add("aspect_tokens", tweet, token)
+                    add("pair_tokens", tweet, 2 * token + 1)
+
+        # One integer per (tweet, key), duplicates within a tweet count once
+        combined = {level:np.unique((np.asarray(tweets, dtype=np.int64) << 32) | np.asarray(levelKeys, dtype=np.int64))
+                    for level, (tweets, levelKeys) in keys.items()}
+        return combined, (np.asarray(wordCounts[0], dtype=np.int64), np.asarray(wordCounts[1], dtype=np.int64))
+
+
+def countMatches(predicted, reference, nTweets):
+    # Per-tweet (true positives, predicted, reference) of one level, as an nTweets x 3 array
+    hits = np.isin(predicted, reference, assume_unique=True)
+    predTweets = predicted >> 32
+    return np.stack([np.bincount(predTweets, weights=hits, minlength=nTweets),
+                     np.bincount(predTweets, minlength=nTweets),
+                     np.bincount(reference >> 32, minlength=nTweets)], axis=1).astype(np.float64)
+
+def scores(totals):
+    # Precision, recall and F1 from summed counts, the last axis being (tp, predicted, reference)
+    tp, predicted, reference = totals[..., 0], totals[..., 1], totals[..., 2]
+    precision = np.divide(tp, predicted, out=np.zeros_like(tp), where=predicted > 0)
+    recall = np.divide(tp, reference, out=np.zeros_like(tp), where=reference > 0)
+    f1 = np.divide(2 * precision * recall, precision + recall, out=np.zeros_like(tp), where=precision + recall > 0)
+    return np.stack([precision, recall, f1], axis=-1)
+
+def bootstrap(counts, samples=1000, seed=0, batchSize=256):
+    # counts is nTweets x nColumns x 3, returns samples x nColumns x 3 scores of resampled tweet sets
+    nTweets = counts.shape[0]
+    flat = counts.reshape(nTweets, -1)
+    rng = np.random.default_rng(seed)
+    results = []
+    for start in range(0, samples, batchSize):
+        # How often each tweet is drawn in each resample
+        weights = rng.multinomial(nTweets, np.full(nTweets, 1 / nTweets), size=min(batchSize, samples - start))
+        results.append(scores((weights @ flat).reshape(len(weights), *counts.shape[1:])))
+    return np.concatenate(results)
+
+def evaluate(referencePath, predictionPaths, format="pairs", samples=1000, seed=0, confidence=0.95):
+    # Returns the scores of every predictions file, the word counts of every source for the charts
+    encoder = Encoder()
+    reference = readReference(referencePath)
+    nTweets = len(reference)
+    referenceKeys, referenceWords = encoder.encode(reference)
+    wordCounts = {"Reference": referenceWords}
+
+    counts = []
+    for path in predictionPaths:
+        predictions = readPredictions(path, format)
+        if len(predictions) < nTweets:
+            raise ValueError(path + " has " + str(len(predictions)) + " lines, the reference has " + str(nTweets))
+        if len(predictions) > nTweets:
+            print(path + ": only the first " + str(nTweets) + " lines are scored")
+        predictedKeys, predictedWords = encoder.encode(predictions[:nTweets])
+        wordCounts[path] = predictedWords
+        counts.append(np.stack([countMatches(predictedKeys[level], referenceKeys[level], nTweets) for level in LEVELS], axis=1))
+
+    # nTweets x (models * levels) x 3
+    counts = np.concatenate(counts, axis=1) if counts else np.zeros((nTweets, 0, 3))
+    point = scores(counts.sum(axis=0))
+    if samples > 0:
+        resampled = bootstrap(counts, samples, seed)
+        alpha = (1 - confidence) / 2 * 100
+        low, high = np.percentile(resampled, [alpha, 100 - alpha], axis=0)
+
+    results = {}
+    for m, path in enumerate(predictionPaths):
+        results[path] = {}
+        for l, level in enumerate(LEVELS):
+            column = m * len(LEVELS) + l
+            tp, predicted, referenced = counts[:, column].sum(axis=0)
+            result = {"precision":point[column, 0], "recall":point[column, 1], "f1":point[column, 2],
+                      "tp":int(tp), "predicted":int(predicted), "reference":int(referenced)}
+            if samples > 0:
+                for i, name in enumerate(["precision", "recall", "f1"]):
+                    result[name + "_ci"] = [float(low[column, i]), float(high[column, i])]
+            results[path][level] = {name:float(value) if isinstance(value, np.floating) else value
+                                    for name, value in result.items()}
+    return results, wordCounts
+
+def wordCountChart(name, targetWords, aspectWords, outputPath, colors):
+    # Bar charts of the word counts of the targets and aspects, as in *TargetsAndAspectsByWordCount.png
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    fig, axes = plt.subplots(1, 2, figsize=(16, 5), sharey=True)
+    for ax, words, color in zip(axes, [targetWords, aspectWords], colors):
+        values, counts = np.unique(words, return_counts=True)
+        ax.bar([str(value) for value in values], counts, color=color)
+        ax.grid(axis="y", alpha=0.3)
+    axes[0].set_ylabel("Amount of posts")
+    fig.suptitle(name + " targets and " + name.lower() + " aspects by word counts", x=0.01, ha="left")
+    fig.savefig(outputPath, bbox_inches="tight")
+    plt.close(fig)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Scores target/aspect predictions against an annotation TSV")
+    parser.add_argument("reference", help="annotation_dev.tsv or annotation_test.tsv")
+    parser.add_argument("predictions", nargs="+", help="Predictions files, e.g. one per model checkpoint")
+    parser.add_argument("--format", choices=FORMATS, default="pairs",
+                        help="pairs: JSON lists of [target, aspect], targets: concepts separated by \"*\"")
+    parser.add_argument("--samples", type=int, default=1000, help="Bootstrap resamples, 0 to skip the intervals")
+    parser.add_argument("--confidence", type=float, default=0.95)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="JSON file the scores are written to")
+    parser.add_argument("--charts", default=None, help="Directory the word count charts are written to")
+    args = parser.parse_args()
+
+    results, wordCounts = evaluate(args.reference, args.predictions, args.format, args.samples, args.seed,
+                                   args.confidence)
+    for path, levels in results.items():
+        print(path)
+        for level, result in levels.items():
+            line = "  {:<14} P {:.3f} R {:.3f} F1 {:.3f}".format(level, result["precision"], result["recall"], result["f1"])
+            if "f1_ci" in result:
+                line += "  F1 CI [{:.3f}, {:.3f}]".format(*result["f1_ci"])
+            print(line)
+
+    if args.output is not None:
+        with open(args.output, "w", encoding="utf-8") as outputfile:
+            json.dump(results, outputfile, indent=2)
+
+    if args.charts is not None:
+        os.makedirs(args.charts, exist_ok=True)
+        for name, (targetWords, aspectWords) in wordCounts.items():
+            if name == "Reference":
+                title, colors = "Reference", ["#004C99", "#66B2FF"]
+            else:
+                title, colors = "Candidate", ["#FF6666", "#FFD966"]
+            fileName = os.path.splitext(os.path.basename(name))[0] if name != "Reference" else "Reference"
+            wordCountChart(title, targetWords, aspectWords,
+                           os.path.join(args.charts, fileName + "TargetsAndAspectsByWordCount.png"), colors)
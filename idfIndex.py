@@ -0,0 +1,174 @@
+import argparse
+import hashlib
+import json
+import os
+import re
+import numpy as np
+
+from conceptStore import KINDS, ConceptStore, convert
+
+# Memory-mapped IDF lookups over a vocabulary written by
+# dagw/documentFrequency.py. The vocabulary already holds the sorted terms and
+# their document frequencies; "build" adds a hash index to it:
+#   term_hashes.npy  sorted 64 bit hashes of the terms
+#   term_ids.npy     term number of every hash
+# A batch of terms is hashed, located with one searchsorted and checked
+# against the term bytes, so no process has to load the vocabulary as a dict.
+
+# Same token pattern as the regex tokenizer of documentFrequency.py
+regexPattern = re.compile(r"\w+|[^\w\s]")
+COMBINE = {"mean": np.mean, "max": np.max, "min": np.min}
+
+
+def hashTerm(term):
+    return int.from_bytes(hashlib.blake2b(term, digest_size=8).digest(), "little")
+
+def buildIndex(vocabDir):
+    blob = bytes(np.load(os.path.join(vocabDir, "terms.npy"), mmap_mode="r"))
+    offsets = np.load(os.path.join(vocabDir, "term_offsets.npy"))
+    hashes = np.fromiter((hashTerm(blob[offsets[i]:offsets[i+1]]) for i in range(len(offsets) - 1)),
+                         dtype=np.uint64, count=len(offsets) - 1)
+    order = np.argsort(hashes, kind="stable")
+    sortedHashes = hashes[order]
+    if len(sortedHashes) > 1 and (sortedHashes[1:] == sortedHashes[:-1]).any():
+        raise ValueError("Hash collision between two terms of " + vocabDir)
+    np.save(os.path.join(vocabDir, "term_hashes.npy"), sortedHashes)
+    np.save(os.path.join(vocabDir, "term_ids.npy"), order.astype(np.int64))
+    return len(order)
+
+
+class IdfIndex:
+    def __init__(self, vocabDir, mmap=True):
+        mode = "r" if mmap else None
+        load = lambda name: np.load(os.path.join(vocabDir, name + ".npy"), mmap_mode=mode)
+        with open(os.path.join(vocabDir, "vocab.json"), "r", encoding="utf-8") as file:
+            self.settings = json.load(file)
+        self.nDocs = self.settings["documents"]
+        self.termBlob = load("terms")
+        self.termOffsets = load("term_offsets")
+        self.counts = load("df")
+        self.termHashes = load("term_hashes")
+        self.termIds = load("term_ids")
+        self.tokenizer = None
+
+    def __len__(self):
+        return len(self.counts)
+
+    def term(self, termId):
+        start, end = self.termOffsets[termId], self.termOffsets[termId + 1]
+        return bytes(self.termBlob[start:end]).decode("utf-8")
+
+    def lookup(self, terms):
+        # Term numbers of a batch of terms, -1 for terms not in the vocabulary
+        if self.settings.get("lowercase", False):
+            terms = [term.lower() for term in terms]
+        encoded = [term.encode("utf-8") for term in terms]
+        hashes = np.fromiter((hashTerm(term) for term in encoded), dtype=np.uint64, count=len(encoded))
+        positions = np.searchsorted(self.termHashes, hashes)
+        found = positions < len(self.termHashes)
+        found[found] = np.asarray(self.termHashes)[positions[found]] == hashes[found]
+        ids = np.full(len(encoded), -1, dtype=np.int64)
+        ids[found] = np.asarray(self.termIds)[positions[found]]
+        # Hashes only select a candidate, the bytes decide
+        for i in np.flatnonzero(found):
+            start, end = self.termOffsets[ids[i]], self.termOffsets[ids[i] + 1]
+            if bytes(self.termBlob[start:end]) != encoded[i]:
+                ids[i] = -1
+        return ids
+
+    def df(self, terms):
+        ids = self.lookup(terms)
+        counts = np.zeros(len(ids), dtype=np.int64)
+        counts[ids >= 0] = np.asarray(self.counts)[ids[ids >= 0]]
+        return counts
+
+    def idf(self, terms):
+        # Smoothed IDF, terms not in the vocabulary get the highest value
+        return np.log((1 + self.nDocs) / (1 + self.df(terms))) + 1
+
+    def tokenize(self, phrase):
+        # Lowercased before tokenizing, as documentFrequency.py does
+        if self.settings.get("lowercase", False):
+            phrase = phrase.lower()
+        if self.settings.get("tokenizer") == "spacy":
+            if self.tokenizer is None:
+                import spacy
+                self.tokenizer = spacy.blank("da").tokenizer
+            return [token.text for token in self.tokenizer(phrase)]
+        return regexPattern.findall(phrase)
+
+    def phraseIdf(self, phrases, combine="mean"):
+        # IDF of multi-word targets/aspects, combined over their tokens
+        tokenized = [self.tokenize(phrase) for phrase in phrases]
+        lengths = np.asarray([len(tokens) for tokens in tokenized], dtype=np.int64)
+        idfs = self.idf([token for tokens in tokenized for token in tokens])
+        starts = np.zeros(len(lengths) + 1, dtype=np.int64)
+        starts[1:] = np.cumsum(lengths)
+        return np.asarray([COMBINE[combine](idfs[starts[i]:starts[i+1]]) if lengths[i] > 0 else 0.0
+                           for i in range(len(lengths))])
+
+
+def rankConcepts(index, store, outputPath, kind="concepts", combine="mean", minIdf=None):
+    # Writes every distinct span text of a kind as text<TAB>idf<TAB>count, rarest first
+    strings = store.decodeStrings()
+    rows = np.flatnonzero(np.asarray(store.columns["kind"]) == KINDS.index(kind))
+    textIds, counts = np.unique(np.asarray(store.columns["text"])[rows], return_counts=True)
+    texts = [strings[textId] for textId in textIds]
+    idfs = index.phraseIdf(texts, combine)
+    written = 0
+    with open(outputPath, "w", encoding="utf-8") as outputfile:
+        for i in np.argsort(-idfs, kind="stable"):
+            if minIdf is not None and idfs[i] < minIdf:
+                continue
+            outputfile.write(texts[i] + "\t" + str(round(float(idfs[i]), 4)) + "\t" + str(counts[i]) + "\n")
+            written += 1
+    return written
+
+def filterPairs(index, inputPath, outputPath, minIdf, combine="mean"):
+    # Keeps the pairs whose target and aspect both reach minIdf, one line per text_id as in the input
+    with open(inputPath, "r", encoding="utf-8") as inputfile:
+        lines = [json.loads(line) for line in inputfile]
+    phrases = sorted({phrase for pairs in lines for pair in pairs for phrase in pair})
+    phraseIdfs = dict(zip(phrases, index.phraseIdf(phrases, combine)))
+    kept = 0
+    with open(outputPath, "w", encoding="utf-8") as outputfile:
+        for pairs in lines:
+            pairs = [pair for pair in pairs if min(phraseIdfs[pair[0]], phraseIdfs[pair[1]]) >= minIdf]
+            outputfile.write(json.dumps(pairs) + "\n")
+            kept += len(pairs)
+    return kept
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="IDF index over a DAGW document-frequency vocabulary")
+    parser.add_argument("--vocab", default="documentFrequency", help="Directory written by dagw/documentFrequency.py")
+    parser.add_argument("--combine", choices=list(COMBINE), default="mean",
+                        help="How the IDFs of the tokens of a multi-word phrase are combined")
+    parser.add_argument("--min_idf", type=float, default=None, help="Leave out phrases below this IDF")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("build", help="Adds the hash index to the vocabulary")
+    concepts = subparsers.add_parser("concepts", help="Ranks the spans of a *_concepts_extracted.json file by IDF")
+    concepts.add_argument("input")
+    concepts.add_argument("output", help="TSV of text, IDF and number of occurrences")
+    concepts.add_argument("--kind", choices=KINDS, default="concepts")
+    concepts.add_argument("--store", default=None,
+                          help="Columnar store of the input, built by conceptStore.py if it does not exist")
+    pairs = subparsers.add_parser("pairs", help="Filters a target_aspect_pairs_*.json file by --min_idf")
+    pairs.add_argument("input")
+    pairs.add_argument("output")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        print(str(buildIndex(args.vocab)) + " terms indexed")
+    elif args.command == "concepts":
+        storeDir = args.store if args.store is not None else os.path.splitext(args.input)[0] + "_store"
+        if not os.path.exists(storeDir):
+            convert(args.input, storeDir)
+        count = rankConcepts(IdfIndex(args.vocab), ConceptStore(storeDir), args.output, args.kind, args.combine,
+                             args.min_idf)
+        print(str(count) + " spans ranked")
+    else:
+        if args.min_idf is None:
+            parser.error("pairs needs --min_idf")
+        count = filterPairs(IdfIndex(args.vocab), args.input, args.output, args.min_idf, args.combine)
+        print(str(count) + " pairs kept")
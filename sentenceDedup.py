@@ -0,0 +1,176 @@
+import argparse
+import hashlib
+import json
+import re
+import time
+import zlib
+import numpy as np
+
+# Drops repeated sentences between sentence extraction and Spotlight
+# annotation. Exact repeats are found by a hash of the normalized sentence,
+# near repeats (templated stubs, infobox sentences differing in a name or a
+# number) by MinHash signatures of character shingles, banded for LSH. A
+# candidate from the LSH buckets is only a duplicate if the signatures agree
+# on at least threshold of their values.
+#
+# Memory is bounded by keeping two generations of the index: when the current
+# one holds capacity keys (kept sentences and the exact keys of near
+# duplicates) it becomes the previous one and the oldest generation is
+# dropped, so duplicates are found within the last capacity to 2 * capacity
+# sentences. LSH buckets keep at most maxBucket sentences, which
+# bounds the work spent on very common patterns.
+
+whitespacePattern = re.compile(r"\s+")
+# Largest prime below 2^32, so the signature values fit in 32 bits and
+# a * x + b stays below 2^63 for the 32 bit shingle hashes
+PRIME = (1 << 32) - 5
+
+
+def normalize(sentence):
+    return whitespacePattern.sub(" ", sentence.casefold()).strip()
+
+
+class Generation:
+    def __init__(self, bands, capacity, numPerm):
+        self.exact = set()
+        self.buckets = [{} for _ in range(bands)]
+        # Pages of np.empty are only allocated once they are written
+        self.signatures = np.empty((capacity, numPerm), dtype=np.uint32)
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+
+class SentenceDeduplicator:
+    def __init__(self, threshold=0.8, numPerm=128, bands=16, shingleSize=5, capacity=200000, maxBucket=32, seed=0):
+        if numPerm % bands != 0:
+            raise ValueError("numPerm must be a multiple of bands")
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = numPerm // bands
+        self.shingleSize = shingleSize
+        self.capacity = capacity
+        self.numPerm = numPerm
+        self.maxBucket = maxBucket
+        rng = np.random.default_rng(seed)
+        self.a = rng.integers(1, 1 << 31, size=numPerm, dtype=np.uint64)
+        self.b = rng.integers(0, 1 << 31, size=numPerm, dtype=np.uint64)
+        self.current = Generation(bands, capacity, numPerm)
+        self.previous = Generation(bands, 0, numPerm)
+        self.stats = {"sentences":0, "kept":0, "exact":0, "near":0, "candidates":0}
+
+    def signature(self, normalized):
+        # MinHash over the character shingles, None for sentences shorter than a shingle
+        n = self.shingleSize
+        if len(normalized) < n:
+            return None
+        shingles = {normalized[i:i+n] for i in range(len(normalized) - n + 1)}
+        hashes = np.fromiter((zlib.crc32(shingle.encode("utf-8")) for shingle in shingles),
+                             dtype=np.uint64, count=len(shingles))
+        return ((np.outer(hashes, self.a) + self.b) % PRIME).min(axis=0).astype(np.uint32)
+
+    def bandKeys(self, signature):
+        return [signature[i*self.rows:(i+1)*self.rows].tobytes() for i in range(self.bands)]
+
+    def findNear(self, signature, keys):
+        for generation in (self.current, self.previous):
+            candidates = {candidate for band, key in enumerate(keys)
+                          for candidate in generation.buckets[band].get(key, ())}
+            if not candidates:
+                continue
+            self.stats["candidates"] += len(candidates)
+            # All candidates of a generation are compared at once
+            agreement = (generation.signatures[list(candidates)] == signature).mean(axis=1)
+            if (agreement >= self.threshold).any():
+                return True
+        return False
+
+    def rollover(self):
+        # Kept sentences and near-duplicate keys both count, so the exact set is bounded too
+        if len(self.current.exact) >= self.capacity:
+            self.previous = self.current
+            self.current = Generation(self.bands, self.capacity, self.numPerm)
+
+    def add(self, exactKey, signature, keys):
+        self.rollover()
+        generation = self.current
+        generation.exact.add(exactKey)
+        position = generation.size
+        generation.size += 1
+        if signature is not None:
+            generation.signatures[position] = signature
+            for band, key in enumerate(keys):
+                bucket = generation.buckets[band].setdefault(key, [])
+                if len(bucket) < self.maxBucket:
+                    bucket.append(position)
+
+    def check(self, sentence):
+        # Returns "exact", "near" or None for a new sentence, which is added to the index
+        self.stats["sentences"] += 1
+        normalized = normalize(sentence)
+        exactKey = hashlib.blake2b(normalized.encode("utf-8"), digest_size=8).digest()
+        if exactKey in self.current.exact or exactKey in self.previous.exact:
+            self.stats["exact"] += 1
+            return "exact"
+
+        signature = self.signature(normalized)
+        keys = self.bandKeys(signature) if signature is not None else None
+        if signature is not None and self.findNear(signature, keys):
+            self.stats["near"] += 1
+            # Near duplicates are not indexed, so a chain of small edits cannot drift away from the original
+            self.rollover()
+            self.current.exact.add(exactKey)
+            return "near"
+
+        self.add(exactKey, signature, keys)
+        self.stats["kept"] += 1
+        return None
+
+
+def dedupSentences(records, deduplicator, key=lambda record: record):
+    # Yields the records whose sentence is neither an exact nor a near duplicate of an earlier one
+    for record in records:
+        if deduplicator.check(key(record)) is None:
+            yield record
+
+def formatStats(stats, seconds=None):
+    removed = stats["exact"] + stats["near"]
+    line = (str(stats["sentences"]) + " sentences, " + str(stats["kept"]) + " kept, " + str(stats["exact"]) +
+            " exact and " + str(stats["near"]) + " near duplicates removed (" +
+            str(round(100 * removed / max(stats["sentences"], 1), 1)) + "%)")
+    if seconds is not None:
+        line += " in " + str(round(seconds, 1)) + "s"
+    return line
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Removes exact and near-duplicate sentences before annotation")
+    parser.add_argument("--input", default="DanishWikiSentences.ndjson", help="NDJSON of {\"title\",\"sentence\"} records")
+    parser.add_argument("--output", default="DanishWikiSentencesDedup.ndjson")
+    parser.add_argument("--threshold", type=float, default=0.8,
+                        help="Share of equal MinHash values from which two sentences are near duplicates")
+    parser.add_argument("--num_perm", type=int, default=128, help="Length of the MinHash signatures")
+    parser.add_argument("--bands", type=int, default=16, help="LSH bands, num_perm must be a multiple")
+    parser.add_argument("--shingle_size", type=int, default=5, help="Characters per shingle")
+    parser.add_argument("--capacity", type=int, default=200000,
+                        help="Sentences per index generation, at most two generations are kept in memory")
+    parser.add_argument("--max_bucket", type=int, default=32, help="Sentences kept per LSH bucket")
+    parser.add_argument("--stats", default=None, help="JSON file the dedup statistics are written to")
+    args = parser.parse_args()
+
+    deduplicator = SentenceDeduplicator(args.threshold, args.num_perm, args.bands, args.shingle_size, args.capacity,
+                                        args.max_bucket)
+    start = time.perf_counter()
+    with open(args.input, "r", encoding="utf-8") as inputfile, open(args.output, "w", encoding="utf-8") as outputfile:
+        records = (json.loads(line) for line in inputfile)
+        for record in dedupSentences(records, deduplicator, key=lambda record: record["sentence"]):
+            outputfile.write(json.dumps(record) + "\n")
+            if deduplicator.stats["kept"] % 10000 == 0:
+                print(formatStats(deduplicator.stats), end="\r")
+    seconds = time.perf_counter() - start
+    print(formatStats(deduplicator.stats, seconds))
+
+    if args.stats is not None:
+        with open(args.stats, "w", encoding="utf-8") as file:
+            json.dump(dict(deduplicator.stats, seconds=round(seconds, 2)), file)
@@ -0,0 +1,76 @@
+import argparse
+import json
+import re
+import spacy
+
+from docCache import DocCache
+from sentenceDedup import SentenceDeduplicator, dedupSentences, formatStats
+
+# Splits the DanishWikiData.ndjson pages into the sentences that are sent to
+# DBpedia Spotlight. Only sentence boundaries are needed here, so a blank
+# pipeline with the rule-based sentencizer replaces the full da_core_news_sm.
+
+# Parentheses and "== Heading ==" lines
+cleaningPattern = re.compile(r"( )\([^)]*\)|\([^)]*\)|\={2,}[^=]*\={2,}")
+newlinePattern = re.compile(r"(\n)+")
+
+def isArticle(title):
+    return title.split(":")[0] != "Kategori"
+
+def cleanPage(pagecontent):
+    return cleaningPattern.sub("", pagecontent)
+
+def loadSentencizer(lang="da"):
+    nlp = spacy.blank(lang)
+    nlp.add_pipe("sentencizer")
+    return nlp
+
+def readPages(path):
+    with open(path, "r", encoding="utf-8") as file:
+        for line in file:
+            try:
+                page = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if isArticle(page["title"]):
+                yield cleanPage(page["pagecontent"]), page["title"]
+
+def extractSentences(nlp, pages, batchSize=64, jobs=1, minWords=4, docCache=None):
+    # pages are (cleaned pagecontent, title) tuples, sentences are yielded
+    # in page order together with the title they came from
+    pipe = docCache.pipe if docCache is not None else nlp.pipe
+    for doc, title in pipe(pages, as_tuples=True, batch_size=batchSize, n_process=jobs):
+        for sent in doc.sents:
+            if len(sent.text.strip().split(" ")) >= minWords:
+                yield title, newlinePattern.sub(" ", sent.text).strip(" ")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Extracts sentences from Danish Wikipedia pages")
+    parser.add_argument("--input", default="DanishWikiData.ndjson", help="NDJSON of {\"title\",\"pagecontent\"} pages")
+    parser.add_argument("--output", default="DanishWikiSentences.ndjson",
+                        help="NDJSON of {\"title\",\"sentence\"} records")
+    parser.add_argument("--jobs", type=int, default=1, help="Number of processes used by nlp.pipe")
+    parser.add_argument("--batch_size", type=int, default=64, help="Pages per nlp.pipe batch")
+    parser.add_argument("--doc_cache", default=None,
+                        help="Directory of a spaCy Doc cache (see docCache.py), so pages split before are not split again")
+    parser.add_argument("--dedup", action="store_true", default=False,
+                        help="Leave out exact and near-duplicate sentences, see sentenceDedup.py")
+    parser.add_argument("--dedup_threshold", type=float, default=0.8,
+                        help="Share of equal MinHash values from which two sentences are near duplicates")
+    args = parser.parse_args()
+
+    nlp = loadSentencizer()
+    docCache = DocCache(args.doc_cache, nlp) if args.doc_cache is not None else None
+    sentences = extractSentences(nlp, readPages(args.input), args.batch_size, args.jobs, docCache=docCache)
+    if args.dedup:
+        deduplicator = SentenceDeduplicator(args.dedup_threshold)
+        sentences = dedupSentences(sentences, deduplicator, key=lambda record: record[1])
+    with open(args.output, "w", encoding="utf-8") as outputfile:
+        counter = 0
+        for title, sentence in sentences:
+            outputfile.write(json.dumps({"title":title, "sentence":sentence})+"\n")
+            counter += 1
+            print(counter, end="\r")
+    if args.dedup:
+        print(formatStats(deduplicator.stats))
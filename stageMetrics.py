@@ -0,0 +1,103 @@
+import cProfile
+import io
+import os
+import pstats
+import resource
+import shutil
+import signal
+import subprocess
+import time
+
+# Shared metrics hook of the pipeline stages. A stage times its work with
+# measure(name) and counts the records it handled with add(name, records);
+# both only cost a timer or an addition, so the hook is always on. A driver
+# such as benchmark.py picks a profiler with configure() and reads the
+# results of a stage with stage(name).result().
+#
+# The dagw scripts add the repository root to sys.path to import the hook.
+
+settings = {"profiler":"none", "profileDir":None}
+stages = {}
+
+
+class Metrics:
+    # Timing, throughput, peak RSS and optional profile of one stage
+    def __init__(self, name, profiler="none", profileDir=None):
+        self.name = name
+        self.profiler = profiler
+        self.profileDir = profileDir
+        self.records = 0
+        self.seconds = 0.0
+        self.profile = None
+
+    def add(self, records=1):
+        self.records += records
+
+    def measure(self):
+        return Measurement(self)
+
+    def result(self):
+        # ru_maxrss is in kilobytes on Linux
+        peakRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        peakChildrenRss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+        return {"records":self.records,
+                "seconds":round(self.seconds, 4),
+                "records_per_sec":round(self.records / self.seconds, 2) if self.seconds > 0 else None,
+                "peak_rss_mb":round(peakRss, 1),
+                "peak_children_rss_mb":round(peakChildrenRss, 1),
+                "profile":self.profile}
+
+
+class Measurement:
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.profiler = None
+        self.pySpy = None
+
+    def __enter__(self):
+        metrics = self.metrics
+        if metrics.profiler == "cprofile":
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        elif metrics.profiler == "py-spy":
+            if shutil.which("py-spy") is None:
+                print("py-spy is not installed, " + metrics.name + " is not profiled")
+            else:
+                metrics.profile = os.path.join(metrics.profileDir, metrics.name + ".svg")
+                self.pySpy = subprocess.Popen(["py-spy", "record", "--subprocesses", "-o", metrics.profile,
+                                               "--pid", str(os.getpid())], stdout=subprocess.DEVNULL)
+        self.start = time.perf_counter()
+        return metrics
+
+    def __exit__(self, *exc):
+        metrics = self.metrics
+        metrics.seconds += time.perf_counter() - self.start
+        if self.profiler is not None:
+            self.profiler.disable()
+            metrics.profile = os.path.join(metrics.profileDir, metrics.name + ".prof")
+            self.profiler.dump_stats(metrics.profile)
+            summary = io.StringIO()
+            pstats.Stats(self.profiler, stream=summary).sort_stats("cumulative").print_stats(15)
+            with open(os.path.join(metrics.profileDir, metrics.name + ".txt"), "w", encoding="utf-8") as file:
+                file.write(summary.getvalue())
+        if self.pySpy is not None:
+            # py-spy writes its output when interrupted
+            self.pySpy.send_signal(signal.SIGINT)
+            self.pySpy.wait()
+        return False
+
+
+def configure(profiler="none", profileDir=None):
+    settings["profiler"] = profiler
+    settings["profileDir"] = profileDir
+
+def stage(name):
+    if name not in stages:
+        stages[name] = Metrics(name, settings["profiler"], settings["profileDir"])
+    return stages[name]
+
+def add(name, records=1):
+    stage(name).add(records)
+
+def measure(name):
+    return stage(name).measure()
@@ -0,0 +1,89 @@
+import argparse
+import json
+import os
+import numpy as np
+
+from conceptStore import KINDS, ConceptStore, convert
+
+# Pairs every concept (target) with every VERB/ADJ/ADV span (aspect) of the
+# same sentence. All pairs are computed at once from the sorted rows of a
+# ConceptStore using the (text_id, sent_id) group boundaries, so the cost is
+# linear in the number of spans and pairs.
+
+CONCEPT_KIND = KINDS.index("concepts")
+
+
+def findPairs(store):
+    # Returns the (target row, aspect row) arrays, ordered by text_id and sent_id
+    textIds = np.asarray(store.columns["text_id"])
+    sentIds = np.asarray(store.columns["sent_id"])
+    kinds = np.asarray(store.columns["kind"])
+
+    # Rows are sorted by (text_id, sent_id), a new group starts wherever either changes
+    newGroup = np.ones(len(textIds), dtype=bool)
+    newGroup[1:] = (textIds[1:] != textIds[:-1]) | (sentIds[1:] != sentIds[:-1])
+    groups = np.cumsum(newGroup) - 1
+    nGroups = int(groups[-1]) + 1 if len(groups) > 0 else 0
+
+    isTarget = kinds == CONCEPT_KIND
+    targetRows = np.flatnonzero(isTarget)
+    aspectRows = np.flatnonzero(~isTarget)
+
+    aspectCounts = np.bincount(groups[aspectRows], minlength=nGroups)
+    aspectStarts = np.zeros(nGroups, dtype=np.int64)
+    aspectStarts[1:] = np.cumsum(aspectCounts)[:-1]
+
+    # Every target is repeated once per aspect of its group
+    pairsPerTarget = aspectCounts[groups[targetRows]]
+    pairTargets = np.repeat(targetRows, pairsPerTarget)
+    blockStarts = np.repeat(np.cumsum(pairsPerTarget) - pairsPerTarget, pairsPerTarget)
+    aspectOffsets = np.arange(len(pairTargets)) - blockStarts
+    pairAspects = aspectRows[aspectStarts[groups[pairTargets]] + aspectOffsets]
+
+    return pairTargets, pairAspects
+
+def iterPairs(store, lowercase=False, skipEmpty=False):
+    # Yields (text_id, [[target, aspect], ...]) for every text_id in the store
+    pairTargets, pairAspects = findPairs(store)
+    strings = store.decodeStrings()
+    if lowercase:
+        strings = [string.lower() for string in strings]
+
+    texts = np.asarray(store.columns["text"])
+    targetTexts = texts[pairTargets]
+    aspectTexts = texts[pairAspects]
+    pairTextIds = np.asarray(store.columns["text_id"])[pairTargets]
+    textBounds = np.searchsorted(pairTextIds, np.arange(store.nTexts + 1))
+
+    for textId in range(store.nTexts):
+        start, end = textBounds[textId], textBounds[textId + 1]
+        if skipEmpty and start == end:
+            continue
+        yield textId, [[strings[t], strings[a]] for t, a in zip(targetTexts[start:end], aspectTexts[start:end])]
+
+def writePairs(store, outputPath, lowercase=False, skipEmpty=False):
+    count = 0
+    with open(outputPath, "w", encoding="utf-8") as outputfile:
+        for textId, pairs in iterPairs(store, lowercase, skipEmpty):
+            outputfile.write(json.dumps(pairs) + "\n")
+            count += len(pairs)
+    return count
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generates target/aspect pairs from extracted concepts")
+    parser.add_argument("input", help="*_concepts_extracted.json file")
+    parser.add_argument("output", help="JSON lines file, one list of [target, aspect] pairs per text_id")
+    parser.add_argument("--store", default=None,
+                        help="Columnar store of the input, built by conceptStore.py if it does not exist")
+    parser.add_argument("--lowercase", action="store_true", default=False)
+    parser.add_argument("--skip_empty", action="store_true", default=False,
+                        help="Leave out texts without any pairs instead of writing an empty list")
+    args = parser.parse_args()
+
+    storeDir = args.store if args.store is not None else os.path.splitext(args.input)[0] + "_store"
+    if not os.path.exists(storeDir):
+        convert(args.input, storeDir)
+
+    count = writePairs(ConceptStore(storeDir), args.output, args.lowercase, args.skip_empty)
+    print(str(count) + " pairs written")
@@ -0,0 +1,225 @@
+import http.server
+import json
+import subprocess
+import sys
+import threading
+import urllib.error
+import urllib.request
+
+import pytest
+import spacy
+
+from conceptInference import ConceptExtractor, DynamicBatcher, OnmtTranslator, lengthBatches, makeHandler
+from conceptStore import FIELD_ORDER, KINDS
+
+TAGS = {"hader": "VERB", "dumme": "ADJ", "meget": "ADV", "Danmark": "PROPN", "muslimer": "NOUN",
+        "Anders": "PROPN", "Fogh": "PROPN"}
+
+
+def taggedPipeline():
+    # A blank pipeline with sentence boundaries and fixed POS tags, standing in for da_core_news_sm
+    nlp = spacy.blank("da")
+    nlp.add_pipe("sentencizer")
+    ruler = nlp.add_pipe("attribute_ruler")
+    ruler.add([[{}]], {"POS": "X", "TAG": "X"})
+    for word, pos in TAGS.items():
+        ruler.add([[{"ORTH": word}]], {"POS": pos, "TAG": pos})
+    return nlp
+
+
+class NounTranslator:
+    # Predicts the nouns and proper nouns of the source, separated by "*"
+    def __init__(self):
+        self.batches = []
+
+    def translate(self, sources):
+        self.batches.append(len(sources))
+        targets = []
+        for source in sources:
+            tokens = source.split()
+            words = [tokens[i] for i in range(0, len(tokens), 2) if tokens[i + 1] in ("NOUN", "PROPN")]
+            targets.append(" * ".join(words))
+        return targets
+
+
+class FailingTranslator:
+    def translate(self, sources):
+        raise RuntimeError("model failed")
+
+
+class PickyTranslator(NounTranslator):
+    # Fails on empty sources, on whitespace tokens (a POS without its token) and on the word "fejl"
+    def translate(self, sources):
+        if any(not source or len(source.split()) % 2 or "fejl" in source.split() for source in sources):
+            raise RuntimeError("model failed")
+        return super().translate(sources)
+
+
+TEXTS = ["Jeg hader dumme muslimer i Danmark. Meget dumme!", "Anders Fogh er meget dum", "ok"]
+
+
+def test_lengthBatches():
+    lengths = [5, 1, 9, 3, 3, 7]
+    batches = lengthBatches(lengths, maxBatch=2, maxTokens=100)
+    assert sorted(i for batch in batches for i in batch) == list(range(len(lengths)))
+    assert all(len(batch) <= 2 for batch in batches)
+    assert [lengths[batch[0]] for batch in batches] == sorted(lengths[batch[0]] for batch in batches)
+    # Padded to its longest source, no batch exceeds maxTokens unless it holds a single source
+    batches = lengthBatches(lengths, maxBatch=10, maxTokens=12)
+    assert all(len(batch) * max(lengths[i] for i in batch) <= 12 or len(batch) == 1 for batch in batches)
+
+
+def test_extractorSchemaAndCache():
+    translator = NounTranslator()
+    extractor = ConceptExtractor(taggedPipeline(), translator, maxBatch=2, maxTokens=100)
+    concepts = extractor.extract(TEXTS + [TEXTS[0]])
+
+    assert list(concepts) == KINDS
+    assert all(list(span) == FIELD_ORDER for kind in KINDS for span in concepts[kind])
+    first = [(span["text"], span["sent_id"], span["text_id"]) for span in concepts["concepts"]]
+    assert first == [("muslimer", "0", 0), ("Danmark", "0", 0), ("Anders", "2", 1), ("Fogh", "2", 1),
+                     ("muslimer", "4", 3), ("Danmark", "4", 3)]
+    span = concepts["concepts"][1]
+    assert TEXTS[0][span["begin"]:span["end"]] == "Danmark"
+    assert (span["next_word"], span["type"]) == (".", "NOUN")
+    assert [span["text"] for span in concepts["VERB"]] == ["hader", "hader"]
+    assert [span["text"] for span in concepts["ADV"]] == ["meget"]
+
+    # Repeated texts are translated once, in batches of at most maxBatch
+    assert sum(translator.batches) == 3 and max(translator.batches) <= 2
+    assert extractor.extract(TEXTS) == extractor.extract(TEXTS)
+    assert sum(translator.batches) == 3
+    assert extractor.stats["hits"] == 6
+
+
+def test_batcherCombinesConcurrentRequests():
+    translator = NounTranslator()
+    extractor = ConceptExtractor(taggedPipeline(), translator, maxBatch=64)
+    batcher = DynamicBatcher(extractor.process, maxBatch=64, maxWait=0.2)
+    futures = [batcher.submit("Hej Danmark nummer " + str(i)) for i in range(10)]
+    results = [future.result(5) for future in futures]
+    batcher.close()
+    assert translator.batches == [10]
+    assert [spans[-1][1]["text"] for spans, nSentences in results] == ["Danmark"] * 10
+
+
+def test_batcherPropagatesErrors():
+    batcher = DynamicBatcher(ConceptExtractor(taggedPipeline(), FailingTranslator()).process)
+    with pytest.raises(RuntimeError):
+        batcher.extract(["Hej Danmark"], 5)
+    batcher.close()
+
+
+def test_emptyTextsAreNotTranslated():
+    translator = PickyTranslator()
+    extractor = ConceptExtractor(taggedPipeline(), translator)
+    concepts = extractor.extract(["", "Hej Danmark", " "])
+    assert [(span["text"], span["text_id"]) for span in concepts["concepts"]] == [("Danmark", 1)]
+    assert translator.batches == [1]
+
+
+def test_batcherIsolatesFailingTexts():
+    translator = PickyTranslator()
+    batcher = DynamicBatcher(ConceptExtractor(taggedPipeline(), translator).process, maxWait=0.2)
+    futures = [batcher.submit(text) for text in ["Hej Danmark", "fejl", "Anders Fogh"]]
+    with pytest.raises(RuntimeError):
+        futures[1].result(5)
+    assert [futures[0].result(5)[0][-1][1]["text"], futures[2].result(5)[0][-1][1]["text"]] == ["Danmark", "Fogh"]
+    batcher.close()
+
+
+def serve(extractor):
+    batcher = DynamicBatcher(extractor.process, maxWait=0.01)
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), makeHandler(batcher, extractor, 5))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, batcher, "http://127.0.0.1:" + str(server.server_address[1])
+
+def post(url, body):
+    request = urllib.request.Request(url + "/extract", json.dumps(body).encode("utf-8"))
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as error:
+        return error.code, json.loads(error.read())
+
+
+def test_httpHandler():
+    extractor = ConceptExtractor(taggedPipeline(), NounTranslator())
+    server, batcher, url = serve(extractor)
+    try:
+        status, concepts = post(url, {"texts": TEXTS})
+        assert status == 200
+        assert concepts == extractor.extract(TEXTS)
+        assert post(url, {"text": "forkert"})[0] == 400
+        assert post(url, {"texts": [1, 2]})[0] == 400
+        with urllib.request.urlopen(url + "/stats") as response:
+            assert json.loads(response.read())["cached"] == len(TEXTS)
+    finally:
+        server.shutdown()
+        server.server_close()
+        batcher.close()
+
+
+def test_httpHandlerReportsModelErrors():
+    server, batcher, url = serve(ConceptExtractor(taggedPipeline(), FailingTranslator()))
+    try:
+        status, body = post(url, {"texts": ["Hej Danmark"]})
+        assert status == 500
+        assert "model failed" in body["error"]
+    finally:
+        server.shutdown()
+        server.server_close()
+        batcher.close()
+
+
+def test_tinyOnmtModel(tmp_path):
+    # Trains a tiny copy-attention model for one step, i.e. a randomly initialised one,
+    # with the options of concept_extraction_*.yaml, and serves it through OnmtTranslator
+    pytest.importorskip("torch")
+    onmt = pytest.importorskip("onmt")
+    if not onmt.__version__.startswith("2."):
+        with pytest.raises(RuntimeError, match="OpenNMT-py 2.x"):
+            OnmtTranslator("model.pt")
+        pytest.skip("OpenNMT-py " + onmt.__version__ + " does not load the concept extraction models")
+    nlp = taggedPipeline()
+    sources = [" ".join(token.text + " " + token.pos_ for token in nlp(text)) for text in TEXTS * 4]
+    (tmp_path / "src.txt").write_text("\n".join(sources) + "\n", encoding="utf-8")
+    (tmp_path / "tgt.txt").write_text("\n".join(["muslimer * Danmark", "Anders Fogh", "ok"] * 4) + "\n",
+                                      encoding="utf-8")
+    config = tmp_path / "tiny.yaml"
+    config.write_text("\n".join([
+        "save_data: " + str(tmp_path / "run"),
+        "src_vocab: " + str(tmp_path / "vocab.src"),
+        "tgt_vocab: " + str(tmp_path / "vocab.tgt"),
+        "overwrite: True",
+        "data:",
+        "    train:",
+        "        path_src: " + str(tmp_path / "src.txt"),
+        "        path_tgt: " + str(tmp_path / "tgt.txt"),
+        "save_model: " + str(tmp_path / "model"),
+        "copy_attn: true",
+        "global_attention: mlp",
+        "coverage_attn: true",
+        "reuse_copy_attn: true",
+        "copy_loss_by_seqlength: true",
+        "word_vec_size: 8",
+        "rnn_size: 8",
+        "layers: 1",
+        "encoder_type: brnn",
+        "train_steps: 1",
+        "save_checkpoint_steps: 1",
+        "batch_size: 4",
+        "bucket_size: 16",
+        "optim: sgd",
+        "learning_rate: 0.1",
+        "seed: 0",
+    ]) + "\n", encoding="utf-8")
+    for command in ["build_vocab", "train"]:
+        arguments = ["-config", str(config)] + (["-n_sample", "-1"] if command == "build_vocab" else [])
+        subprocess.run([sys.executable, "-m", "onmt.bin." + command] + arguments, check=True, cwd=tmp_path)
+
+    translator = OnmtTranslator(str(tmp_path / "model_step_1.pt"), beamSize=2, maxLength=5)
+    extractor = ConceptExtractor(nlp, translator, maxBatch=2)
+    concepts = extractor.extract(TEXTS)
+    assert list(concepts) == KINDS
+    assert all(span["text_id"] in range(len(TEXTS)) for span in concepts["concepts"])
@@ -0,0 +1,42 @@
+import random
+
+from dataAnnotation import cleanTarget, createTarget, createTargetLegacy
+
+WORDS = ["Danmark", "Sverige", "(Schweiz)", "København,", "og", "i", "Anders", "Fogh", "Rasmussen", ":", "EU"]
+
+
+def randomEntry(rng):
+    # A Spotlight response whose resources start at token offsets, with some
+    # at offsets inside tokens, repeated or out of order as in real responses
+    tokens = [rng.choice(WORDS) for _ in range(rng.randint(1, 12))]
+    text = " ".join(tokens)
+    offsets = []
+    position = 0
+    for token in tokens:
+        offsets.append(position)
+        position += len(token) + 1
+
+    resources = []
+    for _ in range(rng.randint(0, 6)):
+        offset = rng.choice(offsets) if rng.random() < 0.8 else rng.randrange(len(text))
+        resources.append({"@offset": str(offset), "@surfaceForm": text[offset:].split(" ")[0]})
+    if rng.random() < 0.7:
+        resources.sort(key=lambda resource: int(resource["@offset"]))
+    return {"@text": text, "Resources": resources}
+
+
+def test_createTargetMatchesLegacy():
+    rng = random.Random(0)
+    for _ in range(20000):
+        dbEntry = randomEntry(rng)
+        assert createTarget(dbEntry) == createTargetLegacy(dbEntry), dbEntry
+        assert cleanTarget(createTarget(dbEntry)) == cleanTarget(createTargetLegacy(dbEntry)), dbEntry
+
+
+def test_attachedPunctuation():
+    dbEntry = {"@text": "Fra (Schweiz til Danmark,Sverige",
+               "Resources": [{"@offset": "5", "@surfaceForm": "Schweiz"},
+                             {"@offset": "17", "@surfaceForm": "Danmark"},
+                             {"@offset": "25", "@surfaceForm": "Sverige"}]}
+    assert createTarget(dbEntry) == "Danmark *"
+    assert createTarget(dbEntry, attachedPunctuation=True) == "Schweiz * Danmark Sverige"
@@ -0,0 +1,77 @@
+import http.server
+import json
+import threading
+import urllib.parse
+
+import pytest
+import requests
+
+from dbSpotlight import DBSpotlight
+
+
+class StubSpotlight(http.server.BaseHTTPRequestHandler):
+    # Answers 503 to the first two requests of every text, then echoes it
+    requests = []
+    failures = {}
+    lock = threading.Lock()
+
+    def do_GET(self):
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+        text = query["text"][0]
+        with self.lock:
+            self.requests.append(text)
+            failed = self.failures.get(text, 0)
+            self.failures[text] = failed + 1
+        if failed < 2:
+            self.send_response(503)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = json.dumps({"@text": text, "@confidence": query["confidence"][0]}).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        return
+
+
+@pytest.fixture
+def server():
+    StubSpotlight.requests = []
+    StubSpotlight.failures = {}
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), StubSpotlight)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_annotateManyRetriesInOrderAndCaches(server, tmp_path):
+    texts = ["sætning " + str(i) for i in range(40)]
+    cachePath = str(tmp_path / "cache.sqlite")
+
+    client = DBSpotlight("http://127.0.0.1", str(server.server_address[1]), workers=4, backoff=0.001,
+                         cachePath=cachePath)
+    responses = list(client.annotateMany(texts, 0.5))
+    client.close()
+    assert [json.loads(response)["@text"] for response in responses] == texts
+    assert len(StubSpotlight.requests) == 3 * len(texts)
+
+    # A re-run with the same confidence is answered from the cache
+    client = DBSpotlight("http://127.0.0.1", str(server.server_address[1]), workers=4, backoff=0.001,
+                         cachePath=cachePath)
+    assert list(client.annotateMany(texts, 0.5)) == responses
+    client.close()
+    assert len(StubSpotlight.requests) == 3 * len(texts)
+
+
+def test_retriesAreBounded(server):
+    client = DBSpotlight("http://127.0.0.1", str(server.server_address[1]), maxRetries=1, backoff=0.001)
+    with pytest.raises(requests.HTTPError):
+        client.annotate("altid overbelastet", 0.5)
+    client.close()
+    assert StubSpotlight.requests == ["altid overbelastet"] * 2
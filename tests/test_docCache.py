@@ -0,0 +1,47 @@
+import spacy
+
+from docCache import DocCache
+
+
+def pipeline():
+    nlp = spacy.blank("da")
+    nlp.add_pipe("sentencizer")
+    return nlp
+
+
+def counted(texts, consumed):
+    for text in texts:
+        consumed.append(text)
+        yield text
+
+
+TEXTS = ["Tekst nummer " + str(i) + ". Anden sætning." for i in range(500)]
+
+
+def test_pipeMatchesPipeline(tmp_path):
+    nlp = pipeline()
+    cache = DocCache(str(tmp_path), nlp)
+    expected = [[sent.text for sent in doc.sents] for doc in nlp.pipe(TEXTS)]
+    # Every third text cached beforehand, so chunks mix hits and misses
+    list(cache.pipe(TEXTS[::3], batch_size=16))
+    items = [(text, i) for i, text in enumerate(TEXTS + TEXTS[:10])]
+    result = list(cache.pipe(items, as_tuples=True, batch_size=16, maxPending=2))
+    assert [i for doc, i in result] == list(range(len(items)))
+    assert [[sent.text for sent in doc.sents] for doc, i in result] == expected + expected[:10]
+    assert cache.stats["misses"] == len(TEXTS)
+    cache.close()
+
+
+def test_pipeStreamsWarmCache(tmp_path):
+    cache = DocCache(str(tmp_path), pipeline())
+    list(cache.pipe(TEXTS, batch_size=50))
+    consumed = []
+    docs = cache.pipe(counted(TEXTS, consumed), batch_size=50)
+    assert next(docs).text == TEXTS[0]
+    assert len(consumed) == 50
+    # A single miss only reads ahead the chunks the pipeline can wait for
+    consumed.clear()
+    docs = cache.pipe(counted(TEXTS[:100] + ["Ny tekst."] + TEXTS[100:], consumed), batch_size=50, maxPending=3)
+    assert [doc.text for _, doc in zip(range(101), docs)][-1] == "Ny tekst."
+    assert len(consumed) <= 4 * 50
+    cache.close()
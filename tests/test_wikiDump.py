@@ -0,0 +1,34 @@
+import bz2
+import os
+import subprocess
+
+import pytest
+
+from wikiDump import iterPages, stripMarkup
+
+DUMP = """<mediawiki xmlns="http://www.mediawiki.org/xml/export-0.10/">
+  <page><title>Danmark</title><ns>0</ns><revision><text>'''Danmark''' er et [[land|kongerige]].</text></revision></page>
+  <page><title>Skabelon:X</title><ns>10</ns><revision><text>{{x}}</text></revision></page>
+  <page><title>DK</title><ns>0</ns><redirect title="Danmark" /><revision><text>#REDIRECT [[Danmark]]</text></revision></page>
+</mediawiki>
+"""
+
+
+def test_iterPages(tmp_path):
+    path = tmp_path / "dump.xml.bz2"
+    path.write_bytes(bz2.compress(DUMP.encode("utf-8")))
+    pages = list(iterPages(str(path)))
+    assert [title for title, _ in pages] == ["Danmark"]
+    assert stripMarkup(pages[0][1]) == "Danmark er et kongerige."
+
+
+def test_iterPagesFailsWithDecompressor(tmp_path, monkeypatch):
+    # A decompressor that writes a complete document, then fails as on a corrupt archive
+    (tmp_path / "dump.xml").write_text(DUMP, encoding="utf-8")
+    fake = tmp_path / "bin" / "lbzip2"
+    fake.parent.mkdir()
+    fake.write_text("#!/bin/sh\ncat " + str(tmp_path / "dump.xml") + "\nexit 2\n")
+    fake.chmod(0o755)
+    monkeypatch.setenv("PATH", str(fake.parent) + os.pathsep + os.environ["PATH"])
+    with pytest.raises(subprocess.CalledProcessError):
+        list(iterPages(str(tmp_path / "dump.xml.bz2")))
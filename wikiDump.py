@@ -0,0 +1,138 @@
+import argparse
+import bz2
+import contextlib
+import json
+import multiprocessing
+import re
+import shutil
+import subprocess
+import xml.etree.ElementTree as ET
+
+# Turns a local dawiki pages-articles XML(.bz2) dump into the same
+# {"title","pagecontent"} NDJSON that wikidata.py fetches through the API.
+# One process decompresses and parses the XML while a pool of workers
+# strips the wiki markup.
+
+commentPattern = re.compile(r"<!--.*?-->", re.DOTALL)
+refPattern = re.compile(r"<ref[^>/]*/>|<ref[^>]*>.*?</ref>", re.DOTALL | re.IGNORECASE)
+innerTemplatePattern = re.compile(r"\{\{[^{}]*\}\}")
+innerTablePattern = re.compile(r"\{\|(?:(?!\{\|).)*?\|\}", re.DOTALL)
+mediaLinkPattern = re.compile(r"\[\[(?:Fil|File|Billede|Image|Kategori|Category):[^\[\]]*(?:\[\[[^\[\]]*\]\][^\[\]]*)*\]\]",
+                              re.IGNORECASE)
+pipedLinkPattern = re.compile(r"\[\[[^\[\]|]*\|([^\[\]]*)\]\]")
+linkPattern = re.compile(r"\[\[([^\[\]]*)\]\]")
+externalLinkPattern = re.compile(r"\[(?:https?:)?//[^\s\]]+\s*([^\]]*)\]")
+formattingPattern = re.compile(r"'{2,}")
+tagPattern = re.compile(r"</?[a-zA-Z][^>]*>")
+listPattern = re.compile(r"^[*#:;]+\s*", re.MULTILINE)
+blankLinesPattern = re.compile(r"\n{3,}")
+
+
+def removeNested(pattern, text):
+    # Templates and tables nest, so the innermost ones are removed until none are left
+    while True:
+        text, n = pattern.subn("", text)
+        if n == 0:
+            return text
+
+def stripMarkup(wikitext):
+    # Headings are kept as "== Heading ==" like in the API output,
+    # the sentence extraction removes them afterwards
+    text = commentPattern.sub("", wikitext)
+    text = refPattern.sub("", text)
+    text = removeNested(innerTemplatePattern, text)
+    text = removeNested(innerTablePattern, text)
+    text = mediaLinkPattern.sub("", text)
+    text = pipedLinkPattern.sub(r"\1", text)
+    text = linkPattern.sub(r"\1", text)
+    text = externalLinkPattern.sub(r"\1", text)
+    text = formattingPattern.sub("", text)
+    text = tagPattern.sub("", text)
+    text = listPattern.sub("", text)
+    text = blankLinesPattern.sub("\n\n", text)
+    return text.strip()
+
+@contextlib.contextmanager
+def openDump(dumpPath):
+    if not dumpPath.endswith(".bz2"):
+        with open(dumpPath, "rb") as file:
+            yield file
+        return
+    # lbzip2/pbzip2 decompress on several cores, bz2 is the single-core fallback
+    for command in ["lbzip2", "pbzip2"]:
+        if shutil.which(command) is not None:
+            process = subprocess.Popen([command, "-dc", dumpPath], stdout=subprocess.PIPE)
+            try:
+                yield process.stdout
+            finally:
+                process.stdout.close()
+                returncode = process.wait()
+            # A truncated or corrupt archive only shows in the exit code, the
+            # XML parser just sees the output end
+            if returncode != 0:
+                raise subprocess.CalledProcessError(returncode, process.args)
+            return
+    with bz2.open(dumpPath, "rb") as file:
+        yield file
+
+def localName(tag):
+    return tag.rsplit("}", 1)[-1]
+
+def iterPages(dumpPath, namespaces=("0",)):
+    # Yields (title, wikitext) for every non-redirect page in the given namespaces
+    with openDump(dumpPath) as file:
+        context = ET.iterparse(file, events=("start", "end"))
+        _, root = next(context)
+        title = namespace = text = None
+        isRedirect = False
+        for event, elem in context:
+            if event != "end":
+                continue
+            tag = localName(elem.tag)
+            if tag == "title":
+                title = elem.text
+            elif tag == "ns":
+                namespace = elem.text
+            elif tag == "redirect":
+                isRedirect = True
+            elif tag == "text":
+                text = elem.text or ""
+            elif tag == "page":
+                if namespace in namespaces and not isRedirect and title is not None:
+                    yield title, text
+                title = namespace = text = None
+                isRedirect = False
+                # Drop the finished page so memory stays flat
+                root.clear()
+
+def stripPage(page):
+    title, wikitext = page
+    return {
+        "title":title,
+        "pagecontent":stripMarkup(wikitext)
+    }
+
+def convertDump(dumpPath, outputPath, jobs, namespaces=("0",), chunkSize=64):
+    count = 0
+    with multiprocessing.Pool(jobs) as pool:
+        with open(outputPath, "w", encoding="utf-8") as outputfile:
+            for wikiDataDict in pool.imap(stripPage, iterPages(dumpPath, namespaces), chunkSize):
+                if wikiDataDict["pagecontent"] == "":
+                    continue
+                outputfile.write(json.dumps(wikiDataDict)+"\n")
+                count += 1
+                print(count, end="\r")
+    print(str(count) + " pages written")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Converts a dawiki pages-articles dump to DanishWikiData NDJSON")
+    parser.add_argument("--dump", required=True, help="dawiki-*-pages-articles.xml or .xml.bz2 dump")
+    parser.add_argument("--output", default="DanishWikiData.ndjson")
+    parser.add_argument("--jobs", type=int, default=multiprocessing.cpu_count(),
+                        help="Number of processes stripping markup")
+    parser.add_argument("--namespaces", nargs="+", default=["0"],
+                        help="Page namespaces to keep, 0 is articles and 14 is categories")
+    args = parser.parse_args()
+
+    convertDump(args.dump, args.output, args.jobs, tuple(args.namespaces))
@@ -1,40 +1,259 @@
-
 #import ijson
 import ijson.backends.yajl2 as ijson
+from ijson.common import JSONError
+import argparse
+import collections
 import json
+import multiprocessing
+import os
+import shutil
+import threading
 import wikipedia
 import time
+from concurrent.futures import ThreadPoolExecutor
+
+import stageMetrics
 wikipedia.set_lang("da")
 
 
+# The Wikidata JSON dump is one array with one entity per line, so every line
+# (minus the trailing comma) can be parsed on its own and the dump can be
+# entered at any line boundary.
 
-with open("wikidata-20220307-all.json", "rb") as file:
-    danishTitles = ijson.items(file, "item.sitelinks.dawiki.title")
-    count = 0
-    with open("DanishWikiData.ndjson", "a", encoding="utf-8") as outputfile:
-        for idx, title in enumerate(danishTitles):
-            if idx < 76032:
-                count +=1
-                print(count, end="\r")
-                continue
-            while True:
-                try:
-                    wikiDataDict = {
-                        "title":title,
-                        "pagecontent":wikipedia.page(title=title).content
-                    }
-                except (wikipedia.DisambiguationError, wikipedia.PageError, json.JSONDecodeError) as e:
-                    # Since we are parsing the entirety of wikipedia, we know we are going to reach all of the suggested pages at some point so we just skip if the title is ambiguas 
-                    break
-                except (wikipedia.WikipediaException, TimeoutError, ConnectionError):
-                    # This is the exception thrown if the call engine is currently busy
-                    print("Too busy right now, retrying in 5 seconds")
-                    time.sleep(5)
-                    continue
-
-
-                outputfile.write(json.dumps(wikiDataDict)+"\n")
-                count +=1
-                print(count, end="\r")
+def parseDanishTitle(line):
+    # Cheap byte check first, most entities have no Danish Wikipedia page
+    if b'"dawiki"' not in line:
+        return None
+    line = line.strip().rstrip(b",")
+    try:
+        return next(ijson.items(line, "sitelinks.dawiki.title"), None)
+    except JSONError:
+        return None
+
+def iterDanishTitles(dumpPath, start=0, end=None):
+    # Yields (title, offset) where offset is the byte position just after the entity
+    with open(dumpPath, "rb") as file:
+        file.seek(start)
+        position = start
+        while end is None or position < end:
+            line = file.readline()
+            if not line:
                 break
+            position += len(line)
+            title = parseDanishTitle(line)
+            if title is not None:
+                yield title, position
+
+def findShardRanges(path, nShards):
+    # Splits the file into byte ranges that start and end on line boundaries
+    fileSize = os.path.getsize(path)
+    boundaries = [0]
+
+    with open(path, "rb") as file:
+        for i in range(1, nShards):
+            file.seek(max(fileSize * i // nShards, boundaries[-1]))
+            if file.tell() > 0:
+                file.seek(file.tell() - 1)
+                file.readline()
+            boundaries.append(file.tell())
+    boundaries.append(fileSize)
+
+    return [(boundaries[i], boundaries[i+1]) for i in range(nShards) if boundaries[i] < boundaries[i+1]]
+
+def readCheckpoint(checkpointPath):
+    if not os.path.exists(checkpointPath):
+        return None
+    with open(checkpointPath, "r", encoding="utf-8") as file:
+        return json.load(file)
+
+def writeCheckpoint(checkpointPath, offset, title):
+    # Written to a temporary file first so a crash never leaves a broken checkpoint
+    with open(checkpointPath + ".tmp", "w", encoding="utf-8") as file:
+        json.dump({"offset":offset, "title":title}, file)
+    os.replace(checkpointPath + ".tmp", checkpointPath)
+
+def lastWrittenTitle(outputPath):
+    if not os.path.exists(outputPath):
+        return None
+    title = None
+    with open(outputPath, "r", encoding="utf-8") as file:
+        for line in file:
+            try:
+                title = json.loads(line)["title"]
+            except (json.JSONDecodeError, KeyError):
+                continue
+    return title
+
+def findResumeOffset(dumpPath, outputPath, checkpointPath):
+    checkpoint = readCheckpoint(checkpointPath)
+    if checkpoint is not None:
+        print("resuming after " + repr(checkpoint["title"]) + " at byte " + str(checkpoint["offset"]))
+        return checkpoint["offset"]
+
+    # Output from before checkpoints were recorded: find its last title in the dump once
+    title = lastWrittenTitle(outputPath)
+    if title is None:
+        return 0
+    print("no checkpoint, searching the dump for " + repr(title))
+    for dumpTitle, offset in iterDanishTitles(dumpPath):
+        if dumpTitle == title:
+            writeCheckpoint(checkpointPath, offset, title)
+            return offset
+    return 0
+
+class BusyError(Exception):
+    # Raised by a fetcher when the page should be requested again later
+    pass
+
+class WikipediaFetcher:
+    def fetch(self, title):
+        try:
+            return wikipedia.page(title=title).content
+        except (wikipedia.DisambiguationError, wikipedia.PageError, json.JSONDecodeError) as e:
+            # Since we are parsing the entirety of wikipedia, we know we are going to reach all of the suggested pages at some point so we just skip if the title is ambiguas
+            return None
+        except (wikipedia.WikipediaException, TimeoutError, ConnectionError) as e:
+            # This is the exception thrown if the call engine is currently busy
+            raise BusyError(str(e))
+
+class DirectoryFetcher:
+    # Local stand-in for Wikipedia: one <title>.txt file per page, with "/" replaced by "%2F"
+    def __init__(self, directory):
+        self.directory = directory
+
+    def fetch(self, title):
+        path = os.path.join(self.directory, title.replace("/", "%2F") + ".txt")
+        if not os.path.exists(path):
+            return None
+        with open(path, "r", encoding="utf-8") as file:
+            return file.read()
+
+class RateLimiter:
+    # Shared by all fetch threads: spaces requests at least minInterval apart and
+    # widens that interval while the server reports that it is busy
+    def __init__(self, requestsPerSecond, maxBackoff=60):
+        self.minInterval = 1 / requestsPerSecond if requestsPerSecond > 0 else 0
+        self.interval = self.minInterval
+        self.maxBackoff = maxBackoff
+        self.nextRequest = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            delay = max(0, self.nextRequest - now)
+            self.nextRequest = max(now, self.nextRequest) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+    def busy(self):
+        with self.lock:
+            self.interval = min(max(self.interval * 2, 1), self.maxBackoff)
+            self.nextRequest = time.monotonic() + self.interval
+
+    def success(self):
+        with self.lock:
+            self.interval = max(self.interval / 2, self.minInterval)
+
+def fetchPage(fetcher, limiter, title):
+    while True:
+        limiter.wait()
+        try:
+            pagecontent = fetcher.fetch(title)
+        except BusyError:
+            limiter.busy()
+            print("Too busy right now, backing off " + str(limiter.interval) + " seconds")
+            continue
+        limiter.success()
+        return pagecontent
+
+def harvest(dumpPath, outputPath, checkpointPath, fetcher, workers=8, requestsPerSecond=10, checkpointEvery=1000):
+    # Titles from the dump are fetched by a bounded pool of threads while this
+    # thread writes the pages in dump order, so the checkpoint stays exact
+    start = findResumeOffset(dumpPath, outputPath, checkpointPath)
+    limiter = RateLimiter(requestsPerSecond)
+    count = 0
+
+    def writeNext(idx, future):
+        nonlocal count
+        title, offset, pagecontent = future.result()
+        if pagecontent is not None:
+            wikiDataDict = {
+                "title":title,
+                "pagecontent":pagecontent
+            }
+            outputfile.write(json.dumps(wikiDataDict)+"\n")
+            count +=1
+            stageMetrics.add("wikidata_harvest")
+            print(count, end="\r")
+
+        # The checkpoint may never point past what has been flushed to the output
+        if pagecontent is not None or idx % checkpointEvery == 0:
+            outputfile.flush()
+            writeCheckpoint(checkpointPath, offset, title)
+
+    def fetchTitle(title, offset):
+        return title, offset, fetchPage(fetcher, limiter, title)
+
+    with open(outputPath, "a", encoding="utf-8") as outputfile, stageMetrics.measure("wikidata_harvest"):
+        with ThreadPoolExecutor(workers) as executor:
+            pending = collections.deque()
+            written = 0
+            for title, offset in iterDanishTitles(dumpPath, start):
+                pending.append(executor.submit(fetchTitle, title, offset))
+                if len(pending) >= 2 * workers:
+                    writeNext(written, pending.popleft())
+                    written += 1
+            while pending:
+                writeNext(written, pending.popleft())
+                written += 1
+
+def extractTitleShard(shard):
+    dumpPath, start, end, shardPath = shard
+    count = 0
+    with open(shardPath, "w", encoding="utf-8") as file:
+        for title, offset in iterDanishTitles(dumpPath, start, end):
+            file.write(title + "\n")
+            count += 1
+    return count
+
+def extractTitles(dumpPath, titlesPath, jobs):
+    # Extracts all Danish titles in parallel, one byte range of the dump per process
+    shards = [(dumpPath, start, end, titlesPath + ".shard" + str(shardIndex))
+              for shardIndex, (start, end) in enumerate(findShardRanges(dumpPath, jobs))]
+    with stageMetrics.measure("wikidata_titles"):
+        with multiprocessing.Pool(jobs) as pool:
+            count = sum(pool.map(extractTitleShard, shards))
+
+        with open(titlesPath, "wb") as outputFile:
+            for shard in shards:
+                with open(shard[3], "rb") as shardFile:
+                    shutil.copyfileobj(shardFile, outputFile)
+                os.remove(shard[3])
+    stageMetrics.add("wikidata_titles", count)
+    print(str(count) + " titles extracted")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Harvests Danish Wikipedia pages listed in a Wikidata dump")
+    parser.add_argument("--dump", default="wikidata-20220307-all.json", help="Wikidata JSON dump")
+    parser.add_argument("--output", default="DanishWikiData.ndjson", help="NDJSON file the pages are appended to")
+    parser.add_argument("--checkpoint", default=None,
+                        help="Checkpoint file, defaults to the output path with a .checkpoint suffix")
+    parser.add_argument("--extract_titles", default=None,
+                        help="Only write the Danish titles of the dump to this file")
+    parser.add_argument("--jobs", type=int, default=multiprocessing.cpu_count(),
+                        help="Number of processes used with --extract_titles")
+    parser.add_argument("--workers", type=int, default=8, help="Maximum number of pages fetched at the same time")
+    parser.add_argument("--requests_per_second", type=float, default=10,
+                        help="Upper bound on the request rate, 0 for no limit")
+    parser.add_argument("--pages_dir", default=None,
+                        help="Read pages from <title>.txt files in this directory instead of Wikipedia")
+    args = parser.parse_args()
 
+    if args.extract_titles is not None:
+        extractTitles(args.dump, args.extract_titles, args.jobs)
+    else:
+        checkpointPath = args.checkpoint if args.checkpoint is not None else args.output + ".checkpoint"
+        fetcher = DirectoryFetcher(args.pages_dir) if args.pages_dir is not None else WikipediaFetcher()
+        harvest(args.dump, args.output, checkpointPath, fetcher, args.workers, args.requests_per_second)